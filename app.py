@@ -1,43 +1,147 @@
-import datetime
+import os
+import time
 
-from flask import Flask, jsonify, request
-from flask_sqlalchemy import SQLAlchemy
+from flask import Blueprint, Flask, current_app, g, jsonify, request, stream_with_context
+from sqlalchemy import or_, text
+from sqlalchemy.orm import configure_mappers, selectinload
 import json
-import bcrypt
-import random
-
-DB_FILE = "clubreview.db"
-
-app = Flask(__name__)
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_FILE}"
-db = SQLAlchemy(app)
+from engine import engine_options, read_engine
+from database import db
+from pagination import InvalidPage, page_args, page_response
+from session_cache import session_cache
+from hashing import password_hasher, HashingUnavailable, HASH_RETRY_AFTER
+from catalog import catalog_changed, sync_catalog
+from response_cache import cached_get, response_cache
+from content_encoding import compressor, compress_response
+from metrics import metrics, route_of_request, TimedJSONProvider, PROMETHEUS_MIMETYPE
+from ratelimit import rate_limiter, client_key
+from models import Club, Tag, User
+from serializers import (chunked, club_summaries, club_details_by_code, clubs_by_code, favorite_users,
+                         favorite_users_export, tag_club_summaries, tags_with_club_cnt, user_favorite_club_details)
+from search import index_clubs, unindex_clubs, insert_search_rows, search_club_codes
+from favoriting import existing_codes, add_favorites, remove_favorite, user_favorite_codes
+from fragments import encode, fragment_cache
+from tag_index import tag_index, InvalidTagQuery
+from snapshot import catalog_snapshot
+from recommendations import co_favorites, MAX_SIMILAR
+from export import export_chunks, EXPORT_MIMETYPES
+from sessions import start_session, end_session, live_session, session_sweeper
+from changes import changes_since, change_log_compactor, change_reader
+
+""" The routes are registered on a blueprint, and create_app (at the end of this file) makes an app
+    serving them, binds db to it and configures the mappers. The models and every module the routes use
+    are imported once, above, instead of inside each handler: models.py imports db from database.py,
+    not from this file, so there is no import cycle left to work around.
+    `app` is the app made with the default configuration, used by `flask run`, the servers and the scripts
+"""
+DB_FILE = os.environ.get('DB_FILE', "clubreview.db")
+
+routes = Blueprint('routes', __name__)
 
 """ HELPER FUNCTIONS """
+# tag names are case insensitive, so duplicates are removed after lower casing
+def unique_tag_names (tag_names) :
+    return sorted(set(tag_name.lower() for tag_name in tag_names))
+
+# loads every existing tag among tag_names with one IN query, returns a dict name -> Tag
+def load_tags (tag_names) :
+    known_tags = {}
+    for batch in chunked(unique_tag_names(tag_names)) :
+        for tag in db.session.query(Tag).filter(Tag.name.in_(batch)) :
+            known_tags[tag.name] = tag
+    return known_tags
+
 # stream line the process of adding club-tag relationship
-def add_tag_to_club (club, tag_name):
-    from models import Tag, Club
+# known_tags is the result of load_tags for all the tags being added, new tags are added to it
+def add_tag_to_club (club, tag_name, known_tags=None):
     tag_name = tag_name.lower()
-    tag_placeholder = db.session.query(Tag).filter_by(name=tag_name).first();
+    if known_tags is None :
+        known_tags = load_tags([tag_name])
+    tag_placeholder = known_tags.get(tag_name)
     if (tag_placeholder is None) : # if tag does not yet exist, we add a new tag
         new_tag = Tag(name=tag_name)
         db.session.add(new_tag)
+        known_tags[tag_name] = new_tag
         club.tags.append(new_tag)
     else : # if tag exist, we only create the new relationship
         club.tags.append(tag_placeholder)
 
+# why an item of a /api/clubs/batch list of kind create, modify or delete can not be applied, or None
+def invalid_batch_item (kind, item) :
+    if kind == 'modify' :
+        if not has_required_fields(item, ['code', 'name', 'new_data']) or not isinstance(item['new_data'], dict) :
+            return "missing information"
+    elif not has_required_fields(item, ['code', 'name']) :
+        return "missing club code or name"
+    if not isinstance(item['code'], str) or not isinstance(item['name'], str) :
+        return "club code and name must be strings"
+    if kind == 'delete' :
+        return None
+    fields = item['new_data'] if kind == 'modify' else item
+    if not isinstance(fields.get('name', ""), str) :
+        return "club name must be a string"
+    if not isinstance(fields.get('description') or "", str) :
+        return "description must be a string"
+    tags = fields.get('tags', [])
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags) :
+        return "tags must be a list of strings"
+    return None
+
 # authenticate request for all post except login and signup
+# returns the logged in user as a SessionUser, or None if the session_key is missing, unknown or expired
 def authenticate_post (data) :
-    from models import User
     if 'session_key' not in data:
-        return False
-
-    session_key = data['session_key']
-    user_placeholder = db.session.query(User).filter_by(session_key=session_key).first()
-
-    return (user_placeholder is not None) and \
-           (user_placeholder.session_key is not None) and \
-           (user_placeholder.session_expiration is not None) and \
-           (datetime.datetime.now() < user_placeholder.session_expiration)
+        return None
+
+    return live_session(data['session_key'])
+
+# catches up with the commits of the other worker processes, see catalog.py
+@routes.before_app_request
+def sync_catalog_version () :
+    sync_catalog()
+
+# per route latency, sql and response size, served at /api/metrics
+@routes.before_app_request
+def start_request_metrics () :
+    metrics.request_started()
+
+@routes.after_app_request
+def record_request_metrics (response) :
+    metrics.request_finished(route_of_request(), request.method, response.status_code, response.content_length or 0)
+    return response
+
+# compresses the response in an encoding the client accepts, see content_encoding.py. Registered after the
+# metrics hook so it runs before it, and the metrics count the bytes sent
+@routes.after_app_request
+def encode_response (response) :
+    return compress_response(response, request.headers.get('Accept-Encoding'))
+
+# token buckets per client and a cap on expensive requests in flight, see ratelimit.py
+@routes.before_app_request
+def admit_request () :
+    if not rate_limiter.enabled :
+        return
+    route = route_of_request()
+    rejection, holds_slot = rate_limiter.admit(route, client_key(route))
+    if rejection is not None :
+        rate_limiter.hold(rejection)
+        return rejection.message, rejection.status, {'Retry-After': str(rejection.retry_after)}
+    g.holds_in_flight_slot = holds_slot
+
+@routes.teardown_app_request
+def release_request (error) :
+    if g.pop('holds_in_flight_slot', False) :
+        rate_limiter.release()
+
+# malformed limit or cursor query parameters on a paginated endpoint
+@routes.app_errorhandler(InvalidPage)
+def invalid_page (error) :
+    return str(error), 406
+
+# the password hashing pool is saturated, the client should retry shortly
+@routes.app_errorhandler(HashingUnavailable)
+def hashing_unavailable (error) :
+    return str(error), 503, {'Retry-After': str(HASH_RETRY_AFTER)}
 
 # check if json data has the required fields
 def has_required_fields (json, field_list) :
@@ -48,65 +152,98 @@ def has_required_fields (json, field_list) :
     return True
 
 """ APIs """
-@app.route('/')
+@routes.route('/')
 def main():
     return "Welcome to Penn Club Review!", 200
 
-@app.route('/api')
+@routes.route('/api')
 def api():
     return jsonify({"message": "Welcome to the Penn Club Review API!."}), 200
 
-@app.route('/api/clubs', methods=['GET'])
+@routes.route('/api/clubs', methods=['GET'])
+@cached_get
 def get_all_clubs():
-    from models import Club, User
-    club_names = [{'code': club.code,
-                   'name': club.name,
-                   'fav_cnt': db.session.query(User).with_parent(
-                       club, "favorites").count()} for club in Club.query.all()]
-    return jsonify(club_names), 200
-
-@app.route('/api/clubs/search', methods=['GET'])
+    limit, after = page_args(request.args)
+    return page_response(*club_summaries(catalog_snapshot.get(), after=after, limit=limit))
+
+@routes.route('/api/clubs/search', methods=['GET'])
+@cached_get
 def search_clubs_with_string():
-    from models import Club, Tag, User
+    """
+    Reasoning: the search string is matched as word prefixes against club names, descriptions and tags,
+                results are ranked by relevance (bm25) with matches in the name counting the most.
+                The ranking needs the fts index, the clubs are rendered from the catalog snapshot
+    """
     search_string = request.args.get('string')
-    # ilike is case insensitive
-    clubs_with_string = Club.query.filter(Club.name.ilike("%"+search_string+"%")).all()
-    clubs_json_ready = [{'code': club.code,
-                        'name': club.name,
-                        'description': club.description,
-                        'tags': [tag.name for tag in db.session.query(Tag).with_parent(
-                                    club, "tags")],
-                        'fav_cnt': db.session.query(User).with_parent(
-                            club, "favorites").count()} for club in clubs_with_string]
-    return jsonify(clubs_json_ready), 200
-
-@app.route('/api/clubs/favorite_users', methods=['GET'])
+    if search_string is None :
+        return "missing search string", 406
+    limit, after = page_args(request.args)
+    codes, next_cursor = search_club_codes(search_string, after=after, limit=limit)
+    return page_response(club_details_by_code(catalog_snapshot.get(), codes), next_cursor)
+
+@routes.route('/api/clubs/favorite_users', methods=['GET'])
+@cached_get
 def get_favorite_users_of_club():
     """
     Reasoning: we can use the list of users who have liked a club to create mailing list
                 or notify them collectively of announcements
     """
-    from models import Club, User
     # can get access with either club code or name
     code = request.args.get('code')
     name = request.args.get('name')
     if (code is None and name is None) :
         return "missing both club code and name", 406
+    limit, after = page_args(request.args)
 
-    club = db.session.query(Club).filter((Club.code==code) | (Club.name==name)).first()
+    # comparing only the identifiers that were given keeps the lookup on their indexes
+    club = db.session.query(Club).filter(or_(*[column == value for column, value in
+                                               ((Club.code, code), (Club.name, name)) if value is not None])).first()
     if (club is None) :
         return "club doesn't exist", 404
     else :
-        users = [{
-            'email': user.email,
-            'username': user.username,
-        }
-            for user in db.session.query(User).with_parent(
-                club, "favorites").all()
-        ]
-        return jsonify(users), 200
+        return page_response(*favorite_users(club, after=after, limit=limit))
 
-@app.route('/api/clubs/create', methods=['POST'])
+@routes.route('/api/clubs/favorite_users/export', methods=['GET'])
+def export_favorite_users():
+    """
+    Requirements: one or more club codes (code=a&code=b), and optionally format, ndjson (default) or csv
+    Reasoning: building a mailing list needs every user who favorited the clubs, not one page of them.
+                The email and username of each user are streamed to the client as they are read, in chunks,
+                so clubs of any size export in constant memory. A user who favorited several of the clubs
+                is listed once
+    """
+    codes = list(dict.fromkeys(request.args.getlist('code')))
+    if not codes :
+        return "missing club code", 406
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_MIMETYPES :
+        return "format must be one of " + ", ".join(EXPORT_MIMETYPES), 406
+    unknown = set(codes) - existing_codes(codes)
+    if unknown :
+        return "club doesn't exist: " + ", ".join(sorted(unknown)), 404
+
+    chunks = export_chunks(export_format, ('email', 'username'), favorite_users_export(codes))
+    return current_app.response_class(stream_with_context(chunks), mimetype=EXPORT_MIMETYPES[export_format],
+                              headers={'Content-Disposition': 'attachment; filename=favorite_users.' + export_format})
+
+@routes.route('/api/clubs/similar', methods=['GET'])
+@cached_get
+def get_similar_clubs():
+    """
+    Requirements: club code, and optionally limit (default and maximum 100)
+    Reasoning: "users who liked this club also liked", the clubs most often favorited by the same users,
+                relative to how popular each club is (see recommendations.py)
+    """
+    code = request.args.get('code')
+    if code is None :
+        return "missing club code", 406
+    limit, _ = page_args(request.args)
+    snapshot = catalog_snapshot.get()
+    if snapshot.club(code) is None :
+        return "club doesn't exist", 404
+    return page_response(clubs_by_code(snapshot, co_favorites.similar_clubs(code, min(limit, MAX_SIMILAR)), 'summary'), None)
+
+@routes.route('/api/clubs/create', methods=['POST'])
 def add_club():
     """
     Requirements: club code and name have to provided and cannot conflict with existing clubs
@@ -114,7 +251,6 @@ def add_club():
                 tag list should be removed of duplicates before entering database, else the club will
                 have the same tag twice
     """
-    from models import Club
 
     data = json.loads(request.get_data())
     if not authenticate_post(data) :
@@ -132,15 +268,18 @@ def add_club():
                     )
     if ('tags' in data) :
         # removing duplicate tags
-        data['tags'] = list(set(data['tags']))
+        data['tags'] = unique_tag_names(data['tags'])
+        known_tags = load_tags(data['tags'])
         for tag in data['tags'] :
-            add_tag_to_club(club_obj, tag)
+            add_tag_to_club(club_obj, tag, known_tags)
 
     db.session.add(club_obj)
+    index_clubs([club_obj.code])
+    catalog_changed(db.session, [club_obj.code])
     db.session.commit()
     return "successfully added club " + data['name'], 200
 
-@app.route('/api/clubs/modify', methods=['POST'])
+@routes.route('/api/clubs/modify', methods=['POST'])
 def modify_club():
     """
     Requirements: has to provide correct club code and name pair for security purposes
@@ -148,7 +287,6 @@ def modify_club():
     Reasoning: cannot change club code because it is the db's primary key
                 cannot modify favorites because user should have sole control
     """
-    from models import Club, Tag
     data = json.loads(request.get_data())
     if not authenticate_post(data) :
         return "permission denied", 404
@@ -184,22 +322,24 @@ def modify_club():
             target_club.description = value
         elif (key == 'tags'):
             # removing duplicate tags
-            new_data['tags'] = list(set(new_data['tags']))
+            new_data['tags'] = unique_tag_names(new_data['tags'])
+            known_tags = load_tags(new_data['tags'])
             # removes all previous tags
             target_club.tags = []
             for tag in new_data['tags']:
-                add_tag_to_club(target_club, tag)
+                add_tag_to_club(target_club, tag, known_tags)
 
+    index_clubs([code])
+    catalog_changed(db.session, [code])
     db.session.commit()
     return "successfully updated club with code: " + code, 200
 
-@app.route('/api/clubs/delete', methods=['POST'])
+@routes.route('/api/clubs/delete', methods=['POST'])
 def delete_club():
     """
     Reasoning: has to provide correct club code and name pair for security purposes
     """
     # can only delete by club code
-    from models import Club, Tag
     # turn post body into json
     data = json.loads(request.get_data())
     if not authenticate_post(data) :
@@ -215,16 +355,158 @@ def delete_club():
     if (club_placeholder is None or club_placeholder.name != name) :
         return "invalid code name pair", 406
 
+    unindex_clubs([code])
+    # unlinking the tags first keeps their club counts in sync
+    club_placeholder.tags = []
     db.session.delete(club_placeholder)
+    catalog_changed(db.session, [code])
     db.session.commit()
     return "successfully removed club", 200
 
-@app.route('/api/user', methods=['GET'])
+@routes.route('/api/clubs/batch', methods=['POST'])
+def batch_clubs():
+    """
+    Requirements: a valid session_key and any of the lists create, modify and delete, whose items have
+                    the same fields as the bodies of /api/clubs/create, /api/clubs/modify and /api/clubs/delete
+    Reasoning: syncing thousands of clubs one request at a time is slow, so the user is authenticated once,
+                every club and tag the batch refers to is loaded with a few IN queries and all changes are
+                committed in one transaction. Items are applied in order, creates then modifies then deletes,
+                and each gets its own status and message; an invalid item is skipped without affecting the others
+    """
+
+    data = json.loads(request.get_data())
+    if not authenticate_post(data) :
+        return "permission denied", 404
+
+    creates = data.get('create', [])
+    modifies = data.get('modify', [])
+    deletes = data.get('delete', [])
+    if not all(isinstance(items, list) and all(isinstance(item, dict) for item in items)
+               for items in (creates, modifies, deletes)) :
+        return "create, modify and delete must be lists of objects", 406
+
+    # items with missing fields or fields of the wrong type are answered with a 406 and not looked at further
+    problems = {kind: [invalid_batch_item(kind, item) for item in items]
+                for kind, items in (('create', creates), ('modify', modifies), ('delete', deletes))}
+    def valid (kind, items) :
+        return [item for item, problem in zip(items, problems[kind]) if problem is None]
+    creates_ok, modifies_ok, deletes_ok = valid('create', creates), valid('modify', modifies), valid('delete', deletes)
+
+    # loading every club the batch refers to by code or by name, with their tags
+    codes = set(item['code'].lower() for item in creates_ok + modifies_ok + deletes_ok)
+    names = set(item['name'] for item in creates_ok)
+    names.update(item['new_data']['name'] for item in modifies_ok if 'name' in item['new_data'])
+    clubs = {}
+    for batch in chunked(list(codes)) :
+        for club in Club.query.options(selectinload(Club.tags)).filter(Club.code.in_(batch)) :
+            clubs[club.code] = club
+    names_in_use = set(club.name for club in clubs.values())
+    for batch in chunked(list(names)) :
+        names_in_use.update(name for name, in db.session.query(Club.name).filter(Club.name.in_(batch)))
+
+    tag_names = [tag for item in creates_ok for tag in item.get('tags', [])]
+    tag_names += [tag for item in modifies_ok for tag in item['new_data'].get('tags', [])]
+    known_tags = load_tags(tag_names)
+
+    results = {'create': [], 'modify': [], 'delete': []}
+    # new clubs are indexed from their data, modified ones are reindexed from the db
+    created, reindexed, unindexed = {}, set(), set()
+    # clubs created and deleted again by this batch, which never reach the db
+    discarded = set()
+    def result (kind, item, status, message) :
+        results[kind].append({'code': item.get('code'), 'status': status, 'message': message})
+
+    for item, problem in zip(creates, problems['create']) :
+        if problem is not None :
+            result('create', item, 406, problem)
+            continue
+        code = item['code'].lower()
+        if (code in clubs) or (item['name'] in names_in_use) :
+            result('create', item, 406, "a club with the same name or code already exists")
+            continue
+        club_obj = Club(code=code, name=item['name'], description=item.get('description', ""))
+        tags = unique_tag_names(item.get('tags', []))
+        for tag in tags :
+            add_tag_to_club(club_obj, tag, known_tags)
+        db.session.add(club_obj)
+        clubs[code] = club_obj
+        names_in_use.add(club_obj.name)
+        created[code] = {'code': code, 'name': club_obj.name, 'description': club_obj.description, 'tags': tags}
+        result('create', item, 200, "successfully added club " + item['name'])
+
+    for item, problem in zip(modifies, problems['modify']) :
+        if problem is not None :
+            result('modify', item, 406, problem)
+            continue
+        target_club = clubs.get(item['code'].lower())
+        if (target_club is None) or (target_club.name != item['name']) :
+            result('modify', item, 406, "invalid code name pair")
+            continue
+        new_data = item['new_data']
+        if ('name' in new_data) and (new_data['name'] != target_club.name) and (new_data['name'] in names_in_use) :
+            result('modify', item, 406, "new name causes conflict")
+            continue
+        if 'name' in new_data :
+            names_in_use.discard(target_club.name)
+            names_in_use.add(new_data['name'])
+            target_club.name = new_data['name']
+        if 'description' in new_data :
+            target_club.description = new_data['description']
+        if 'tags' in new_data :
+            target_club.tags = []
+            for tag in unique_tag_names(new_data['tags']) :
+                add_tag_to_club(target_club, tag, known_tags)
+        if target_club.code in created :
+            created[target_club.code] = {'code': target_club.code,
+                                         'name': target_club.name,
+                                         'description': target_club.description,
+                                         'tags': [tag.name for tag in target_club.tags]}
+        else :
+            reindexed.add(target_club.code)
+        result('modify', item, 200, "successfully updated club with code: " + target_club.code)
+
+    for item, problem in zip(deletes, problems['delete']) :
+        if problem is not None :
+            result('delete', item, 406, problem)
+            continue
+        club_placeholder = clubs.get(item['code'].lower())
+        if (club_placeholder is None) or (club_placeholder.name != item['name']) :
+            result('delete', item, 406, "invalid code name pair")
+            continue
+        # unlinking the tags first keeps their club counts in sync
+        club_placeholder.tags = []
+        if club_placeholder in db.session.new :
+            # created earlier in this batch, so it never reaches the db
+            db.session.expunge(club_placeholder)
+            discarded.add(club_placeholder.code)
+        else :
+            db.session.delete(club_placeholder)
+        del clubs[club_placeholder.code]
+        names_in_use.discard(club_placeholder.name)
+        reindexed.discard(club_placeholder.code)
+        if created.pop(club_placeholder.code, None) is None :
+            unindexed.add(club_placeholder.code)
+        result('delete', item, 200, "successfully removed club")
+
+    # tags created by this batch whose clubs were all deleted again are not added either
+    for tag in list(known_tags.values()) :
+        if tag in db.session.new and not tag.club_cnt :
+            db.session.expunge(tag)
+    db.session.flush()
+    unindex_clubs(unindexed)
+    index_clubs(reindexed)
+    insert_search_rows(created.values())
+    changed = set(str(item_result['code']).lower() for kind_results in results.values()
+                  for item_result in kind_results if item_result['status'] == 200)
+    catalog_changed(db.session, changed - discarded)
+    db.session.commit()
+    return jsonify(results), 200
+
+@routes.route('/api/user', methods=['GET'])
 def get_user_with_username():
     """
     get a user by their username (note: not email)
     """
-    from models import User
     username = request.args.get('username')
     query_result = User.query.filter_by(username=username)
 
@@ -239,96 +521,159 @@ def get_user_with_username():
     }
     return jsonify(truncated_user), 200
 
-@app.route('/api/user/favoriting', methods=['POST'])
+@routes.route('/api/user/favoriting', methods=['POST'])
 def favoriting():
     """
     Requirements: the user has to be logged in and the club code has to be provided
-    Reasoning: we only need these two info pieces to favorite a club
+    Reasoning: we only need these two info pieces to favorite a club.
+                Favoriting a club twice is not an error, the second request changes nothing
     """
-    from models import User, Club
 
     data = json.loads(request.get_data())
-    if not authenticate_post(data) :
+    session_user = authenticate_post(data)
+    if not session_user :
         return "permission denied", 404
 
     # error if post body does not have the right structure (described in documentation)
     if not has_required_fields(data, ['code', 'session_key']):
         return "missing information", 406
 
-    club_placeholder = Club.query.filter_by(code=data['code']).first()
-    user_placeholder = User.query.filter_by(session_key=data['session_key']).first()
+    if not existing_codes([data['code']]) :
+        return "invalid email or club code", 406
 
-    if club_placeholder is None or user_placeholder is None:
+    # creating relationship, without loading the users who already favorited the club
+    if add_favorites(session_user.email, [data['code']]) :
+        catalog_changed(db.session, [data['code']])
+    db.session.commit()
+    return session_user.username + " successfully favorited club " + data['code'], 200
+
+@routes.route('/api/user/unfavoriting', methods=['POST'])
+def unfavoriting():
+    """
+    Requirements: the user has to be logged in and the club code has to be provided
+    Reasoning: the reverse of favoriting, unfavoriting a club that is not favorited changes nothing
+    """
+
+    data = json.loads(request.get_data())
+    session_user = authenticate_post(data)
+    if not session_user :
+        return "permission denied", 404
+
+    if not has_required_fields(data, ['code', 'session_key']):
+        return "missing information", 406
+
+    if not existing_codes([data['code']]) :
         return "invalid email or club code", 406
 
-    # creating relationship
-    if user_placeholder not in club_placeholder.favorites:
-        club_placeholder.favorites.append(user_placeholder)
-        db.session.commit()
-    return user_placeholder.username + " successfully favorited club " + data['code'], 200
+    if remove_favorite(session_user.email, data['code']) :
+        catalog_changed(db.session, [data['code']])
+    db.session.commit()
+    return session_user.username + " successfully unfavorited club " + data['code'], 200
+
+@routes.route('/api/user/favoriting/bulk', methods=['POST'])
+def bulk_favoriting():
+    """
+    Requirements: the user has to be logged in and provide codes, a list of club codes
+    Reasoning: imports a list of favorites in one request and one transaction.
+                Unknown codes are skipped and reported instead of failing the whole import,
+                codes that are already favorited are left as they are
+    """
+
+    data = json.loads(request.get_data())
+    session_user = authenticate_post(data)
+    if not session_user :
+        return "permission denied", 404
+
+    if not has_required_fields(data, ['codes', 'session_key']) or not isinstance(data['codes'], list) :
+        return "missing information", 406
+
+    # each code is favorited once, in the order given
+    codes = list(dict.fromkeys(code for code in data['codes'] if isinstance(code, str)))
+    known = existing_codes(codes)
+    added = add_favorites(session_user.email, [code for code in codes if code in known])
+    if added :
+        catalog_changed(db.session, added)
+    db.session.commit()
+    return jsonify({'favorited': added,
+                    'unknown': [code for code in codes if code not in known]}), 200
 
-@app.route('/api/user/favorite_clubs', methods=['GET'])
+@routes.route('/api/user/favorite_clubs', methods=['GET'])
+@cached_get
 def get_user_favorite_clubs():
     """
     get all the clubs a user has favorited
     """
-    from models import User, Club, Tag
 
     # can get access with either username or email
     username = request.args.get('username')
     email = request.args.get('email')
     if (username is None and email is None) :
         return "missing both username and email", 406
+    limit, after = page_args(request.args)
 
-    user = db.session.query(User).filter((User.email==email) | (User.username==username)).first()
+    # comparing only the identifiers that were given keeps the lookup on their indexes
+    user = db.session.query(User).filter(or_(*[column == value for column, value in
+                                               ((User.email, email), (User.username, username)) if value is not None])).first()
     if (user is None) :
         return "user doesn't exist", 404
     else :
-        clubs = [{
-            'code': club.code,
-            'name': club.name,
-            'description': club.description,
-            'tags': [tag.name for tag in db.session.query(Tag).with_parent(
-                club, "tags")]
-            }
-            for club in db.session.query(Club).with_parent(
-                        user, "favorites").all()
-        ]
-        return jsonify(clubs), 200
-
-@app.route('/api/user/login', methods=['POST'])
+        return page_response(*user_favorite_club_details(user, after=after, limit=limit))
+
+@routes.route('/api/user/recommendations', methods=['GET'])
+@cached_get
+def get_user_recommendations():
+    """
+    Requirements: username or email, and optionally limit (default and maximum 100)
+    Reasoning: the clubs most similar to everything the user favorited, leaving out the clubs
+                they already favorited
+    """
+
+    username = request.args.get('username')
+    email = request.args.get('email')
+    if (username is None and email is None) :
+        return "missing both username and email", 406
+    limit, _ = page_args(request.args)
+
+    user = db.session.query(User).filter(or_(*[column == value for column, value in
+                                               ((User.email, email), (User.username, username)) if value is not None])).first()
+    if (user is None) :
+        return "user doesn't exist", 404
+    codes = co_favorites.recommended_clubs(user_favorite_codes(user.email), min(limit, MAX_SIMILAR))
+    return page_response(clubs_by_code(catalog_snapshot.get(), codes, 'summary'), None)
+
+@routes.route('/api/user/login', methods=['POST'])
 def login():
     """
     Requirements: email and password
     Reasoning: the server will take care of hashing the password
                 and providing a login session_key
     """
-    from models import User
     data = json.loads(request.get_data())
 
     if not has_required_fields(data, ['email', 'password']):
         return "missing email or password", 406
 
     email = data['email']
-    password = data['password'].encode('utf-8')
+    password = data['password']
     user_placeholder = db.session.query(User).filter_by(email=email).first()
     if (user_placeholder is None) :
         return "a user with that email does not exist", 406
 
-    if bcrypt.checkpw(password, user_placeholder.password_hash):
-        # if successful, we return with a session key, which expires in 24 hours
-        user_placeholder.session_key = ''.join(random.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefjhiklmnopqrstuvwxyz')
-                                               for i in range(30))
-        user_placeholder.session_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
+    if password_hasher.verify(password, user_placeholder.password_hash):
+        # the hash was made with a different cost factor than the current one
+        if password_hasher.needs_rehash(user_placeholder.password_hash) :
+            user_placeholder.password_hash = password_hasher.hash(password)
+        # a new session on top of the ones the user has on other devices
+        session_key = start_session(user_placeholder.email)
         db.session.commit()
         key_data = {
-            'session_key': user_placeholder.session_key
+            'session_key': session_key
         }
         return jsonify(key_data), 200
     else :
         return "password does not match", 404
 
-@app.route('/api/user/signup', methods=['POST'])
+@routes.route('/api/user/signup', methods=['POST'])
 def signup():
     """
     Requirements: email and username must not conflict with existing users
@@ -336,7 +681,6 @@ def signup():
     Reasoning: these three fields are required to create a new row in the db
                 email for primary key, username for display purposes, and password for future logins
     """
-    from models import User
     data = json.loads(request.get_data())
     if not has_required_fields(data, ['email', 'password', 'username']):
         return "missing email, password, or username", 406
@@ -352,13 +696,9 @@ def signup():
         return "a user with that email or username already exist", 406
 
     new_user = User(email=email, username=username, pw_plain=password)
-    session_key = ''.join(random.choice('0123456789ABCDEFGHIJKLMNOPabcdefjhiklmnop')
-                          for i in range(30))
-    # session_key expires in 24 hours
-    session_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
-    new_user.session_key = session_key
-    new_user.session_expiration = session_expiration
     db.session.add(new_user)
+    # session_key expires in 24 hours
+    session_key = start_session(email)
     db.session.commit()
 
     key_data = {
@@ -366,62 +706,182 @@ def signup():
     }
     return jsonify(key_data), 200
 
-@app.route('/api/user/logout', methods=['POST'])
+@routes.route('/api/user/logout', methods=['POST'])
 def logout():
     """
     Requirements: only a valid session_key is required
     Reasoning: the session_key is used to make sure the user is truly logged in
                 we only need that to identify the user
+                only the session of that key ends, the user's other devices stay logged in
     """
-    from models import User
     data = json.loads(request.get_data())
-    if not authenticate_post(data) :
+    session_user = authenticate_post(data)
+    if not session_user :
         return "permission denied", 404
 
-    session_key = data['session_key']
-    user_placeholder = db.session.query(User).filter_by(session_key=session_key).first()
-    user_placeholder.session_key = None
-    user_placeholder.session_expiration = None
+    end_session(data['session_key'])
     db.session.commit()
     return "succesfully logged out", 200
 
-@app.route('/api/tag', methods=['GET'])
+@routes.route('/api/tag', methods=['GET'])
+@cached_get
 def get_all_tags_and_count():
     """
     Reasoning: returns tags count only to reduce response size
                 to get the clubs that have a certain tag, use /api/tag/search
     """
-    from models import Tag, Club
-    tags_and_cnt = [{'name': tag.name,
-                    'cnt': db.session.query(Club).with_parent(
-                            tag, "clubs").count()
-                   } for tag in Tag.query.all()]
-    return jsonify(tags_and_cnt), 200
+    limit, after = page_args(request.args)
+    return page_response(*tags_with_club_cnt(catalog_snapshot.get(), after=after, limit=limit))
 
-@app.route('/api/tag/search', methods=['GET'])
+@routes.route('/api/tag/search', methods=['GET'])
+@cached_get
 def tag_search():
     """
     returns all the clubs that are associated with a tag
     """
-    from models import Tag, Club
-    from models import Club, Tag, User
     tag_name = request.args.get('tag')
     if tag_name is None :
         return "tag is null", 404
+    limit, after = page_args(request.args)
     tag_name = tag_name.lower()
-    tag_with_name = db.session.query(Tag).filter_by(name=tag_name).first()
+    clubs, next_cursor = tag_club_summaries(catalog_snapshot.get(), tag_name, after=after, limit=limit)
 
-    if (tag_with_name is None) :
+    if (clubs is None) :
         return "tag does not exist", 406
 
-    tag_json_ready = {'name': tag_name,
-                      'clubs': [{
-                          'code': club.code,
-                          'name': club.name
-                      } for club in db.session.query(Club).with_parent(
-                          tag_with_name, "clubs").all()]
-                    }
-    return jsonify(tag_json_ready), 200
+    # {"clubs": [...], "name": ...}, around the club fragments
+    tag_json_ready = b'{"clubs":' + clubs + b',"name":' + encode(tag_name) + b'}'
+    return page_response(tag_json_ready, next_cursor)
+
+@routes.route('/api/tag/query', methods=['GET'])
+@cached_get
+def tag_query():
+    """
+    Requirements: q, tag names combined with AND, OR, NOT and parentheses,
+                    e.g. "Undergraduate AND Athletics NOT Pre-Professional"
+    Reasoning: filtering by several tags used to take one /api/tag/search per tag and an intersection on the
+                client. The expression is evaluated on the in-memory tag index (tag_index.py), which also counts
+                the matching clubs per tag (facets) so a client can show how each tag would narrow the results
+    """
+    expression = request.args.get('q')
+    if expression is None :
+        return "missing tag query", 406
+    limit, after = page_args(request.args)
+    try :
+        codes, next_cursor, count, facets = tag_index.query(expression, after=after, limit=limit)
+    except InvalidTagQuery as error :
+        return str(error), 406
+    # {"clubs": [...], "count": ..., "facets": {...}}, around the club fragments
+    body = b'{"clubs":' + clubs_by_code(catalog_snapshot.get(), codes, 'brief') + b',"count":' + encode(count) \
+           + b',"facets":' + encode(facets) + b'}'
+    return page_response(body, next_cursor)
+
+@routes.route('/api/changes', methods=['GET'])
+@cached_get
+def get_changes():
+    """
+    Requirements: since, the seq of the last changes the client applied, and optionally limit
+    Reasoning: clients keeping a copy of /api/clubs and /api/tag used to fetch them again to notice any change.
+                This returns the clubs and tags changed after since, in the same shapes, the codes of the
+                deleted clubs and the seq to poll from next (see changes.py). Without since, or once since is
+                too old, "reset" is true: the client fetches the lists again and polls from the seq returned
+    """
+    since = request.args.get('since')
+    limit, _ = page_args(request.args)
+    if since is not None :
+        try :
+            since = int(since)
+        except ValueError :
+            return "since must be an integer", 406
+    return page_response(changes_since(since, limit), None)
+
+@routes.route('/api/stats', methods=['GET'])
+def stats():
+    """
+    hit/miss counters of the in-process caches, for monitoring
+    """
+    return jsonify({'session_cache': session_cache.stats(),
+                    'session_sweeper': session_sweeper.stats(),
+                    'change_log_compactor': change_log_compactor.stats(),
+                    'rate_limiter': rate_limiter.stats(),
+                    'password_hasher': password_hasher.stats(),
+                    'response_cache': response_cache.stats(),
+                    'compression': compressor.stats(),
+                    'fragment_cache': fragment_cache.stats(),
+                    'tag_index': tag_index.stats(),
+                    'catalog_snapshot': catalog_snapshot.stats(),
+                    'recommendations': co_favorites.stats()}), 200
+
+@routes.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """
+    per route request metrics in the Prometheus text format, for scraping
+    """
+    return metrics.prometheus(), 200, {'Content-Type': PROMETHEUS_MIMETYPE}
+
+def create_app (config=None) :
+    """
+    an app serving the routes with db bound to it, config overrides the default settings
+    """
+    flask_app = Flask(__name__)
+    flask_app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_FILE}"
+    # pool sizes and connection settings come from engine.py, see there for the environment variables
+    flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options()
+    flask_app.config.update(config or {})
+    # times every json serialization, see metrics.py
+    flask_app.json = TimedJSONProvider(flask_app)
+    db.init_app(flask_app)
+    flask_app.register_blueprint(routes)
+    # the mappers are compiled now rather than by the first query of the first request
+    configure_mappers()
+    return flask_app
+
+# GET requests rendered by warm_up, comma separated
+WARM_UP_PATHS = [path for path in os.environ.get('WARM_UP_PATHS', '/api/clubs,/api/tag').split(',') if path]
+# the co-favorite matrix takes seconds to build at scale, so by default it is built by the first request needing it
+WARM_UP_RECOMMENDATIONS = os.environ.get('WARM_UP_RECOMMENDATIONS', '0') != '0'
+
+def warm_up (flask_app, connections=True, caches=True) :
+    """
+    readies the process to serve flask_app before it takes traffic: opens every pooled connection (write and
+    read pools) and fills the caches (catalog snapshot, tag index, rendered WARM_UP_PATHS, optionally the
+    co-favorite matrix).
+    returns the seconds each step took
+    """
+    timings = {}
+    with flask_app.app_context() :
+        if connections :
+            start = time.perf_counter()
+            for engine in set([db.engine, read_engine(db.engine)]) :
+                # held at once, so the pool opens as many connections as it keeps
+                opened = [engine.connect() for _ in range(engine.pool.size())]
+                for connection in opened :
+                    connection.execute(text("SELECT 1"))
+                    connection.close()
+            timings['connections'] = time.perf_counter() - start
+        if caches :
+            start = time.perf_counter()
+            # the caches hold what the log says up to here, later commits of other processes are read from it
+            change_reader.start()
+            catalog_snapshot.refresh()
+            tag_index.refresh()
+            if WARM_UP_RECOMMENDATIONS :
+                co_favorites.refresh()
+            db.session.remove()
+            client = flask_app.test_client()
+            for path in WARM_UP_PATHS :
+                client.get(path)
+            # the warm-up requests are not traffic
+            metrics.reset()
+            rate_limiter.clear()
+            timings['caches'] = time.perf_counter() - start
+    return timings
+
+app = create_app()
+# db is used outside of any app context by the scripts and the tests, with the default app
+db.app = app
 
 if __name__ == '__main__':
+    session_sweeper.start(app)
+    change_log_compactor.start(app)
     app.run()
@@ -0,0 +1,232 @@
+import asyncio
+import io
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_date, parse_etags
+from werkzeug.routing import RequestRedirect
+
+from app import app
+from catalog import catalog_version
+from content_encoding import compressor, encoded_headers
+from metrics import metrics
+from ratelimit import address_key, rate_limiter
+from response_cache import cached_response
+
+""" ASGI serving mode
+    Serves the routes of app.py, with the same responses, from an event loop. Connections are handled
+    on the loop, so slow or idle clients do not hold a thread; a GET to a cached endpoint whose answer is
+    a 304 or a cached body (see response_cache.py) is answered right there, without a thread or a query.
+    That path does what the flask hooks of app.py would: it is admitted by the rate limiter (a refusal is
+    held on the loop, not on a thread) and counted in the metrics.
+    Any other request runs the flask view on a bounded pool of worker threads, which is also where its
+    sqlite queries run (sqlite has no asynchronous interface, async drivers run each connection on a
+    thread too), while bcrypt keeps running on its own pool from hashing.py.
+    Response bodies are passed from the worker to the loop chunk by chunk through a small queue, so a
+    streamed response (an export) is sent as it is produced and the worker waits while the client is slow.
+    Usage: python asgi.py [host] [port], or any asgi server with asgi:application
+"""
+ASGI_WORKERS = int(os.environ.get('ASGI_WORKERS', 32))
+# chunks of a response body a worker may produce ahead of the client
+STREAM_QUEUE_CHUNKS = 8
+
+class AsgiAdapter :
+    def __init__ (self, flask_app, workers=ASGI_WORKERS) :
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='asgi')
+        self.url_adapter = flask_app.url_map.bind('localhost')
+
+    async def __call__ (self, scope, receive, send) :
+        if scope['type'] == 'lifespan' :
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http' :
+            raise ValueError("unsupported asgi scope type %s" % scope['type'])
+
+        body = []
+        while True :
+            message = await receive()
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False) :
+                break
+
+        response = self.answer_from_cache(scope)
+        if response is not None :
+            status, headers, body, delay = response
+            if delay :
+                await asyncio.sleep(delay)
+            await self.send_start(send, status, headers)
+            await send({'type': 'http.response.body', 'body': body})
+            return
+
+        loop = asyncio.get_event_loop()
+        chunks = asyncio.Queue(maxsize=STREAM_QUEUE_CHUNKS)
+        abandoned = threading.Event()
+        worker = loop.run_in_executor(self.executor, self.call_wsgi, scope, b''.join(body), loop, chunks, abandoned)
+        try :
+            start = await chunks.get()
+            if start is None :
+                # the app raised before it started the response, await raises its exception
+                await worker
+            status, headers = start
+            await self.send_start(send, status, headers)
+            while True :
+                chunk = await chunks.get()
+                if chunk is None :
+                    break
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+        finally :
+            # the client went away: let the worker stop at its next chunk instead of waiting on a full queue
+            abandoned.set()
+            while not chunks.empty() :
+                chunks.get_nowait()
+        await worker
+
+    async def send_start (self, send, status, headers) :
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+
+    async def lifespan (self, receive, send) :
+        while True :
+            message = await receive()
+            if message['type'] == 'lifespan.startup' :
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown' :
+                self.executor.shutdown(wait=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def answer_from_cache (self, scope) :
+        """
+        (status, headers, body, seconds to hold it) of a GET to a cached_get view that needs neither the view
+        nor the db, or None. The request is admitted and counted as the flask hooks would
+        """
+        if scope['method'] != 'GET' :
+            return None
+        # catching up with the commits of other processes reads the change log, which the worker thread
+        # does in the flask app's before_request hook
+        if catalog_version.behind() :
+            return None
+        try :
+            rule, _ = self.url_adapter.match(scope['path'], method='GET', return_rule=True)
+        except (HTTPException, RequestRedirect) :
+            return None
+        if not getattr(self.flask_app.view_functions[rule.endpoint], 'cached_get', False) :
+            return None
+
+        metrics.request_started()
+        request_headers = dict((name.decode('latin-1'), value.decode('latin-1')) for name, value in scope['headers'])
+        if_none_match = request_headers.get('if-none-match')
+        if_modified_since = request_headers.get('if-modified-since')
+        cached = cached_response(scope['path'], scope['query_string'],
+                                 parse_etags(if_none_match) if if_none_match else None,
+                                 parse_date(if_modified_since) if if_modified_since else None,
+                                 request_headers.get('accept-encoding'))
+        if cached is None :
+            # the worker thread runs the request through the flask hooks
+            metrics.request_abandoned()
+            return None
+
+        # a GET is always limited by address, see ratelimit.client_key
+        rejection, holds_slot = rate_limiter.admit(rule.rule, address_key((scope.get('client') or ('',))[0]))
+        if holds_slot :
+            # the answer is ready, the slot is not held while it is sent
+            rate_limiter.release()
+        delay = 0
+        if rejection is not None :
+            status, mimetype = rejection.status, 'text/html; charset=utf-8'
+            headers, body = {'Retry-After': str(rejection.retry_after)}, rejection.message.encode('utf-8')
+            if compressor.encodings :
+                # as compress_response marks it on the flask path
+                encoded_headers(headers, None)
+            delay = rate_limiter.tarpit_delay(rejection)
+        else :
+            status, headers, body, mimetype = cached
+        # recorded before the tarpit: other requests use the loop thread's metrics while this one sleeps
+        metrics.request_finished(rule.rule, 'GET', status, len(body))
+        headers = list(headers.items())
+        if mimetype is not None :
+            headers.append(('Content-Type', mimetype))
+        headers.append(('Content-Length', str(len(body))))
+        return status, headers, body, delay
+
+    def call_wsgi (self, scope, body, loop, chunks, abandoned) :
+        """
+        runs the wsgi app on a worker thread, putting (status, headers) then each chunk of the body
+        and finally None in the chunks queue of the loop
+        """
+        def put (item) :
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        server = scope.get('server') or ('localhost', 80)
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1])
+        if scope.get('client') :
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers'] :
+            name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+            if name == 'CONTENT_TYPE' :
+                environ[name] = value
+            elif name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING') :
+                # the body has already been read in full
+                continue
+            elif 'HTTP_' + name in environ :
+                environ['HTTP_' + name] += ',' + value
+            else :
+                environ['HTTP_' + name] = value
+
+        started = []
+        def start_response (status, headers, exc_info=None) :
+            started[:] = [int(status.split(' ', 1)[0]), headers]
+        result = None
+        # the status and headers go out with the first chunk, wsgi apps may call start_response until then
+        sent_start = False
+        try :
+            # an app that raises (with PROPAGATE_EXCEPTIONS) still ends the queue, the loop then re-raises
+            result = self.flask_app(environ, start_response)
+            for chunk in result :
+                if not sent_start :
+                    put(tuple(started))
+                    sent_start = True
+                if abandoned.is_set() :
+                    return
+                if chunk :
+                    put(chunk)
+            # an empty body has no chunk
+            if not sent_start :
+                put(tuple(started))
+        finally :
+            if result is not None and hasattr(result, 'close') :
+                result.close()
+            if not abandoned.is_set() :
+                put(None)
+
+application = AsgiAdapter(app)
+
+if __name__ == '__main__':
+    import uvicorn
+    from sessions import session_sweeper
+    from changes import change_log_compactor
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    session_sweeper.start(app)
+    change_log_compactor.start(app)
+    uvicorn.run(application, host=host, port=port, log_level='warning')
@@ -0,0 +1,3 @@
+""" Benchmarks for the club review API. Run each one from the repository root as a module,
+    e.g. `pipenv run python -m benchmarks.fts_search`
+"""
@@ -0,0 +1,59 @@
+import argparse
+import os
+import time
+
+from app import app
+from benchmarks.concurrent_reads import percentile
+from content_encoding import compressor
+from ratelimit import rate_limiter
+
+""" Size and cost of compressed responses
+    On a database made by benchmarks.synthetic: for a page of 1000 clubs of /api/clubs, /api/clubs/search and
+    /api/clubs/favorite_users, the body's size uncompressed and in each encoding available, the time to
+    compress it, and the latency of serving it from the response cache uncompressed and compressed (the
+    compressed body is cached with the entry by the first request, so only that one pays for compressing).
+    Usage: python -m benchmarks.compression bench.db [--requests 500] [--search anime] [--code club-0]
+"""
+
+def latencies (client, path, headers, requests) :
+    times = []
+    for _ in range(requests) :
+        start = time.perf_counter()
+        client.get(path, headers=headers)
+        times.append((time.perf_counter() - start) * 1000)
+    return percentile(times, 50), percentile(times, 99)
+
+def main () :
+    parser = argparse.ArgumentParser(description="compressed response sizes and latency")
+    parser.add_argument('path', help="database made by benchmarks.synthetic")
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--search', default='anime', help="search string")
+    parser.add_argument('--code', default='club-0', help="club whose favorite users are listed")
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(args.path)
+    # one client sends every request
+    rate_limiter.enabled = False
+    client = app.test_client()
+    paths = ['/api/clubs?limit=1000',
+             '/api/clubs/search?string=%s&limit=1000' % args.search,
+             '/api/clubs/favorite_users?code=%s&limit=1000' % args.code]
+    print("levels %s, encodings %s" % (compressor.levels, ', '.join(compressor.encodings)))
+    for path in paths :
+        body = client.get(path).data
+        print(path)
+        print("    %-10s %10d bytes" % ('identity', len(body)))
+        for encoding in compressor.encodings :
+            start = time.perf_counter()
+            compressed = compressor.compress(body, encoding)
+            took = time.perf_counter() - start
+            print("    %-10s %10d bytes (%4.1f%%), compressed in %.2f ms"
+                  % (encoding, len(compressed), 100.0 * len(compressed) / len(body), took * 1000))
+        print("    %-28s %10s %10s" % ('cached response', 'p50 ms', 'p99 ms'))
+        for encoding in ['identity'] + compressor.encodings :
+            headers = {'Accept-Encoding': encoding}
+            client.get(path, headers=headers)
+            print("    %-28s %10.3f %10.3f" % ((encoding,) + latencies(client, path, headers, args.requests)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from pagination import encode_cursor
+
+""" Read throughput while writes are happening, with the old sqlite settings and with the engine profile
+    of engine.py. Each profile runs in its own process, since the settings are read from the environment
+    when the app is imported. A threaded server gets reader clients paging through /api/clubs and writer
+    clients toggling favorites as fast as they can; the response cache is disabled so every read hits sqlite,
+    and the rate limiter too, since every client comes from the same address.
+    Usage: python -m benchmarks.concurrent_reads [--clubs 5000] [--readers 8] [--writers 2] [--seconds 5]
+"""
+PROFILES = [
+    ('rollback journal', {'SQLITE_JOURNAL_MODE': 'delete', 'SQLITE_SYNCHRONOUS': 'full',
+                          'SQLITE_CACHE_SIZE': '-2000', 'SQLITE_MMAP_SIZE': '0', 'SQLITE_READ_POOL_SIZE': '0'}),
+    ('wal + read pool', {}),
+]
+
+# p-th percentile of a list of samples
+def percentile (samples, p) :
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else 0.0
+
+def request (url, body=None) :
+    try :
+        return urllib.request.urlopen(url, data=body).status
+    except urllib.error.HTTPError as error :
+        return error.code
+
+def reader (base_url, codes, stop, latencies, statuses) :
+    rng = random.Random()
+    while not stop.is_set() :
+        cursor = ''
+        if rng.random() < 0.9 :
+            cursor = '&cursor=' + encode_cursor(rng.choice(codes))
+        start = time.perf_counter()
+        status = request(base_url + '/api/clubs?limit=50' + cursor)
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+
+def writer (base_url, codes, session_key, stop, statuses) :
+    rng = random.Random()
+    while not stop.is_set() :
+        endpoint = rng.choice(['/api/user/favoriting', '/api/user/unfavoriting'])
+        body = json.dumps({'session_key': session_key, 'code': rng.choice(codes)}).encode('utf-8')
+        status = request(base_url + endpoint, body)
+        statuses[status] = statuses.get(status, 0) + 1
+
+def run_profile (args) :
+    """
+    runs in the child process, prints the measurements as json
+    """
+    from werkzeug.serving import make_server
+    from app import app, db
+    from importer import import_batch
+    import bootstrap
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
+    db.create_all()
+    bootstrap.create_user()
+    codes = ['club-%d' % i for i in range(args.clubs)]
+    import_batch([{'code': code, 'name': 'Club %s' % code, 'description': 'a club', 'tags': ['bench']}
+                  for code in codes])
+    db.session.commit()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    stop, latencies, read_statuses, write_statuses = threading.Event(), [], {}, {}
+    clients = [threading.Thread(target=reader, args=(base_url, codes, stop, latencies, read_statuses))
+               for _ in range(args.readers)]
+    clients += [threading.Thread(target=writer, args=(base_url, codes, bootstrap.session_key, stop, write_statuses))
+                for _ in range(args.writers)]
+    for client in clients :
+        client.start()
+    time.sleep(args.seconds)
+    stop.set()
+    for client in clients :
+        client.join()
+    server.shutdown()
+
+    print(json.dumps({'reads_per_second': len(latencies) / args.seconds,
+                      'writes_per_second': sum(write_statuses.values()) / args.seconds,
+                      'read_p50_ms': percentile(latencies, 50),
+                      'read_p99_ms': percentile(latencies, 99),
+                      'read_statuses': read_statuses,
+                      'write_statuses': write_statuses}))
+
+def main () :
+    parser = argparse.ArgumentParser(description="read throughput under concurrent writes per sqlite profile")
+    parser.add_argument('--clubs', type=int, default=5000)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child :
+        run_profile(args)
+        return
+
+    print("%-18s %10s %10s %10s %10s  %s" % ('profile', 'reads/s', 'writes/s', 'p50 ms', 'p99 ms', 'statuses'))
+    for name, environment in PROFILES :
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.concurrent_reads', '--child'] + sys.argv[1:],
+                                env=dict(os.environ, RESPONSE_CACHE_BYTES='0', RATE_LIMIT_ENABLED='0', **environment),
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print("%-18s %10.0f %10.0f %10.2f %10.2f  reads %s writes %s" % (
+            name, result['reads_per_second'], result['writes_per_second'], result['read_p50_ms'],
+            result['read_p99_ms'], result['read_statuses'], result['write_statuses']))
+
+if __name__ == '__main__':
+    main()
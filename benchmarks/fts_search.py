@@ -0,0 +1,91 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from app import app, db
+from models import Club, Tag, clubs2tags
+from search import rebuild_search_index, search_club_codes
+from serializers import club_details_by_code
+from snapshot import catalog_snapshot
+
+""" Compares the old `Club.name ilike '%string%'` search with the fts5 index at scale.
+    Usage: python -m benchmarks.fts_search [--clubs 100000] [--repeat 20]
+"""
+WORDS = ['penn', 'juggling', 'labs', 'society', 'club', 'association', 'debate', 'robotics', 'chess',
+         'theatre', 'dance', 'music', 'finance', 'consulting', 'coding', 'startup', 'literary', 'film',
+         'photography', 'hiking', 'sailing', 'cooking', 'volunteer', 'medical', 'law', 'engineering',
+         'wharton', 'quaker', 'philly', 'outdoors', 'gaming', 'anime', 'poetry', 'choir', 'jazz']
+TAGS = ['undergraduate', 'graduate', 'athletics', 'literary', 'technology', 'academic', 'pre-professional',
+        'arts', 'cultural', 'service']
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'ti', 'vo', 'ze', 'qua', 'bri', 'dol', 'fen', 'gor', 'hul']
+QUERIES = ['penn', 'robot', 'jazz choir', 'philly outdoors', 'consult', 'kalomi', 'zequahul']
+
+# description vocabulary: made up words whose frequencies follow a zipf distribution
+def vocabulary (rng, size=5000) :
+    words = sorted(set(''.join(rng.choice(SYLLABLES) for _ in range(3)) for _ in range(size * 2)))[:size]
+    rng.shuffle(words)
+    return words, [1.0 / rank for rank in range(1, len(words) + 1)]
+
+def generate (n_clubs, seed=0) :
+    rng = random.Random(seed)
+    vocab, weights = vocabulary(rng)
+    db.session.execute(Tag.__table__.insert(), [{'name': tag, 'club_cnt': 0} for tag in TAGS])
+    clubs, links = [], []
+    for i in range(n_clubs) :
+        code = 'club-%d' % i
+        clubs.append({'code': code,
+                      'name': ' '.join(rng.choice(WORDS) for _ in range(3)).title() + ' %d' % i,
+                      'description': ' '.join(rng.choices(vocab, weights, k=25)),
+                      'fav_cnt': 0})
+        links += [{'club_id': code, 'tag_id': tag} for tag in rng.sample(TAGS, 2)]
+    db.session.execute(Club.__table__.insert(), clubs)
+    db.session.execute(clubs2tags.insert(), links)
+    start = time.perf_counter()
+    rebuild_search_index()
+    db.session.commit()
+    return time.perf_counter() - start
+
+# best and mean wall time of fn over repeat runs, in milliseconds
+def timed (fn, repeat) :
+    times = []
+    for _ in range(repeat) :
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), sum(times) / len(times)
+
+def ilike_search (string, limit) :
+    # the previous implementation of /api/clubs/search, restricted to the same page size
+    rows = db.session.query(Club.code).filter(Club.name.ilike("%" + string + "%")) \
+                     .order_by(Club.code).limit(limit).all()
+    return club_details_by_code(catalog_snapshot.get(), [row.code for row in rows])
+
+def fts_search (string, limit) :
+    codes, _ = search_club_codes(string, limit=limit)
+    return club_details_by_code(catalog_snapshot.get(), codes)
+
+def main () :
+    parser = argparse.ArgumentParser(description="compare ilike and fts5 club search")
+    parser.add_argument('--clubs', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--limit', type=int, default=100)
+    args = parser.parse_args()
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
+    db.create_all()
+    print("Generating %d clubs..." % args.clubs)
+    index_seconds = generate(args.clubs)
+    print("Built the search index in %.2fs" % index_seconds)
+
+    print("%-18s %22s %22s" % ('query', 'ilike best/mean ms', 'fts5 best/mean ms'))
+    for string in QUERIES :
+        ilike = timed(lambda: ilike_search(string, args.limit), args.repeat)
+        fts = timed(lambda: fts_search(string, args.limit), args.repeat)
+        print("%-18s %10.2f / %9.2f %10.2f / %9.2f" % ((string,) + ilike + fts))
+    os.remove(db_file)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.fts_search import WORDS
+from benchmarks.synthetic import (PASSWORD, club_code, user_email, username, tag_name, session_key,
+                                  zipf_cum_weights)
+from pagination import encode_cursor
+
+""" Load driver
+    Replays a weighted mix of requests covering every route, from a number of concurrent clients,
+    against the flask test client on a database file or against a live server, and reports throughput
+    and p50/p95/p99 latency per operation as json, so runs can be stored and compared.
+    The data is expected to come from benchmarks.synthetic, whose sizes are passed with the same flags.
+    Every client comes from the same address, so the rate limiter is disabled on the test client, and a
+    live server should run with RATE_LIMIT_ENABLED=0 (unless the limiter is what is measured).
+    Usage:
+        python -m benchmarks.load --db bench.db [--mix read-heavy] [--seconds 30] [--concurrency 8] [--output run.json]
+        python -m benchmarks.load --url http://127.0.0.1:5000 [...]
+        python -m benchmarks.load --compare before.json after.json
+"""
+# relative weight of every operation in each mix, operations left out are never sent
+MIXES = {
+    'read-heavy': {'root': 1, 'clubs': 20, 'clubs_search': 10, 'favorite_users': 5, 'user': 5,
+                   'favorite_clubs': 5, 'tags': 10, 'tag_search': 10, 'favoriting': 6, 'unfavoriting': 3,
+                   'favoriting_bulk': 1, 'club_create': 1, 'club_modify': 1, 'club_delete': 1, 'clubs_batch': 0.5,
+                   'login': 0.5, 'signup': 0.2, 'logout': 0.2},
+    'write-heavy': {'clubs': 10, 'clubs_search': 5, 'tags': 5, 'tag_search': 5, 'favoriting': 20,
+                    'unfavoriting': 10, 'favoriting_bulk': 3, 'club_create': 5, 'club_modify': 5, 'club_delete': 3,
+                    'clubs_batch': 2, 'login': 1, 'signup': 1, 'logout': 1},
+}
+BULK_SIZE = 20
+
+class Workload :
+    """
+    builds the requests of each operation, drawing clubs, users and tags with the same
+    zipf distributions as the generator, so popular rows get most of the traffic
+    """
+    def __init__ (self, clubs, users, tags, sessions, exponent) :
+        self.clubs, self.users, self.tags, self.sessions = clubs, users, tags, sessions
+        self.club_weights = zipf_cum_weights(clubs, exponent)
+        self.user_weights = zipf_cum_weights(users, exponent)
+        self.tag_weights = zipf_cum_weights(tags, exponent)
+        # clubs created by the driver, which it may modify and delete
+        self.created = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def club (self, rng) :
+        return club_code(rng.choices(range(self.clubs), cum_weights=self.club_weights)[0])
+
+    def user (self, rng) :
+        return rng.choices(range(self.users), cum_weights=self.user_weights)[0]
+
+    def new_code (self) :
+        return 'load-%d-%d' % (os.getpid(), next(self.counter))
+
+    def requests (self, name, rng) :
+        """
+        list of (method, path, json body) to send for one operation, the last one is the one timed
+        """
+        key = session_key(rng.randrange(self.sessions))
+        if name == 'root' :
+            return [('GET', '/api', None)]
+        if name == 'clubs' :
+            cursor = '' if rng.random() < 0.2 else '&cursor=' + encode_cursor(club_code(rng.randrange(self.clubs)))
+            return [('GET', '/api/clubs?limit=100' + cursor, None)]
+        if name == 'clubs_search' :
+            return [('GET', '/api/clubs/search?limit=20&string=' + rng.choice(WORDS), None)]
+        if name == 'favorite_users' :
+            return [('GET', '/api/clubs/favorite_users?limit=100&code=' + self.club(rng), None)]
+        if name == 'user' :
+            return [('GET', '/api/user?username=' + username(self.user(rng)), None)]
+        if name == 'favorite_clubs' :
+            return [('GET', '/api/user/favorite_clubs?limit=100&username=' + username(self.user(rng)), None)]
+        if name == 'tags' :
+            return [('GET', '/api/tag', None)]
+        if name == 'tag_search' :
+            tag = tag_name(rng.choices(range(self.tags), cum_weights=self.tag_weights)[0])
+            return [('GET', '/api/tag/search?limit=100&tag=' + tag, None)]
+        if name in ('favoriting', 'unfavoriting') :
+            return [('POST', '/api/user/' + name, {'session_key': key, 'code': self.club(rng)})]
+        if name == 'favoriting_bulk' :
+            codes = [self.club(rng) for _ in range(BULK_SIZE)]
+            return [('POST', '/api/user/favoriting/bulk', {'session_key': key, 'codes': codes})]
+        if name in ('club_modify', 'club_delete') :
+            with self.lock :
+                picked = rng.choice(self.created) if self.created else None
+                if picked is not None and name == 'club_delete' :
+                    self.created.remove(picked)
+            if picked is not None :
+                code, club_name = picked
+                if name == 'club_modify' :
+                    new_data = {'name': club_name, 'description': ' '.join(rng.sample(WORDS, 5)),
+                                'tags': [tag_name(rng.randrange(self.tags))]}
+                    return [('POST', '/api/clubs/modify',
+                             {'session_key': key, 'code': code, 'name': club_name, 'new_data': new_data})]
+                return [('POST', '/api/clubs/delete', {'session_key': key, 'code': code, 'name': club_name})]
+            name = 'club_create'
+        if name == 'club_create' :
+            code = self.new_code()
+            with self.lock :
+                self.created.append((code, 'Load ' + code))
+            return [('POST', '/api/clubs/create', {'session_key': key, 'code': code, 'name': 'Load ' + code,
+                                                    'description': ' '.join(rng.sample(WORDS, 5)),
+                                                    'tags': [tag_name(rng.randrange(self.tags))]})]
+        if name == 'clubs_batch' :
+            create = [{'code': code, 'name': 'Load ' + code, 'tags': [tag_name(rng.randrange(self.tags))]}
+                      for code in (self.new_code() for _ in range(BULK_SIZE))]
+            return [('POST', '/api/clubs/batch', {'session_key': key, 'create': create})]
+        if name == 'login' :
+            return [('POST', '/api/user/login', {'email': user_email(self.user(rng)), 'password': PASSWORD})]
+        if name == 'signup' :
+            code = self.new_code()
+            return [('POST', '/api/user/signup', {'email': code + '@upenn.edu', 'username': code,
+                                                  'password': PASSWORD})]
+        if name == 'logout' :
+            # logs in a user that the other operations do not use, then logs it out
+            email = user_email(self.sessions + rng.randrange(max(1, self.users - self.sessions)))
+            return [('POST', '/api/user/login', {'email': email, 'password': PASSWORD}),
+                    ('POST', '/api/user/logout', None)]
+        raise ValueError("unknown operation %s" % name)
+
+class TestClientTarget :
+    def __init__ (self, db_path) :
+        from app import app
+        from ratelimit import rate_limiter
+        app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(db_path)
+        # every client comes from one address
+        rate_limiter.enabled = False
+        self.app = app
+        self.local = threading.local()
+
+    def send (self, method, path, body) :
+        if not hasattr(self.local, 'client') :
+            self.local.client = self.app.test_client()
+        response = self.local.client.open(path, method=method, data=None if body is None else json.dumps(body))
+        return response.status_code, response.data
+
+class UrlTarget :
+    def __init__ (self, url) :
+        self.url = url.rstrip('/')
+
+    def send (self, method, path, body) :
+        data = None if body is None else json.dumps(body).encode('utf-8')
+        try :
+            response = urllib.request.urlopen(urllib.request.Request(self.url + path, data=data, method=method))
+            return response.status, response.read()
+        except urllib.error.HTTPError as error :
+            return error.code, error.read()
+
+def run_operation (target, workload, name, rng) :
+    """
+    sends the requests of one operation, returns (status of the last one, its latency in ms)
+    """
+    requests = workload.requests(name, rng)
+    previous = None
+    for method, path, body in requests :
+        if body is None and method == 'POST' :
+            # logout takes the session key returned by the login before it
+            body = {'session_key': json.loads(previous)['session_key']} if previous else {}
+        start = time.perf_counter()
+        try :
+            status, previous = target.send(method, path, body)
+        except OSError :
+            status, previous = 'error', None
+        latency = (time.perf_counter() - start) * 1000
+        if status != 200 :
+            break
+    return status, latency
+
+def client (target, workload, weights, seed, deadline, max_requests, samples) :
+    rng = random.Random(seed)
+    names, cum_weights = list(weights), list(itertools.accumulate(weights.values()))
+    while time.monotonic() < deadline and (max_requests is None or len(samples) < max_requests) :
+        name = rng.choices(names, cum_weights=cum_weights)[0]
+        status, latency = run_operation(target, workload, name, rng)
+        samples.append((name, status, latency, time.monotonic()))
+
+# p-th percentile of a sorted list of samples
+def percentile (ordered, p) :
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] if ordered else None
+
+def summarize (samples, seconds) :
+    latencies = sorted(sample[2] for sample in samples)
+    statuses = {}
+    for sample in samples :
+        statuses[str(sample[1])] = statuses.get(str(sample[1]), 0) + 1
+    return {'requests': len(samples),
+            'throughput_rps': len(samples) / seconds if seconds > 0 else None,
+            'p50_ms': percentile(latencies, 50),
+            'p95_ms': percentile(latencies, 95),
+            'p99_ms': percentile(latencies, 99),
+            'max_ms': latencies[-1] if latencies else None,
+            'statuses': statuses,
+            'server_errors': sum(count for status, count in statuses.items() if not status.startswith(('2', '4')))}
+
+def git_commit () :
+    try :
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip() or None
+    except OSError :
+        return None
+
+def run (target, workload, weights, seconds, concurrency, requests=None, seed=0) :
+    """
+    runs the mix for the given time (or number of operations per client), returns the report as a dict
+    """
+    per_client = [[] for _ in range(concurrency)]
+    start = time.monotonic()
+    deadline = start + seconds
+    threads = [threading.Thread(target=client, args=(target, workload, weights, seed * 1000 + i, deadline,
+                                                     requests, per_client[i]))
+               for i in range(concurrency)]
+    for thread in threads :
+        thread.start()
+    for thread in threads :
+        thread.join()
+    elapsed = time.monotonic() - start
+    samples = [sample for client_samples in per_client for sample in client_samples]
+    return {'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z', time.localtime(time.time() - elapsed)),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'concurrency': concurrency,
+            'seed': seed,
+            'weights': weights,
+            'duration_s': elapsed,
+            'overall': summarize(samples, elapsed),
+            'operations': {name: summarize([sample for sample in samples if sample[0] == name], elapsed)
+                           for name in sorted(weights)}}
+
+def compare (before, after) :
+    print("%-16s %12s %12s %9s %12s %12s %9s" % ('operation', 'p50 before', 'p50 after', 'change',
+                                                   'p99 before', 'p99 after', 'change'))
+    rows = [('overall', before['overall'], after['overall'])]
+    rows += [(name, before['operations'][name], after['operations'][name])
+             for name in sorted(after['operations']) if name in before['operations']]
+    for name, old, new in rows :
+        if not old['requests'] or not new['requests'] :
+            continue
+        print("%-16s %12.2f %12.2f %8.0f%% %12.2f %12.2f %8.0f%%" % (
+            name, old['p50_ms'], new['p50_ms'], 100.0 * (new['p50_ms'] / old['p50_ms'] - 1),
+            old['p99_ms'], new['p99_ms'], 100.0 * (new['p99_ms'] / old['p99_ms'] - 1)))
+    print("throughput: %.1f -> %.1f requests/s" % (before['overall']['throughput_rps'],
+                                                    after['overall']['throughput_rps']))
+
+def main () :
+    parser = argparse.ArgumentParser(description="replay a request mix and report latency percentiles as json")
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--db', help="database file for the flask test client")
+    target_group.add_argument('--url', help="base url of a live server")
+    target_group.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two reports")
+    parser.add_argument('--mix', default='read-heavy',
+                        help="one of %s, or a json object of operation weights" % ', '.join(MIXES))
+    parser.add_argument('--seconds', type=float, default=30)
+    parser.add_argument('--requests', type=int, help="stop each client after this many operations")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--clubs', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--tags', type=int, default=500)
+    parser.add_argument('--sessions', type=int, default=100)
+    parser.add_argument('--zipf', type=float, default=1.0)
+    parser.add_argument('--output', help="file to write the json report to, instead of stdout")
+    args = parser.parse_args()
+
+    if args.compare :
+        reports = []
+        for path in args.compare :
+            with open(path) as report_file :
+                reports.append(json.load(report_file))
+        compare(*reports)
+        return
+
+    weights = MIXES[args.mix] if args.mix in MIXES else json.loads(args.mix)
+    weights = {name: weight for name, weight in weights.items() if weight > 0}
+    target = TestClientTarget(args.db) if args.db else UrlTarget(args.url)
+    workload = Workload(args.clubs, args.users, args.tags, args.sessions, args.zipf)
+    report = run(target, workload, weights, args.seconds, args.concurrency, requests=args.requests, seed=args.seed)
+    report.update({'target': args.url or 'test-client', 'mix': args.mix,
+                   'dataset': {'clubs': args.clubs, 'users': args.users, 'tags': args.tags,
+                               'sessions': args.sessions, 'zipf': args.zipf}})
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output :
+        with open(args.output, 'w') as output_file :
+            output_file.write(output + '\n')
+    else :
+        sys.stdout.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from werkzeug.serving import make_server
+
+from app import app, db
+from ratelimit import rate_limiter
+import bootstrap
+
+""" Measures GET /api/clubs latency on a live threaded server, first on its own and then while
+    a number of clients keep logging in as fast as they can (each login is a bcrypt verification).
+    The rate limiter is disabled, as every client comes from the same address: the storm is meant to
+    saturate the hashing pool, not to be answered with 429s.
+    Usage: python -m benchmarks.login_storm [--storm-clients 32] [--requests 300]
+"""
+# p-th percentile of a list of samples
+def percentile (samples, p) :
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def get_latencies (base_url, n) :
+    latencies = []
+    for _ in range(n) :
+        start = time.perf_counter()
+        urllib.request.urlopen(base_url + '/api/clubs').read()
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+def login_storm (base_url, stop, statuses) :
+    body = json.dumps({'email': 'andy@upenn.edu', 'password': 'andyiscool'}).encode('utf-8')
+    while not stop.is_set() :
+        try :
+            status = urllib.request.urlopen(base_url + '/api/user/login', data=body).status
+        except urllib.error.HTTPError as error :
+            status = error.code
+            # well behaved clients back off when the server is saturated
+            time.sleep(float(error.headers.get('Retry-After', 0)))
+        statuses[status] = statuses.get(status, 0) + 1
+
+def report (label, latencies) :
+    print("%-14s p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms" % (
+        label, percentile(latencies, 50), percentile(latencies, 99), max(latencies)))
+
+def main () :
+    parser = argparse.ArgumentParser(description="GET latency during a login storm")
+    parser.add_argument('--storm-clients', type=int, default=32)
+    parser.add_argument('--requests', type=int, default=300)
+    args = parser.parse_args()
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
+    # every client comes from one address
+    rate_limiter.enabled = False
+    db.create_all()
+    bootstrap.create_user()
+    bootstrap.load_data()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:%d' % server.server_port
+
+    report('idle', get_latencies(base_url, args.requests))
+
+    stop, statuses = threading.Event(), {}
+    clients = [threading.Thread(target=login_storm, args=(base_url, stop, statuses))
+               for _ in range(args.storm_clients)]
+    for client in clients :
+        client.start()
+    time.sleep(1)
+    report('login storm', get_latencies(base_url, args.requests))
+    stop.set()
+    for client in clients :
+        client.join()
+    server.shutdown()
+    print("login responses by status: %s" % statuses)
+    os.remove(db_file)
+
+if __name__ == '__main__':
+    main()
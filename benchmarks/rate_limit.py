@@ -0,0 +1,116 @@
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+from werkzeug.serving import make_server
+
+from app import app, db
+from benchmarks.login_storm import percentile
+from ratelimit import rate_limiter
+import bootstrap
+
+""" Latency of cheap routes while one client floods login, without and with the rate limiter
+    The flooding client sends logins from 127.0.0.2 on --flood-threads connections as fast as it can and never
+    backs off, from a process of its own so that it does not compete with the server for the GIL. Meanwhile GET /api/clubs and /api/tag are sent round robin from --clients other loopback
+    addresses (127.0.1.x), which are well within their own buckets, and --logins logins of other users one at a
+    time from 127.0.2.x: without the limiter they queue behind the flood on the password hashing pool.
+    Usage: python -m benchmarks.rate_limit [--flood-threads 16] [--requests 400] [--clients 50] [--logins 10]
+"""
+FLOOD_ADDRESS = '127.0.0.2'
+CHEAP_PATHS = ('/api/clubs', '/api/tag')
+
+def request (port, source, method, path, body=None) :
+    connection = http.client.HTTPConnection('127.0.0.1', port, source_address=(source, 0))
+    try :
+        connection.request(method, path, body=body)
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally :
+        connection.close()
+
+def cheap_latencies (port, n, clients) :
+    latencies, statuses = [], {}
+    for i in range(n) :
+        start = time.perf_counter()
+        status = request(port, '127.0.1.%d' % (1 + i % clients), 'GET', CHEAP_PATHS[i % len(CHEAP_PATHS)])
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+    return latencies, statuses
+
+def login_latencies (port, n) :
+    body = json.dumps({'email': 'josh@upenn.edu', 'password': 'joshiscool'})
+    latencies, statuses = [], {}
+    for i in range(n) :
+        start = time.perf_counter()
+        status = request(port, '127.0.2.%d' % (1 + i), 'POST', '/api/user/login', body)
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+    return latencies, statuses
+
+def flood_connection (port, stop, statuses, lock) :
+    body = json.dumps({'email': 'andy@upenn.edu', 'password': 'andyiscool'})
+    while not stop.is_set() :
+        status = request(port, FLOOD_ADDRESS, 'POST', '/api/user/login', body)
+        with lock :
+            statuses[status] = statuses.get(status, 0) + 1
+
+# the flooding client, run in its own process until stop is set; puts its responses by status on results
+def flood (port, threads, stop, results) :
+    statuses, lock = {}, threading.Lock()
+    connections = [threading.Thread(target=flood_connection, args=(port, stop, statuses, lock))
+                   for _ in range(threads)]
+    for connection in connections :
+        connection.start()
+    for connection in connections :
+        connection.join()
+    results.put(statuses)
+
+def report (label, latencies, statuses) :
+    print("%-36s p50 %7.2f ms   p99 %7.2f ms   max %7.2f ms   %s" % (
+        label, percentile(latencies, 50), percentile(latencies, 99), max(latencies), statuses))
+
+def main () :
+    parser = argparse.ArgumentParser(description="cheap route latency while one client floods login")
+    parser.add_argument('--flood-threads', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--logins', type=int, default=10)
+    args = parser.parse_args()
+
+    db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_file}"
+    db.create_all()
+    bootstrap.create_user()
+    bootstrap.load_data()
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    report('idle', *cheap_latencies(port, args.requests, args.clients))
+    report('idle, other logins', *login_latencies(port, args.logins))
+    for enabled in (False, True) :
+        rate_limiter.enabled = enabled
+        rate_limiter.clear()
+        stop, results = multiprocessing.Event(), multiprocessing.Queue()
+        flooder = multiprocessing.Process(target=flood, args=(port, args.flood_threads, stop, results))
+        flooder.start()
+        time.sleep(1)
+        label = 'flood, limiter %s' % ('on' if enabled else 'off')
+        report(label, *cheap_latencies(port, args.requests, args.clients))
+        report(label + ', other logins', *login_latencies(port, args.logins))
+        stop.set()
+        print("    login responses by status: %s" % results.get())
+        flooder.join()
+    server.shutdown()
+    os.remove(db_file)
+
+if __name__ == '__main__':
+    main()
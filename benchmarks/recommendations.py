@@ -0,0 +1,52 @@
+import argparse
+import os
+import random
+import time
+from sqlalchemy import text
+
+from app import app, db
+from benchmarks.concurrent_reads import percentile
+from benchmarks.synthetic import club_code, user_email
+from favoriting import user_favorite_codes
+from recommendations import co_favorites
+
+""" Time to build the co-favorite matrix and to answer similar clubs and user recommendations lookups,
+    on a database made by benchmarks.synthetic (the full size one has 10M favorite draws).
+    Lookups are timed cold (the club's similar list is computed) and warm (it is cached).
+    Usage: python -m benchmarks.recommendations bench.db [--lookups 1000]
+"""
+
+def timed_lookups (lookup, keys) :
+    times = []
+    for key in keys :
+        start = time.perf_counter()
+        lookup(key)
+        times.append((time.perf_counter() - start) * 1000)
+    return percentile(times, 50), percentile(times, 99)
+
+def main () :
+    parser = argparse.ArgumentParser(description="co-favorite matrix build and lookup times")
+    parser.add_argument('path', help="database made by benchmarks.synthetic")
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(args.path)
+    rng = random.Random(args.seed)
+    with app.app_context() :
+        start = time.perf_counter()
+        co_favorites.refresh()
+        print("built the matrix in %.1fs: %s" % (time.perf_counter() - start, co_favorites.stats()))
+
+        clubs = len(co_favorites.codes)
+        users = db.session.execute(text("SELECT count(*) FROM user")).scalar()
+        codes = [club_code(rng.randrange(clubs)) for _ in range(args.lookups)]
+        emails = [user_email(rng.randrange(min(users, 10000))) for _ in range(args.lookups)]
+        print("%-26s %10s %10s" % ('lookup', 'p50 ms', 'p99 ms'))
+        print("%-26s %10.2f %10.2f" % (('similar clubs, cold',) + timed_lookups(co_favorites.similar_clubs, codes)))
+        print("%-26s %10.2f %10.2f" % (('similar clubs, warm',) + timed_lookups(co_favorites.similar_clubs, codes)))
+        print("%-26s %10.2f %10.2f" % (('user recommendations',) + timed_lookups(
+            lambda email : co_favorites.recommended_clubs(user_favorite_codes(email)), emails)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks.concurrent_reads import percentile
+
+""" Requests per second and latency of the threaded wsgi server and of the asgi mode (asgi.py under
+    uvicorn) at high concurrency. Each server runs in its own process on a fresh database; the clients
+    send a mix of catalog reads, searches, favorites and logins. The servers run without the rate limiter,
+    since every client comes from the same address.
+    Usage: python -m benchmarks.serving_modes [--clients 64] [--seconds 10] [--clubs 2000]
+"""
+SEARCHES = ['penn', 'club', 'juggling', 'memes', 'labs', 'pre', 'professional', 'bench']
+
+def serve (mode, port, clubs) :
+    """
+    runs in the server process
+    """
+    from app import app, db
+    from importer import import_batch
+    import bootstrap
+
+    db.create_all()
+    bootstrap.create_user()
+    bootstrap.load_data()
+    import_batch([{'code': 'club-%d' % i, 'name': 'Bench Club %d' % i, 'description': 'a club', 'tags': ['bench']}
+                  for i in range(clubs)])
+    db.session.commit()
+    if mode == 'wsgi' :
+        from werkzeug.serving import make_server
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        make_server('127.0.0.1', port, app, threaded=True).serve_forever()
+    else :
+        import uvicorn
+        from asgi import application
+        uvicorn.run(application, host='127.0.0.1', port=port, log_level='error')
+
+def client (base_url, session_key, stop, latencies, statuses) :
+    rng = random.Random()
+    login = json.dumps({'email': 'andy@upenn.edu', 'password': 'andyiscool'}).encode('utf-8')
+    while not stop.is_set() :
+        draw = rng.random()
+        if draw < 0.7 :
+            url, body = base_url + '/api/clubs', None
+        elif draw < 0.9 :
+            url, body = base_url + '/api/clubs/search?string=' + rng.choice(SEARCHES), None
+        elif draw < 0.98 :
+            endpoint = rng.choice(['/api/user/favoriting', '/api/user/unfavoriting'])
+            url = base_url + endpoint
+            body = json.dumps({'session_key': session_key, 'code': 'club-%d' % rng.randrange(100)}).encode('utf-8')
+        else :
+            url, body = base_url + '/api/user/login', login
+        start = time.perf_counter()
+        try :
+            response = urllib.request.urlopen(url, data=body)
+            response.read()
+            status = response.status
+        except urllib.error.HTTPError as error :
+            status = error.code
+        except OSError :
+            status = 'error'
+        latencies.append((time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+
+def wait_until_up (base_url, timeout=60) :
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline :
+        try :
+            urllib.request.urlopen(base_url + '/api').read()
+            return
+        except OSError :
+            time.sleep(0.2)
+    raise RuntimeError("server at %s did not start" % base_url)
+
+def main () :
+    parser = argparse.ArgumentParser(description="throughput and p99 latency of the wsgi and asgi serving modes")
+    parser.add_argument('--clients', type=int, default=64)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--clubs', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--serve', choices=['wsgi', 'asgi'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.serve :
+        serve(args.serve, args.port, args.clubs)
+        return
+
+    print("%-6s %10s %10s %10s  %s" % ('mode', 'req/s', 'p50 ms', 'p99 ms', 'statuses'))
+    for mode in ('wsgi', 'asgi') :
+        db_file = os.path.join(tempfile.mkdtemp(), 'bench.db')
+        server = subprocess.Popen([sys.executable, '-m', 'benchmarks.serving_modes', '--serve', mode,
+                                   '--port', str(args.port), '--clubs', str(args.clubs)],
+                                  env=dict(os.environ, DB_FILE=db_file, RATE_LIMIT_ENABLED='0'))
+        base_url = 'http://127.0.0.1:%d' % args.port
+        try :
+            wait_until_up(base_url)
+            login = json.dumps({'email': 'josh@upenn.edu', 'password': 'joshiscool'}).encode('utf-8')
+            session_key = json.loads(urllib.request.urlopen(base_url + '/api/user/login', data=login).read())['session_key']
+            stop, latencies, statuses = threading.Event(), [], {}
+            clients = [threading.Thread(target=client, args=(base_url, session_key, stop, latencies, statuses))
+                       for _ in range(args.clients)]
+            for thread in clients :
+                thread.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for thread in clients :
+                thread.join()
+        finally :
+            server.terminate()
+            server.wait()
+        print("%-6s %10.0f %10.2f %10.2f  %s" % (mode, len(latencies) / args.seconds, percentile(latencies, 50),
+                                                 percentile(latencies, 99), statuses))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import argparse
+import datetime
+import os
+import random
+import time
+from sqlalchemy import text
+
+from app import app, db, authenticate_post
+from models import UserSession
+from benchmarks.concurrent_reads import percentile
+from benchmarks.synthetic import insert_chunks, session_key, user_email
+from session_cache import session_cache
+from sessions import sweep_batch
+
+""" Authentication lookups with millions of live sessions, and the expiry sweep
+    Adds --sessions live sessions (several per user, keys from session_key(i)) and --expired expired ones to
+    a database made by benchmarks.synthetic (owned by its users user_email(0) to user_email(--users - 1), the
+    users it generated: counting the user table would also count the signups of benchmarks.load), then times authenticate_post for random live keys: cold (the
+    session is looked up in the db) and warm (it is in the session cache), and a sweep of the expired
+    sessions, with the longest batch, which is how long the sweeper holds the write lock.
+    Usage: python -m benchmarks.sessions bench.db [--users 1000000] [--sessions 3000000] [--expired 500000]
+           [--lookups 10000]
+"""
+
+def expired_key (i) :
+    return 'bench-expired-%d' % i
+
+def timed_lookups (keys) :
+    times = []
+    for key in keys :
+        start = time.perf_counter()
+        if authenticate_post({'session_key': key}) is None :
+            raise RuntimeError("no session for %s" % key)
+        times.append((time.perf_counter() - start) * 1000)
+    return percentile(times, 50), percentile(times, 99)
+
+def main () :
+    parser = argparse.ArgumentParser(description="session lookups and expiry sweep at scale")
+    parser.add_argument('path', help="database made by benchmarks.synthetic")
+    parser.add_argument('--users', type=int, default=1000000, help="--users the database was generated with")
+    parser.add_argument('--sessions', type=int, default=3000000)
+    parser.add_argument('--expired', type=int, default=500000)
+    parser.add_argument('--lookups', type=int, default=10000)
+    parser.add_argument('--batch', type=int, default=1000, help="rows deleted per sweep transaction")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(args.path)
+    rng = random.Random(args.seed)
+    with app.app_context() :
+        # databases made before the sessions table existed
+        UserSession.__table__.create(db.engine, checkfirst=True)
+        users = args.users
+        if db.session.execute(text("SELECT 1 FROM user WHERE email = :email"),
+                              {'email': user_email(users - 1)}).first() is None :
+            parser.error("%s has no user %s, pass the --users it was generated with" % (args.path, user_email(users - 1)))
+        now = datetime.datetime.now()
+        live = (now + datetime.timedelta(days=365)).strftime('%Y-%m-%d %H:%M:%S.%f')
+        expired = (now - datetime.timedelta(hours=1)).strftime('%Y-%m-%d %H:%M:%S.%f')
+
+        start = time.perf_counter()
+        connection = db.engine.raw_connection()
+        try :
+            statement = "INSERT OR IGNORE INTO user_session (key, user_id, expires_at) VALUES (?, ?, ?)"
+            insert_chunks(connection, statement,
+                          ((session_key(i), user_email(i % users), live) for i in range(args.sessions)))
+            insert_chunks(connection, statement,
+                          ((expired_key(i), user_email(i % users), expired) for i in range(args.expired)))
+        finally :
+            connection.close()
+        total = db.session.execute(text("SELECT count(*) FROM user_session")).scalar()
+        print("%d sessions in the table (inserted in %.1fs)" % (total, time.perf_counter() - start))
+
+        keys = [session_key(rng.randrange(args.sessions)) for _ in range(args.lookups)]
+        print("%-26s %10s %10s" % ('lookup', 'p50 ms', 'p99 ms'))
+        session_cache.clear()
+        session_cache.max_size = 0
+        print("%-26s %10.3f %10.3f" % (('authenticate, db',) + timed_lookups(keys)))
+        session_cache.max_size = args.lookups
+        timed_lookups(keys)
+        print("%-26s %10.3f %10.3f" % (('authenticate, cached',) + timed_lookups(keys)))
+
+        batches = []
+        while True :
+            start = time.perf_counter()
+            count = sweep_batch(datetime.datetime.now(), args.batch)
+            batches.append((time.perf_counter() - start) * 1000)
+            if count < args.batch :
+                break
+        print("swept the expired sessions in %d batches of %d: %.1fs, longest batch %.1f ms, p50 %.1f ms"
+              % (len(batches), args.batch, sum(batches) / 1000, max(batches), percentile(batches, 50)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import gc
+import os
+import random
+import time
+import tracemalloc
+
+from app import app, db
+from benchmarks.concurrent_reads import percentile
+from benchmarks.synthetic import tag_name
+from catalog import catalog_changed, catalog_version
+from fragments import json_array
+from models import Club, Tag, clubs2tags
+from pagination import paginate
+from serializers import club_fragments, club_summaries, tag_club_summaries
+from snapshot import catalog_snapshot
+
+""" Memory and refresh cost of the catalog snapshot, and reads from it against reads from sqlite
+    On a database made by benchmarks.synthetic: the memory the snapshot holds (traced by tracemalloc, so it
+    counts the records, strings, tuples, dicts and arrays it keeps) and the time of a rebuild, of a patch
+    after a favorite (a club's count changes) and after a new club (positions move, so the tags' arrays are
+    regrouped), then the latency of pages of /api/clubs and /api/tag/search read from the snapshot and with
+    the queries the routes ran before (both with the fragments cached, so only the reads differ).
+    The database is left as it was.
+    Usage: python -m benchmarks.snapshot bench.db [--pages 2000] [--tag 0]
+"""
+
+def db_club_summaries (after, limit) :
+    # the previous implementation of club_summaries
+    version, _ = catalog_version.get()
+    rows, next_cursor = paginate(db.session.query(Club.code, Club.name, Club.fav_cnt), Club.code, after, limit)
+    return json_array(club_fragments('summary', rows, version)), next_cursor
+
+def db_tag_club_summaries (tag, after, limit) :
+    # the previous implementation of tag_club_summaries
+    version, _ = catalog_version.get()
+    db.session.query(Tag).filter_by(name=tag).first()
+    query = db.session.query(Club.code, Club.name) \
+                      .join(clubs2tags, clubs2tags.c.club_id == Club.code) \
+                      .filter(clubs2tags.c.tag_id == tag)
+    rows, next_cursor = paginate(query, Club.code, after, limit)
+    return json_array(club_fragments('brief', rows, version)), next_cursor
+
+def timed (fn, arguments) :
+    times = []
+    for args in arguments :
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return percentile(times, 50), percentile(times, 99)
+
+def main () :
+    parser = argparse.ArgumentParser(description="catalog snapshot memory, refresh time and read latency")
+    parser.add_argument('path', help="database made by benchmarks.synthetic")
+    parser.add_argument('--pages', type=int, default=2000)
+    parser.add_argument('--tag', type=int, default=0, help="number of the tag whose clubs are paged")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(args.path)
+    rng = random.Random(args.seed)
+    with app.app_context() :
+        gc.collect()
+        tracemalloc.start()
+        catalog_snapshot.refresh()
+        db.session.remove()
+        gc.collect()
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        # timed again without tracing, which slows every allocation down
+        catalog_snapshot.clear()
+        start = time.perf_counter()
+        catalog_snapshot.refresh()
+        rebuild = time.perf_counter() - start
+        snapshot = catalog_snapshot.get()
+        stats = snapshot.stats()
+        print("%d clubs, %d tags, %d links" % (stats['clubs'], stats['tags'], stats['links']))
+        print("rebuild %.0f ms, holds %.1f MiB (%.0f bytes per club), peak while building %.1f MiB"
+              % (rebuild * 1000, held / 2 ** 20, held / stats['clubs'], peak / 2 ** 20))
+
+        code = snapshot.codes[len(snapshot.codes) // 2]
+        catalog_changed(db.session, [code])
+        db.session.query(Club).filter_by(code=code).update({Club.fav_cnt: Club.fav_cnt + 1})
+        db.session.commit()
+        start = time.perf_counter()
+        catalog_snapshot.get()
+        print("patch after a favorite: %.2f ms" % ((time.perf_counter() - start) * 1000))
+
+        new_code = 'bench-snapshot-club'
+        club = Club(code=new_code, name='Bench Snapshot Club')
+        club.tags.append(db.session.query(Tag).filter_by(name=tag_name(args.tag)).first())
+        db.session.add(club)
+        catalog_changed(db.session, [new_code])
+        db.session.commit()
+        start = time.perf_counter()
+        catalog_snapshot.get()
+        print("patch after a new club: %.2f ms" % ((time.perf_counter() - start) * 1000))
+
+        # the same pages from both, with every fragment cached by a first pass
+        codes = catalog_snapshot.get().codes
+        club_pages = [(codes[rng.randrange(len(codes))],) for _ in range(args.pages)]
+        tag = tag_name(args.tag)
+        members = [club.code for club in catalog_snapshot.get().clubs if tag in club.tags]
+        tag_pages = [(rng.choice(members),) for _ in range(args.pages)]
+        readers = [
+            ('/api/clubs, sqlite', lambda after : db_club_summaries(after, 100), club_pages),
+            ('/api/clubs, snapshot', lambda after : club_summaries(catalog_snapshot.get(), after, 100), club_pages),
+            ('/api/tag/search, sqlite', lambda after : db_tag_club_summaries(tag, after, 100), tag_pages),
+            ('/api/tag/search, snapshot', lambda after : tag_club_summaries(catalog_snapshot.get(), tag, after, 100), tag_pages),
+        ]
+        print("%-28s %10s %10s" % ('page of 100', 'p50 ms', 'p99 ms'))
+        for label, read, pages in readers :
+            timed(read, pages)
+            print("%-28s %10.3f %10.3f" % ((label,) + timed(read, pages)))
+
+        db.session.query(clubs2tags).filter(clubs2tags.c.club_id == new_code).delete(synchronize_session=False)
+        db.session.query(Tag).filter_by(name=tag).update({Tag.club_cnt: Tag.club_cnt - 1})
+        db.session.query(Club).filter_by(code=new_code).delete()
+        db.session.query(Club).filter_by(code=code).update({Club.fav_cnt: Club.fav_cnt - 1})
+        db.session.commit()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+""" Startup time and first-request latency
+    Each measurement runs in a fresh python process on the database given (by default a bootstrapped one):
+    the time to import the app (models, mappers and every module the routes use), optionally the warm-up
+    (warm_up in app.py), then the latency of the first and the second request to each of PATHS. Without
+    the warm-up the first requests pay for opening connections, filling the caches and building the tag index.
+    Then prefork.py is started with --workers and timed from launch until it answers, and its first answer.
+    Usage: python -m benchmarks.startup [bench.db] [--runs 3] [--workers 2]
+"""
+# a tag and a word of the databases made by bootstrap.py and by benchmarks.synthetic
+PATHS = ['/api/clubs', '/api/tag', '/api/clubs/search?string=penn', '/api/tag/query?q={tag}']
+
+# run in the measured process: prints the timings as json
+MEASURE = '''
+import json, sys, time
+start = time.perf_counter()
+from app import app, warm_up
+timings = {'import': time.perf_counter() - start}
+if sys.argv[1] == 'warm' :
+    start = time.perf_counter()
+    warm_up(app)
+    timings['warm_up'] = time.perf_counter() - start
+client = app.test_client()
+for path in json.loads(sys.argv[2]) :
+    for attempt in ('first', 'second') :
+        start = time.perf_counter()
+        status = client.get(path).status_code
+        timings['%s %s' % (attempt, path)] = time.perf_counter() - start
+        assert status == 200, (path, status)
+print(json.dumps(timings))
+'''
+
+def measure (db_file, mode, paths) :
+    output = subprocess.run([sys.executable, '-c', MEASURE, mode, json.dumps(paths)], check=True,
+                            stdout=subprocess.PIPE, env=dict(os.environ, DB_FILE=db_file)).stdout
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+def free_port () :
+    with socket.socket() as probe :
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def time_prefork (db_file, workers) :
+    """
+    seconds from launching prefork.py until it answers, and the time of that first answer
+    """
+    port = free_port()
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, 'prefork.py', '127.0.0.1', str(port), '--workers', str(workers)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=dict(os.environ, DB_FILE=db_file))
+    try :
+        while True :
+            request_start = time.perf_counter()
+            try :
+                urllib.request.urlopen('http://127.0.0.1:%d/api/clubs' % port).read()
+                return time.perf_counter() - start, time.perf_counter() - request_start
+            except (urllib.error.URLError, ConnectionError) :
+                time.sleep(0.01)
+    finally :
+        server.terminate()
+        server.wait()
+
+def main () :
+    parser = argparse.ArgumentParser(description="startup time and first request latency")
+    parser.add_argument('path', nargs='?', help="database made by benchmarks.synthetic, bootstrapped if left out")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    if args.path is None :
+        db_file = os.path.abspath('startup-bench.db')
+        subprocess.run([sys.executable, 'bootstrap.py'], check=True, stdout=subprocess.DEVNULL,
+                       env=dict(os.environ, DB_FILE=db_file))
+        tag = 'undergraduate'
+    else :
+        db_file = os.path.abspath(args.path)
+        tag = 'tag-0'
+    paths = [path.format(tag=tag) for path in PATHS]
+
+    for mode in ('cold', 'warm') :
+        runs = [measure(db_file, mode, paths) for _ in range(args.runs)]
+        print(mode)
+        for name in runs[0] :
+            # the median run
+            print("    %-40s %9.1f ms" % (name, sorted(run[name] for run in runs)[len(runs) // 2] * 1000))
+    ready, first = time_prefork(db_file, args.workers)
+    print("prefork with %d workers: answering after %.0f ms, first answer %.1f ms" % (args.workers, ready * 1000, first * 1000))
+    if args.path is None :
+        for suffix in ('', '-wal', '-shm') :
+            if os.path.exists(db_file + suffix) :
+                os.remove(db_file + suffix)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import datetime
+import itertools
+import os
+import random
+import time
+from sqlalchemy import text
+
+from app import app, db
+from benchmarks.fts_search import WORDS, vocabulary
+from counters import reconcile_counters
+from hashing import password_hasher
+from search import rebuild_search_index
+
+""" Seeded synthetic data at production scale
+    Clubs, tags, users and favorites are generated from a seed, so two runs with the same arguments
+    build the same database. Tag use, club popularity and user activity follow zipf distributions
+    (a few tags, clubs and users account for most links), like real catalogs do.
+    Rows are written with executemany on a raw connection in chunks, then the counters and the search
+    index are rebuilt. Every user has the password PASSWORD, and the first `sessions` users are logged
+    in with the keys from session_key(i), for the load driver.
+    Names used by the other benchmarks: club_code(i), user_email(i), username(i), tag_name(i)
+    Usage: python -m benchmarks.synthetic bench.db [--clubs 100000] [--users 1000000] [--favorites 10000000]
+"""
+PASSWORD = 'benchmark'
+CHUNK_SIZE = 100000
+
+def club_code (i) :
+    return 'club-%d' % i
+
+def user_email (i) :
+    return 'user%d@upenn.edu' % i
+
+def username (i) :
+    return 'user%d' % i
+
+def tag_name (i) :
+    return 'tag-%d' % i
+
+def session_key (i) :
+    return 'bench-session-%d' % i
+
+# logs in the users numbered in numbers with the keys session_key(i), until expiration
+def insert_sessions (connection, numbers, expiration) :
+    # in the format sqlalchemy stores datetimes in, so that they compare as strings
+    expires_at = expiration.strftime('%Y-%m-%d %H:%M:%S.%f')
+    insert_chunks(connection, "INSERT OR IGNORE INTO user_session (key, user_id, expires_at) VALUES (?, ?, ?)",
+                  ((session_key(i), user_email(i), expires_at) for i in numbers))
+
+# cumulative weights of a zipf distribution over n ranks, for random.choices
+def zipf_cum_weights (n, exponent) :
+    return list(itertools.accumulate(1.0 / rank ** exponent for rank in range(1, n + 1)))
+
+def insert_chunks (connection, statement, rows) :
+    cursor = connection.cursor()
+    chunk = []
+    for row in rows :
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE :
+            cursor.executemany(statement, chunk)
+            chunk = []
+    if chunk :
+        cursor.executemany(statement, chunk)
+    connection.commit()
+
+def generate (clubs, users, favorites, tags=500, tags_per_club=3, sessions=100, exponent=1.0, seed=0,
+              report=print) :
+    """
+    fills the (empty) database of the app, returns the number of rows of each table
+    """
+    rng = random.Random(seed)
+    vocab, vocab_weights = vocabulary(rng)
+    vocab_cum_weights = list(itertools.accumulate(vocab_weights))
+    tag_cum_weights = zipf_cum_weights(tags, exponent)
+    password_hash = password_hasher.hash(PASSWORD)
+    expiration = datetime.datetime.now() + datetime.timedelta(days=365)
+
+    connection = db.engine.raw_connection()
+    try :
+        start = time.perf_counter()
+        insert_chunks(connection, "INSERT INTO tag (name, club_cnt) VALUES (?, 0)",
+                      ((tag_name(i),) for i in range(tags)))
+        insert_chunks(connection, "INSERT INTO club (code, name, description, fav_cnt) VALUES (?, ?, ?, 0)",
+                      ((club_code(i),
+                        ' '.join(rng.choice(WORDS) for _ in range(3)).title() + ' %d' % i,
+                        ' '.join(rng.choices(vocab, cum_weights=vocab_cum_weights, k=20)))
+                       for i in range(clubs)))
+        insert_chunks(connection, "INSERT OR IGNORE INTO clubs2tags (club_id, tag_id) VALUES (?, ?)",
+                      ((club_code(i), tag_name(tag))
+                       for i in range(clubs)
+                       for tag in rng.choices(range(tags), cum_weights=tag_cum_weights, k=tags_per_club)))
+        report("clubs and tags: %.1fs" % (time.perf_counter() - start))
+
+        start = time.perf_counter()
+        insert_chunks(connection, "INSERT INTO user (email, username, password_hash) VALUES (?, ?, ?)",
+                      ((user_email(i), username(i), password_hash) for i in range(users)))
+        insert_sessions(connection, range(min(sessions, users)), expiration)
+        report("users: %.1fs" % (time.perf_counter() - start))
+
+        # popular clubs and active users are drawn more often, duplicate pairs are dropped by the primary key
+        start = time.perf_counter()
+        club_cum_weights = zipf_cum_weights(clubs, exponent)
+        user_cum_weights = zipf_cum_weights(users, exponent)
+        def favorite_pairs () :
+            remaining = favorites
+            while remaining > 0 :
+                k = min(CHUNK_SIZE, remaining)
+                club_ids = rng.choices(range(clubs), cum_weights=club_cum_weights, k=k)
+                user_ids = rng.choices(range(users), cum_weights=user_cum_weights, k=k)
+                for club_id, user_id in zip(club_ids, user_ids) :
+                    yield club_code(club_id), user_email(user_id)
+                remaining -= k
+        insert_chunks(connection, "INSERT OR IGNORE INTO favorites (club_id, user_id) VALUES (?, ?)",
+                      favorite_pairs())
+        report("favorites: %.1fs" % (time.perf_counter() - start))
+    finally :
+        connection.close()
+
+    start = time.perf_counter()
+    reconcile_counters()
+    rebuild_search_index()
+    db.session.commit()
+    report("counters and search index: %.1fs" % (time.perf_counter() - start))
+
+    return {table: db.session.execute(text("SELECT count(*) FROM %s" % table)).scalar()
+            for table in ('club', 'tag', 'clubs2tags', 'user', 'favorites')}
+
+def main () :
+    parser = argparse.ArgumentParser(description="generate a seeded synthetic club review database")
+    parser.add_argument('path', help="database file to create")
+    parser.add_argument('--clubs', type=int, default=100000)
+    parser.add_argument('--users', type=int, default=1000000)
+    parser.add_argument('--favorites', type=int, default=10000000)
+    parser.add_argument('--tags', type=int, default=500)
+    parser.add_argument('--tags-per-club', type=int, default=3)
+    parser.add_argument('--sessions', type=int, default=100, help="number of logged in users")
+    parser.add_argument('--zipf', type=float, default=1.0, help="exponent of the zipf distributions")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path) :
+        parser.error("%s already exists" % args.path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:///" + os.path.abspath(args.path)
+    db.create_all()
+    counts = generate(args.clubs, args.users, args.favorites, tags=args.tags, tags_per_club=args.tags_per_club,
+                      sessions=args.sessions, exponent=args.zipf, seed=args.seed)
+    print(', '.join('%d %s rows' % (count, table) for table, count in counts.items()))
+
+if __name__ == '__main__':
+    main()
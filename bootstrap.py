@@ -1,17 +1,17 @@
+import datetime
 import os
-import json
 from app import DB_FILE
 from models import *
-import random
+from importer import import_clubs
+from sessions import new_session_key
 
-session_key = ''.join(random.choice('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefjhiklmnopqrstuvwxyz')
-                      for i in range(30))
+session_key = new_session_key()
 def create_user():
     josh = User(email="josh@upenn.edu", username="josh", pw_plain="joshiscool")
     # also logs josh in for testing purposes
-    josh.session_key = session_key
-    josh.session_expiration = datetime.datetime.now() + datetime.timedelta(hours=24)
     db.session.add(josh)
+    db.session.add(UserSession(key=session_key, user_id=josh.email,
+                               expires_at=datetime.datetime.now() + datetime.timedelta(hours=24)))
 
     # for login testing
     andy = User(email="andy@upenn.edu", username="andy", pw_plain="andyiscool")
@@ -19,28 +19,8 @@ def create_user():
 
 def load_data():
     print("Loading data into db...")
-    clubs_file = open("clubs.json")
-    clubs_data = clubs_file.read()
-    clubs_file.close()
-    clubs_list = json.loads(clubs_data)
-    # dictionary containing tag string and tag objects
-    all_tags = {}
-
-    for club in clubs_list :
-        club_obj = Club(code=club['code'],
-                        name=club['name'],
-                        description=club['description'])
-        # removing duplicate tags
-        club['tags'] = list(set(club['tags']))
-        for tag in club['tags'] :
-            if (tag not in all_tags) :
-                tag_obj = Tag(name=tag.lower())
-                all_tags[tag] = tag_obj
-            club_obj.tags.append(all_tags[tag])
-
-        db.session.add(club_obj)
-
-    db.session.commit()
+    # clubs.json is streamed in batches, see importer.py
+    import_clubs("clubs.json", report=lambda progress: None)
     print("Finished loading data.")
 
 # No need to modify the below code.
@@ -0,0 +1,159 @@
+import datetime
+import multiprocessing
+import threading
+import uuid
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+""" Catalog version
+    A counter of the committed changes to the catalog (clubs, their tags and their favorites), used
+    to tell whether a response computed earlier is still current. Every write path calls
+    catalog_changed with the codes of the clubs it touched before committing, and the version is
+    bumped once the transaction commits; a rollback forgets the change.
+    The version lives in the process, so an ETag also carries an id of the process's start, and
+    a restarted server never mistakes an old ETag for a current one. Processes forked by prefork.py
+    share the counter instead (see share): a commit in one worker moves it for all of them, and each
+    worker calls sync_catalog before serving a request to hear about the commits of the others. Which
+    clubs they touched is read from the change log they wrote (the change reader of changes.py), so the
+    caches of the other workers only drop those clubs; a gap in the log stands for every club.
+    Caches of per club data register with on_catalog_change to hear which clubs a commit changed. Caches
+    that follow the commits of their process by other means (the co-favorite matrix) register with
+    on_catalog_sync to hear which clubs the commits of other processes changed
+"""
+# session.info key holding the codes of the clubs changed in the current transaction
+CHANGED_CLUBS = 'changed_clubs'
+# stands for every club, when a transaction cannot tell which clubs it changed
+ALL_CLUBS = None
+
+class CatalogVersion :
+    def __init__ (self) :
+        self.epoch = uuid.uuid4().hex[:8]
+        self.version = 0
+        # http dates have a resolution of one second
+        self.modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        # the counter shared with the other processes, once share was called
+        self.shared = None
+        # whether a commit of this process found commits of others that sync has not caught up with yet
+        self.missed = False
+        self._lock = threading.Lock()
+
+    def get (self) :
+        """
+        the current (version, last modified time)
+        """
+        with self._lock :
+            return self.version, self.modified
+
+    def share (self) :
+        """
+        makes the processes forked after this call (which keep the epoch) count their commits together
+        """
+        with self._lock :
+            self.shared = multiprocessing.Value('q', self.version)
+
+    def bump (self) :
+        """
+        counts a commit of this process. Commits of other processes since the last sync are left to sync
+        """
+        with self._lock :
+            if self.shared is None :
+                self.version += 1
+            else :
+                with self.shared.get_lock() :
+                    self.missed = self.missed or self.shared.value != self.version
+                    self.shared.value += 1
+                    self.version = self.shared.value
+            self.modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+
+    def behind (self) :
+        """
+        whether other processes committed since the last sync
+        """
+        return self.shared is not None and (self.missed or self.shared.value != self.version)
+
+    def sync (self) :
+        """
+        catches up with the commits of other processes, returns whether there were any
+        """
+        if self.shared is None :
+            return False
+        version = self.shared.value
+        with self._lock :
+            if self.missed :
+                # the version of the commit that found them counts them already, but what was cached at it
+                # may not: a new version keeps those answers from being served
+                with self.shared.get_lock() :
+                    self.shared.value += 1
+                    version = self.shared.value
+            elif version == self.version :
+                return False
+            self.version = version
+            self.missed = False
+            self.modified = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+            return True
+
+    def etag (self, version) :
+        return '%s-%d' % (self.epoch, version)
+
+catalog_version = CatalogVersion()
+
+# functions called with the codes of the clubs (or ALL_CLUBS) after a commit changed them
+catalog_listeners = []
+
+def on_catalog_change (listener) :
+    catalog_listeners.append(listener)
+    return listener
+
+def catalog_changed (session, codes=ALL_CLUBS) :
+    """
+    records that the current transaction of session changes the catalog, codes are the clubs it touches
+    (leaving them out means any club may have changed)
+    """
+    changed = session.info.get(CHANGED_CLUBS, ())
+    if changed is ALL_CLUBS or codes is ALL_CLUBS :
+        session.info[CHANGED_CLUBS] = ALL_CLUBS
+    else :
+        session.info[CHANGED_CLUBS] = set(changed) | set(codes)
+
+# functions called with the codes of the clubs (or ALL_CLUBS) changed by the commits of other processes
+catalog_sync_listeners = []
+
+def on_catalog_sync (listener) :
+    catalog_sync_listeners.append(listener)
+    return listener
+
+def notify (codes) :
+    for listener in catalog_listeners :
+        listener(codes)
+
+# function () -> the codes of the clubs changed by the commits it has not read yet (or ALL_CLUBS),
+# registered by changes.py with read_changes_with
+change_reader = None
+
+def read_changes_with (reader) :
+    global change_reader
+    change_reader = reader
+    return reader
+
+def sync_catalog () :
+    """
+    tells the listeners about the commits of other processes, if any. Reads the change log, so it runs
+    in an app context
+    """
+    if catalog_version.sync() :
+        codes = change_reader() if change_reader is not None else ALL_CLUBS
+        notify(codes)
+        for listener in catalog_sync_listeners :
+            listener(codes)
+
+@event.listens_for(Session, 'after_commit')
+def bump_catalog_version (session) :
+    if CHANGED_CLUBS in session.info :
+        codes = session.info.pop(CHANGED_CLUBS)
+        # listeners run after the bump, so a reader that stores data after them saw the new version
+        catalog_version.bump()
+        notify(codes)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_catalog_changes (session, previous_transaction) :
+    session.info.pop(CHANGED_CLUBS, None)
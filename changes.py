@@ -0,0 +1,263 @@
+import datetime
+import logging
+import os
+import threading
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import Session
+
+from database import db
+from catalog import ALL_CLUBS, CHANGED_CLUBS, catalog_changed, read_changes_with
+from models import CatalogChange, Club, Tag
+from pagination import DEFAULT_PAGE_SIZE
+from serializers import chunked
+
+""" Catalog change feed
+    Every commit that changes the catalog appends one row per club and per tag it changed to the
+    catalog_change table, in the same transaction: the clubs come from catalog_changed (see catalog.py),
+    so every write path is logged, and the tags are the ones the flushes created or recounted (or that
+    a bulk path reports with tags_changed). A commit that cannot tell which clubs it changed appends a
+    'reset' row instead. Rows are numbered by seq, which only grows.
+    /api/changes?since=<seq> then answers with the current state of what changed after seq: the clubs in
+    the shape of /api/clubs, the codes of the deleted ones and the tags in the shape of /api/tag, so a
+    client that polls only pays for what changed. Without since, or when since is before a reset, the
+    answer is a reset: the client fetches the lists again and polls from the seq it was given.
+    The log is compacted every CHANGE_LOG_COMPACT_INTERVAL seconds: a row is dropped once a later row
+    names the same club or tag, which no client can tell apart, and the rows older than
+    CHANGE_LOG_RETENTION seconds are replaced by one reset row, so only clients that fell further behind
+    than that have to start over.
+    The log also tells the processes of prefork.py which clubs the others changed: change_reader reads
+    the rows after the last seq this process read when sync_catalog (see catalog.py) finds commits of
+    other processes. A reset row, or more than CHANGE_SYNC_MAX_ROWS rows, is reported as every club
+"""
+CHANGE_LOG_RETENTION = float(os.environ.get('CHANGE_LOG_RETENTION', 7 * 24 * 3600))
+# 0 disables the compactor
+CHANGE_LOG_COMPACT_INTERVAL = float(os.environ.get('CHANGE_LOG_COMPACT_INTERVAL', 600))
+# rows of seq range compacted per transaction, so the write lock is only held briefly
+CHANGE_LOG_COMPACT_BATCH = int(os.environ.get('CHANGE_LOG_COMPACT_BATCH', 10000))
+# rows read at once by change_reader, a process further behind drops every club from its caches
+CHANGE_SYNC_MAX_ROWS = int(os.environ.get('CHANGE_SYNC_MAX_ROWS', 10000))
+# session.info key holding the names of the tags changed in the current transaction
+CHANGED_TAGS = 'changed_tags'
+
+logger = logging.getLogger('clubreview.changes')
+
+DELETE_SUPERSEDED = text("""
+    DELETE FROM catalog_change WHERE seq >= :low AND seq < :high AND seq < (
+        SELECT max(newer.seq) FROM catalog_change AS newer
+        WHERE newer.kind = catalog_change.kind AND newer.key = catalog_change.key
+    )
+""")
+
+def tags_changed (session, names) :
+    """
+    records that the current transaction of session changes the tags, for writes that bypass the orm
+    """
+    session.info.setdefault(CHANGED_TAGS, set()).update(names)
+
+@event.listens_for(Session, 'before_flush')
+def record_changed_tags (session, flush_context, instances) :
+    # created tags, and tags whose club count changed
+    names = [obj.name for objects in (session.new, session.dirty, session.deleted)
+             for obj in objects if isinstance(obj, Tag)]
+    if names :
+        tags_changed(session, names)
+
+@event.listens_for(Session, 'before_commit')
+def write_catalog_changes (session) :
+    # the last flush may still change tags
+    session.flush()
+    if CHANGED_CLUBS not in session.info and CHANGED_TAGS not in session.info :
+        return
+    codes = session.info.get(CHANGED_CLUBS, ())
+    tags = session.info.pop(CHANGED_TAGS, ())
+    now = datetime.datetime.now()
+    if codes is ALL_CLUBS :
+        rows = [{'kind': 'reset', 'key': '', 'changed_at': now}]
+    else :
+        rows = [{'kind': 'club', 'key': code, 'changed_at': now} for code in sorted(codes)]
+        rows += [{'kind': 'tag', 'key': name, 'changed_at': now} for name in sorted(tags)]
+    if rows :
+        session.execute(CatalogChange.__table__.insert(), rows)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_changed_tags (session, previous_transaction) :
+    session.info.pop(CHANGED_TAGS, None)
+
+def latest_seq () :
+    return db.session.execute(select(func.max(CatalogChange.seq))).scalar() or 0
+
+def changes_since (since, limit=DEFAULT_PAGE_SIZE) :
+    """
+    what changed after seq since, at most limit log rows of it:
+    {'seq': the seq to poll from next, 'reset': whether the client has to fetch the lists again,
+     'more': whether more changes follow, 'clubs': [...], 'deleted': [codes], 'tags': [...]}.
+    since None asks for a reset. The log is read before the clubs and tags, so they are never older than seq
+    """
+    latest = latest_seq()
+    reset = db.session.execute(select(func.max(CatalogChange.seq)).where(CatalogChange.kind == 'reset')).scalar()
+    # a since after the latest seq comes from another db
+    if since is None or since > latest or (reset is not None and since < reset) :
+        return {'seq': latest, 'reset': True, 'more': False, 'clubs': [], 'deleted': [], 'tags': []}
+
+    rows = db.session.execute(select(CatalogChange.seq, CatalogChange.kind, CatalogChange.key)
+                              .where(CatalogChange.seq > since).order_by(CatalogChange.seq).limit(limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    codes = sorted(set(key for _, kind, key in rows if kind == 'club'))
+    names = sorted(set(key for _, kind, key in rows if kind == 'tag'))
+
+    clubs = {}
+    for batch in chunked(codes) :
+        for code, name, fav_cnt in db.session.execute(select(Club.code, Club.name, Club.fav_cnt)
+                                                      .where(Club.code.in_(batch))) :
+            clubs[code] = {'code': code, 'name': name, 'fav_cnt': fav_cnt}
+    tags = {}
+    for batch in chunked(names) :
+        for name, club_cnt in db.session.execute(select(Tag.name, Tag.club_cnt).where(Tag.name.in_(batch))) :
+            tags[name] = {'name': name, 'cnt': club_cnt}
+    return {'seq': rows[-1].seq if rows else since,
+            'reset': False,
+            'more': more,
+            'clubs': [clubs[code] for code in codes if code in clubs],
+            'deleted': [code for code in codes if code not in clubs],
+            'tags': [tags[name] for name in names if name in tags]}
+
+class ChangeReader :
+    """
+    the codes of the clubs changed by the commits logged since the last read, or ALL_CLUBS
+    """
+    def __init__ (self, max_rows=CHANGE_SYNC_MAX_ROWS) :
+        self.max_rows = max_rows
+        # the seq the log was read up to, None before the first read
+        self.last_seq = None
+        self._lock = threading.Lock()
+
+    def start (self) :
+        """
+        reads from the current end of the log, called before the caches are filled
+        """
+        with self._lock :
+            self.last_seq = latest_seq()
+
+    def __call__ (self) :
+        with self._lock :
+            if self.last_seq is None :
+                self.last_seq = latest_seq()
+                return ALL_CLUBS
+            rows = db.session.execute(select(CatalogChange.seq, CatalogChange.kind, CatalogChange.key)
+                                      .where(CatalogChange.seq > self.last_seq)
+                                      .order_by(CatalogChange.seq).limit(self.max_rows + 1)).fetchall()
+            if not rows :
+                latest = latest_seq()
+                if latest >= self.last_seq :
+                    return set()
+                # the log of another db
+                self.last_seq = latest
+                return ALL_CLUBS
+            if len(rows) > self.max_rows :
+                self.last_seq = latest_seq()
+                return ALL_CLUBS
+            self.last_seq = rows[-1].seq
+            if any(kind == 'reset' for _, kind, _ in rows) :
+                return ALL_CLUBS
+            return set(key for _, kind, key in rows if kind == 'club')
+
+change_reader = read_changes_with(ChangeReader())
+
+def compact_superseded (batch_size=CHANGE_LOG_COMPACT_BATCH) :
+    """
+    deletes the rows followed by a later row for the same club or tag, batch_size seqs per transaction.
+    returns how many
+    """
+    low, high = db.session.execute(select(func.min(CatalogChange.seq), func.max(CatalogChange.seq))).one()
+    deleted = 0
+    if low is None :
+        return deleted
+    for start in range(low, high + 1, batch_size) :
+        deleted += db.session.execute(DELETE_SUPERSEDED, {'low': start, 'high': start + batch_size}).rowcount
+        db.session.commit()
+    return deleted
+
+def truncate_changes (cutoff) :
+    """
+    replaces the rows older than cutoff by one reset row, in one transaction. returns how many were deleted
+    """
+    first_recent = db.session.execute(select(CatalogChange.seq).where(CatalogChange.changed_at >= cutoff)
+                                      .order_by(CatalogChange.seq).limit(1)).scalar()
+    old = select(func.max(CatalogChange.seq))
+    if first_recent is not None :
+        old = old.where(CatalogChange.seq < first_recent)
+    last_old = db.session.execute(old).scalar()
+    if last_old is None :
+        return 0
+    # the newest old row becomes the reset row, so the latest seq is kept
+    deleted = db.session.query(CatalogChange).filter(CatalogChange.seq < last_old) \
+                        .delete(synchronize_session=False)
+    converted = db.session.query(CatalogChange).filter(CatalogChange.seq == last_old, CatalogChange.kind != 'reset') \
+                          .update({CatalogChange.kind: 'reset', CatalogChange.key: ''}, synchronize_session=False)
+    if deleted or converted :
+        # clients behind last_old now get a reset, so the cached answers to them are dropped
+        catalog_changed(db.session, [])
+    db.session.commit()
+    return deleted
+
+def compact_changes (now=None, retention=CHANGE_LOG_RETENTION, batch_size=CHANGE_LOG_COMPACT_BATCH) :
+    """
+    compacts the change log, returns the number of rows deleted
+    """
+    now = now or datetime.datetime.now()
+    deleted = compact_superseded(batch_size)
+    return deleted + truncate_changes(now - datetime.timedelta(seconds=retention))
+
+class ChangeLogCompactor :
+    def __init__ (self, interval=CHANGE_LOG_COMPACT_INTERVAL, retention=CHANGE_LOG_RETENTION,
+                  batch_size=CHANGE_LOG_COMPACT_BATCH) :
+        self.interval = interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self.compacted = 0
+        self.compactions = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start (self, flask_app) :
+        """
+        compacts every interval seconds on a daemon thread, within an app context of flask_app
+        """
+        if self.interval <= 0 or self._thread is not None :
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(flask_app,), name='change-log-compactor', daemon=True)
+        self._thread.start()
+
+    def stop (self) :
+        self._stop.set()
+        if self._thread is not None :
+            self._thread.join()
+            self._thread = None
+
+    def run (self, flask_app) :
+        while not self._stop.wait(self.interval) :
+            with flask_app.app_context() :
+                try :
+                    self.compact()
+                except Exception :
+                    # a locked db is retried at the next interval
+                    logger.exception("change log compaction failed")
+                    db.session.rollback()
+                finally :
+                    db.session.remove()
+
+    def compact (self, now=None) :
+        compacted = compact_changes(now, self.retention, self.batch_size)
+        self.compacted += compacted
+        self.compactions += 1
+        return compacted
+
+    def stats (self) :
+        return {'interval': self.interval,
+                'retention': self.retention,
+                'compactions': self.compactions,
+                'compacted': self.compacted}
+
+change_log_compactor = ChangeLogCompactor()
@@ -0,0 +1,130 @@
+import os
+import threading
+import zlib
+from werkzeug.http import parse_accept_header
+
+try :
+    import brotli
+except ImportError :
+    brotli = None
+
+try :
+    import zstandard
+except ImportError :
+    zstandard = None
+
+""" Negotiated response compression
+    A response whose client sends Accept-Encoding is compressed with the encoding it accepts with the highest
+    quality, ties going to the first of COMPRESSION_ENCODINGS: brotli (br) and zstd when their packages are
+    installed, gzip always. Bodies smaller than COMPRESSION_MIN_BYTES are sent as they are, since compressing
+    them gains less than a packet, as are streamed responses (the exports), which are sent as they are produced.
+    The responses of cached_get views are compressed once per cached entry, the compressed bodies are kept
+    next to the rendered one (see response_cache.py), so a popular page costs one compression per catalog
+    version and encoding. Other responses are compressed per request by an after_request hook in app.py.
+    A compressed response has a weak ETag, as its bytes differ from the uncompressed ones, and every
+    response that could be compressed says Vary: Accept-Encoding for the caches on the way
+"""
+# in order of preference, the ones whose package is missing are left out. Empty disables compression
+COMPRESSION_ENCODINGS = [name.strip() for name in os.environ.get('COMPRESSION_ENCODINGS', 'br,zstd,gzip').split(',')
+                         if name.strip()]
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+# gzip 1-9, brotli 0-11, zstd 1-22. Higher levels compress smaller and slower
+COMPRESSION_LEVELS = {
+    'gzip': int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6)),
+    'br': int(os.environ.get('COMPRESSION_BR_LEVEL', 5)),
+    'zstd': int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3)),
+}
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html')
+
+# gzip framing through zlib, with no file name and a zero mtime, so a body always compresses to the same bytes
+def gzip_compress (body, level) :
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+# encoding -> function (body, level) -> compressed body, for the encodings whose package is installed
+ENCODERS = {'gzip': gzip_compress}
+if brotli is not None :
+    ENCODERS['br'] = lambda body, level : brotli.compress(body, quality=level)
+if zstandard is not None :
+    # a ZstdCompressor must not be shared between threads
+    ENCODERS['zstd'] = lambda body, level : zstandard.ZstdCompressor(level=level).compress(body)
+
+def compressible (mimetype) :
+    return mimetype in COMPRESSIBLE_MIMETYPES
+
+class Compressor :
+    def __init__ (self, encodings=COMPRESSION_ENCODINGS, min_bytes=COMPRESSION_MIN_BYTES, levels=COMPRESSION_LEVELS) :
+        self.encodings = [name for name in encodings if name in ENCODERS]
+        self.min_bytes = min_bytes
+        self.levels = dict(levels)
+        # encoding -> [bodies compressed, bytes in, bytes out]
+        self.counts = {name: [0, 0, 0] for name in self.encodings}
+        self._lock = threading.Lock()
+
+    def negotiate (self, accept_encoding, size) :
+        """
+        the encoding to send a body of size bytes in to a client sending the Accept-Encoding header
+        accept_encoding, or None to send it uncompressed
+        """
+        if not accept_encoding or size < self.min_bytes :
+            return None
+        qualities = {}
+        for name, quality in parse_accept_header(accept_encoding) :
+            qualities[name.lower()] = quality
+        best, best_quality = None, 0
+        for name in self.encodings :
+            # an encoding the header does not name has the quality of *, if any
+            quality = qualities.get(name, qualities.get('*', 0))
+            if quality > best_quality :
+                best, best_quality = name, quality
+        return best
+
+    def compress (self, body, encoding) :
+        compressed = ENCODERS[encoding](body, self.levels[encoding])
+        with self._lock :
+            counts = self.counts[encoding]
+            counts[0] += 1
+            counts[1] += len(body)
+            counts[2] += len(compressed)
+        return compressed
+
+    def stats (self) :
+        with self._lock :
+            return {'encodings': list(self.encodings),
+                    'min_bytes': self.min_bytes,
+                    'compressed': {name: {'bodies': bodies, 'bytes_in': bytes_in, 'bytes_out': bytes_out}
+                                   for name, (bodies, bytes_in, bytes_out) in self.counts.items()}}
+
+compressor = Compressor()
+
+def encoded_headers (headers, encoding) :
+    """
+    headers (a dict) updated for a body sent in encoding, or uncompressed when it is None
+    """
+    headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None :
+        headers['Content-Encoding'] = encoding
+        if 'ETag' in headers and not headers['ETag'].startswith('W/') :
+            headers['ETag'] = 'W/' + headers['ETag']
+    return headers
+
+def compress_response (response, accept_encoding) :
+    """
+    after_request hook: response compressed for a client sending the Accept-Encoding header accept_encoding
+    """
+    if not compressor.encodings or response.is_streamed or response.direct_passthrough \
+       or not compressible(response.mimetype) :
+        return response
+    response.vary.add('Accept-Encoding')
+    # cached_get responses arrive compressed already
+    if response.status_code != 200 or 'Content-Encoding' in response.headers :
+        return response
+    body = response.get_data()
+    encoding = compressor.negotiate(accept_encoding, len(body))
+    if encoding is not None :
+        response.set_data(compressor.compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak :
+            response.set_etag(etag, weak=True)
+    return response
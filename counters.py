@@ -0,0 +1,34 @@
+from database import db
+from models import Club, Tag, clubs2tags, favorites
+from sqlalchemy import func, select
+from catalog import catalog_changed
+
+""" Reconciliation of the denormalized counters (Club.fav_cnt and Tag.club_cnt).
+    The counters are maintained incrementally by the model events, this recomputes them from
+    the association tables in bulk and only rewrites the rows that have drifted
+"""
+def reconcile_counters () :
+    """
+    returns the number of clubs and tags whose counter was corrected
+    """
+    actual_fav_cnt = select(func.count()).select_from(favorites) \
+                        .where(favorites.c.club_id == Club.code).scalar_subquery()
+    clubs_fixed = db.session.query(Club) \
+                    .filter(Club.fav_cnt != actual_fav_cnt) \
+                    .update({Club.fav_cnt: actual_fav_cnt}, synchronize_session=False)
+
+    actual_club_cnt = select(func.count()).select_from(clubs2tags) \
+                        .where(clubs2tags.c.tag_id == Tag.name).scalar_subquery()
+    tags_fixed = db.session.query(Tag) \
+                    .filter(Tag.club_cnt != actual_club_cnt) \
+                    .update({Tag.club_cnt: actual_club_cnt}, synchronize_session=False)
+
+    if clubs_fixed or tags_fixed :
+        catalog_changed(db.session)
+    db.session.commit()
+    return clubs_fixed, tags_fixed
+
+if __name__ == '__main__':
+    print("Reconciling counters...")
+    clubs_fixed, tags_fixed = reconcile_counters()
+    print("Fixed %d club favorite counts and %d tag club counts." % (clubs_fixed, tags_fixed))
@@ -0,0 +1,8 @@
+from engine import RoutingSQLAlchemy
+
+""" The database handle shared by the models and the query modules
+    It is created without an app so that models.py can be imported before any app exists (app.py imports
+    the models at startup); create_app in app.py binds it to the app it creates.
+    GET requests are served from a separate pool of read-only connections, see engine.py
+"""
+db = RoutingSQLAlchemy()
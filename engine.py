@@ -0,0 +1,99 @@
+import os
+import sqlite3
+import threading
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+""" SQLite engine profile
+    The default engine opens a new connection per checkout in rollback journal mode, where a writer
+    locks out every reader and concurrent requests fail with "database is locked". Instead:
+    - the database runs in WAL mode, so readers keep reading the last committed state while a write is
+      in progress, with synchronous=NORMAL (durable across application crashes, a power loss can only
+      lose the last transactions), a larger page cache and memory mapped reads
+    - connections wait up to busy_timeout for a lock instead of failing immediately
+    - connections are kept in a sized pool
+    - GET requests run on a separate pool of query_only connections, so reads never queue behind the
+      write pool and can never write by accident
+    Every setting can be overridden with the environment variable of the same name
+"""
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'wal')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'normal')
+# negative sizes are in KiB, so this is a 64 MiB page cache per connection
+SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE', -64000))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# milliseconds a connection waits for a lock before failing with "database is locked"
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 5))
+SQLITE_MAX_OVERFLOW = int(os.environ.get('SQLITE_MAX_OVERFLOW', 10))
+# 0 serves GET requests from the write pool
+SQLITE_READ_POOL_SIZE = int(os.environ.get('SQLITE_READ_POOL_SIZE', 10))
+
+READ_METHODS = ('GET', 'HEAD')
+
+# connections of the read pool, told apart from the others when they are configured
+class ReadOnlyConnection (sqlite3.Connection) :
+    pass
+
+def engine_options (pool_size=SQLITE_POOL_SIZE, max_overflow=SQLITE_MAX_OVERFLOW, read_only=False) :
+    """
+    keyword arguments of create_engine for a pooled sqlite engine
+    """
+    # pooled connections are handed to whichever thread checks them out next
+    connect_args = {'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT / 1000}
+    if read_only :
+        connect_args['factory'] = ReadOnlyConnection
+    return {'poolclass': QueuePool,
+            'pool_size': pool_size,
+            'max_overflow': max_overflow,
+            'connect_args': connect_args}
+
+@event.listens_for(Engine, 'connect')
+def configure_connection (dbapi_connection, connection_record) :
+    if not isinstance(dbapi_connection, sqlite3.Connection) :
+        return
+    cursor = dbapi_connection.cursor()
+    if isinstance(dbapi_connection, ReadOnlyConnection) :
+        cursor.execute("PRAGMA query_only = ON")
+    else :
+        # the journal mode is stored in the database file, the writers set it
+        cursor.execute("PRAGMA journal_mode = %s" % SQLITE_JOURNAL_MODE)
+    cursor.execute("PRAGMA synchronous = %s" % SQLITE_SYNCHRONOUS)
+    cursor.execute("PRAGMA cache_size = %d" % SQLITE_CACHE_SIZE)
+    cursor.execute("PRAGMA mmap_size = %d" % SQLITE_MMAP_SIZE)
+    cursor.execute("PRAGMA busy_timeout = %d" % SQLITE_BUSY_TIMEOUT)
+    cursor.close()
+
+_read_engines = {}
+_read_engines_lock = threading.Lock()
+
+def read_engine (engine) :
+    """
+    the read-only engine on the same database as engine, created the first time it is asked for
+    """
+    if SQLITE_READ_POOL_SIZE == 0 or engine.url.get_backend_name() != 'sqlite' \
+            or engine.url.database in (None, '', ':memory:') :
+        return engine
+    with _read_engines_lock :
+        reader = _read_engines.get(engine.url)
+        if reader is None :
+            reader = create_engine(engine.url, **engine_options(pool_size=SQLITE_READ_POOL_SIZE, read_only=True))
+            _read_engines[engine.url] = reader
+        return reader
+
+class RoutingSession (SignallingSession) :
+    """
+    sends the statements of GET requests to the read-only engine, everything else
+    (including any flush, which would fail on a read-only connection) to the write engine
+    """
+    def get_bind (self, mapper=None, clause=None) :
+        engine = SignallingSession.get_bind(self, mapper, clause)
+        if not self._flushing and has_request_context() and request.method in READ_METHODS :
+            return read_engine(engine)
+        return engine
+
+class RoutingSQLAlchemy (SQLAlchemy) :
+    def create_session (self, options) :
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
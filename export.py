@@ -0,0 +1,46 @@
+import csv
+import io
+import json
+
+""" Streamed exports
+    Rows are written to the response in chunks of EXPORT_CHUNK_ROWS as they are read from the db, so an
+    export of any size holds one chunk in memory. NDJSON has one json object per line, CSV has a header
+    line with the field names
+"""
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def ndjson_chunks (fields, rows, chunk_rows) :
+    lines = []
+    for row in rows :
+        lines.append(json.dumps(dict(zip(fields, row))))
+        if len(lines) == chunk_rows :
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines :
+        yield '\n'.join(lines) + '\n'
+
+def csv_chunks (fields, rows, chunk_rows) :
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    count = 0
+    for row in rows :
+        writer.writerow(row)
+        count += 1
+        if count == chunk_rows :
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    # the header is sent even when there are no rows
+    if count or buffer.tell() :
+        yield buffer.getvalue()
+
+def export_chunks (format, fields, rows, chunk_rows=EXPORT_CHUNK_ROWS) :
+    """
+    the rows (tuples of fields) as chunks of text in format, one of EXPORT_MIMETYPES
+    """
+    if format == 'csv' :
+        return csv_chunks(fields, rows, chunk_rows)
+    return ndjson_chunks(fields, rows, chunk_rows)
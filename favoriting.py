@@ -0,0 +1,58 @@
+from sqlalchemy import bindparam, text
+
+from database import db
+from recommendations import favorites_changed
+from serializers import chunked
+
+""" Favoriting without loading the favorites relationship
+    Checking membership with `user in club.favorites` loads every user who favorited the club, so the
+    cost of a click grew with the popularity of the club. Instead a favorite is a single INSERT OR IGNORE
+    that relies on the (club_id, user_id) primary key of the favorites table: it inserts one row or
+    nothing, and the club's fav_cnt is only bumped when a row was actually inserted (or deleted).
+    Repeating a request is therefore harmless, and concurrent requests cannot double count
+"""
+INSERT_FAVORITE = text("INSERT OR IGNORE INTO favorites (club_id, user_id) VALUES (:code, :email)")
+DELETE_FAVORITE = text("DELETE FROM favorites WHERE club_id = :code AND user_id = :email")
+ADJUST_FAV_CNT = text("UPDATE club SET fav_cnt = fav_cnt + :delta WHERE code = :code")
+SELECT_USER_CODES = text("SELECT club_id FROM favorites WHERE user_id = :email")
+SELECT_CODES = text("SELECT code FROM club WHERE code IN :codes") \
+                .bindparams(bindparam('codes', expanding=True))
+
+def existing_codes (codes) :
+    """
+    the codes among codes that belong to a club
+    """
+    found = set()
+    for batch in chunked(list(codes)) :
+        found.update(code for code, in db.session.execute(SELECT_CODES, {'codes': batch}))
+    return found
+
+def user_favorite_codes (email) :
+    """
+    codes of the clubs a user favorited, read from the (user_id, club_id) index alone
+    """
+    return [code for code, in db.session.execute(SELECT_USER_CODES, {'email': email})]
+
+def add_favorites (email, codes) :
+    """
+    favorites every club in codes for the user, in the current transaction.
+    codes must belong to existing clubs; returns the codes that were not already favorited
+    """
+    added = []
+    for code in codes :
+        if db.session.execute(INSERT_FAVORITE, {'code': code, 'email': email}).rowcount == 1 :
+            added.append(code)
+    if added :
+        db.session.execute(ADJUST_FAV_CNT, [{'code': code, 'delta': 1} for code in added])
+        favorites_changed(db.session, email, added=added)
+    return added
+
+def remove_favorite (email, code) :
+    """
+    unfavorites a club for the user in the current transaction, returns whether it was favorited
+    """
+    if db.session.execute(DELETE_FAVORITE, {'code': code, 'email': email}).rowcount == 0 :
+        return False
+    db.session.execute(ADJUST_FAV_CNT, {'code': code, 'delta': -1})
+    favorites_changed(db.session, email, removed=[code])
+    return True
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from catalog import catalog_version, on_catalog_change
+
+try :
+    import orjson
+except ImportError :
+    orjson = None
+
+""" Pre-serialized club fragments
+    The lists of clubs are made of the same few shapes of the same clubs over and over, so the json of
+    each club is kept as bytes, per shape, and a list body is the concatenation of its clubs' fragments:
+    a request only encodes the clubs whose fragment is missing.
+    Fragments are dropped per club when a transaction that changed the club commits (see catalog.py);
+    a fragment encoded from rows read before such a commit is not stored, since it may already be stale.
+    With orjson installed fragments are encoded with it, JSON_ENCODER=json falls back to the standard
+    library. Keys are sorted and separators compact, as jsonify does, so the bodies are the same json as
+    jsonify's. They are not always the same bytes: orjson writes non-ascii text as utf-8 where jsonify
+    escapes it, so only the standard library encoder keeps the bytes of every body
+"""
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'orjson' if orjson is not None else 'json')
+MAX_FRAGMENTS = int(os.environ.get('FRAGMENT_CACHE_SIZE', 200000))
+
+# the fields of each shape a club is served in
+SHAPES = {
+    # /api/clubs
+    'summary': ('code', 'name', 'fav_cnt'),
+    # /api/clubs/search
+    'full': ('code', 'name', 'description', 'tags', 'fav_cnt'),
+    # /api/user/favorite_clubs, which never showed favorite counts
+    'details': ('code', 'name', 'description', 'tags'),
+    # /api/tag/search
+    'brief': ('code', 'name'),
+}
+
+if JSON_ENCODER == 'orjson' :
+    def encode (value) :
+        return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+else :
+    def encode (value) :
+        return json.dumps(value, sort_keys=True, separators=(',', ':')).encode('ascii')
+
+# a json array of already encoded values
+def json_array (fragments) :
+    return b'[' + b','.join(fragments) + b']'
+
+class FragmentCache :
+    def __init__ (self, max_fragments=MAX_FRAGMENTS) :
+        self.max_fragments = max_fragments
+        self.hits = 0
+        self.misses = 0
+        # shape -> code -> bytes, in insertion order: the oldest fragments are evicted first,
+        # since keeping a recency order would cost more per hit than encoding a fragment again
+        self._fragments = {shape: OrderedDict() for shape in SHAPES}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get_many (self, shape, codes) :
+        """
+        the fragments of shape of the clubs, in order, None where there is none
+        """
+        get = self._fragments[shape].get
+        fragments = [get(code) for code in codes]
+        misses = fragments.count(None)
+        with self._lock :
+            self.hits += len(fragments) - misses
+            self.misses += misses
+        return fragments
+
+    def put_many (self, shape, fragments, version) :
+        """
+        stores fragments (code -> bytes) encoded from rows read at catalog version
+        """
+        with self._lock :
+            if catalog_version.get()[0] != version :
+                return
+            stored = self._fragments[shape]
+            for code, fragment in fragments.items() :
+                self._size += code not in stored
+                stored[code] = fragment
+            while self._size > self.max_fragments :
+                for oldest in self._fragments.values() :
+                    if oldest :
+                        oldest.popitem(last=False)
+                        self._size -= 1
+
+    def invalidate (self, codes) :
+        """
+        drops the fragments of the clubs, or all of them when codes is None
+        """
+        with self._lock :
+            for stored in self._fragments.values() :
+                if codes is None :
+                    stored.clear()
+                else :
+                    for code in codes :
+                        stored.pop(code, None)
+            self._size = sum(len(stored) for stored in self._fragments.values())
+
+    def clear (self) :
+        self.invalidate(None)
+
+    def stats (self) :
+        with self._lock :
+            return {'fragments': self._size,
+                    'max_fragments': self.max_fragments,
+                    'encoder': JSON_ENCODER,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+fragment_cache = FragmentCache()
+on_catalog_change(fragment_cache.invalidate)
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import bcrypt
+
+from metrics import metrics
+
+""" Password hashing off the request threads
+    bcrypt is deliberately slow, so a burst of logins or signups would keep every request thread busy
+    hashing while cheap GET requests wait. Hashing and verification run on a small dedicated pool
+    instead (bcrypt releases the GIL, so threads are enough), and once max_pending jobs are queued
+    or running new ones are refused with HashingUnavailable, which the app answers with a 503.
+    The bcrypt cost factor is configurable; hashes made with another cost are redone at the next login
+"""
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', max(1, (os.cpu_count() or 2) // 2)))
+HASH_MAX_PENDING = int(os.environ.get('HASH_MAX_PENDING', 32))
+# seconds a client is told to wait before retrying when the pool is full
+HASH_RETRY_AFTER = 1
+
+class HashingUnavailable (Exception) :
+    pass
+
+class PasswordHasher :
+    def __init__ (self, rounds=BCRYPT_ROUNDS, workers=HASH_WORKERS, max_pending=HASH_MAX_PENDING) :
+        self.rounds = rounds
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    # runs fn on the pool and waits for its result, or fails fast if the queue is full
+    def _run (self, fn, *args) :
+        if not self._slots.acquire(blocking=False) :
+            self.rejected += 1
+            raise HashingUnavailable("too many password operations in progress")
+        try :
+            future = self._executor.submit(fn, *args)
+        except BaseException :
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _ : self._slots.release())
+        start = time.perf_counter()
+        try :
+            return future.result()
+        finally :
+            metrics.add_time('password_hashing', time.perf_counter() - start)
+
+    def hash (self, password) :
+        salt = bcrypt.gensalt(self.rounds)
+        return self._run(bcrypt.hashpw, password.encode('utf-8'), salt)
+
+    def verify (self, password, password_hash) :
+        if isinstance(password_hash, str) :
+            password_hash = password_hash.encode('utf-8')
+        return self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash)
+
+    def needs_rehash (self, password_hash) :
+        # bcrypt hashes look like $2b$<cost>$<salt and hash>
+        if isinstance(password_hash, str) :
+            password_hash = password_hash.encode('utf-8')
+        return int(password_hash.split(b'$')[2]) != self.rounds
+
+    def stats (self) :
+        return {'rounds': self.rounds,
+                'max_pending': self.max_pending,
+                'rejected': self.rejected}
+
+password_hasher = PasswordHasher()
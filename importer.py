@@ -0,0 +1,263 @@
+import argparse
+import json
+import os
+import time
+from sqlalchemy import bindparam, text
+
+from database import db
+from catalog import catalog_changed
+from changes import tags_changed
+from search import unindex_clubs, insert_search_rows
+from serializers import chunked
+
+""" Streaming bulk importer for club files
+    Reads a JSON array of clubs or NDJSON (one club per line) incrementally, so memory use does not
+    depend on the size of the file, and writes each batch of clubs with a few executemany statements:
+    tags are upserted, clubs are upserted by code and their clubs2tags rows replaced, tag counters
+    are adjusted by the difference and the search index is refreshed, then the batch is committed.
+    Because every statement is an upsert, importing the same file twice leaves the db unchanged,
+    and an interrupted import can be resumed from the last committed batch with --resume.
+    Malformed JSON stops the import with its line (NDJSON) or offset (JSON array). A record with fields of
+    the wrong type, or with the name of another club (names are unique, as the API keeps them), is
+    reported with its line or offset and skipped, and the import goes on
+    Usage: python importer.py clubs.json [--batch-size 1000] [--resume]
+"""
+DEFAULT_BATCH_SIZE = 1000
+READ_CHUNK_SIZE = 1 << 16
+
+UPSERT_TAGS = text("INSERT OR IGNORE INTO tag (name, club_cnt) VALUES (:name, 0)")
+UPSERT_CLUBS = text("""
+    INSERT INTO club (code, name, description, fav_cnt) VALUES (:code, :name, :description, 0)
+    ON CONFLICT (code) DO UPDATE SET name = excluded.name, description = excluded.description
+""")
+SELECT_EXISTING = text("SELECT code FROM club WHERE code IN :codes") \
+                    .bindparams(bindparam('codes', expanding=True))
+SELECT_NAMES = text("SELECT name, code FROM club WHERE name IN :names") \
+                .bindparams(bindparam('names', expanding=True))
+SELECT_LINKS = text("SELECT club_id, tag_id FROM clubs2tags WHERE club_id IN :codes") \
+                .bindparams(bindparam('codes', expanding=True))
+DELETE_LINKS = text("DELETE FROM clubs2tags WHERE club_id IN :codes") \
+                .bindparams(bindparam('codes', expanding=True))
+INSERT_LINKS = text("INSERT INTO clubs2tags (tag_id, club_id) VALUES (:tag_id, :club_id)")
+ADJUST_CLUB_CNT = text("UPDATE tag SET club_cnt = club_cnt + :delta WHERE name = :name")
+
+class InvalidImportFile (ValueError) :
+    pass
+
+# yields ('offset N', value) for the objects of a JSON array one at a time, reading the file in chunks.
+# N is the offset of the value in the file, in characters
+def iter_json_array (file) :
+    decoder = json.JSONDecoder()
+    # offset of buffer[0] in the file
+    buffer, offset = file.read(READ_CHUNK_SIZE), 0
+    while buffer == '' or buffer.isspace() :
+        chunk = file.read(READ_CHUNK_SIZE)
+        if not chunk :
+            break
+        buffer, offset = chunk, offset + len(buffer)
+    offset += len(buffer) - len(buffer.lstrip())
+    buffer = buffer.lstrip()
+    if not buffer.startswith('[') :
+        raise InvalidImportFile("expected a JSON array of clubs")
+    position = 1
+    while True :
+        # skip the separators between values, reading more input when the buffer runs out
+        while True :
+            while position < len(buffer) and buffer[position] in ' \t\r\n,' :
+                position += 1
+            if position < len(buffer) :
+                break
+            buffer, position, offset = file.read(READ_CHUNK_SIZE), 0, offset + len(buffer)
+            if not buffer :
+                raise InvalidImportFile("unterminated JSON array")
+        if buffer[position] == ']' :
+            return
+        try :
+            value, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError :
+            # the value is cut off at the end of the buffer
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk :
+                raise InvalidImportFile("offset %d: malformed or truncated JSON value" % (offset + position))
+            buffer, position, offset = buffer[position:] + chunk, 0, offset + position
+            continue
+        yield 'offset %d' % (offset + position), value
+        position = end
+
+# yields ('line N', value) for the lines of an NDJSON file
+def iter_ndjson (file) :
+    for number, line in enumerate(file, 1) :
+        line = line.strip()
+        if line :
+            try :
+                value = json.loads(line)
+            except ValueError as error :
+                raise InvalidImportFile("line %d: %s" % (number, error))
+            yield 'line %d' % number, value
+
+def iter_located_records (file) :
+    """
+    (location, club) for the clubs in a file, as a JSON array or NDJSON depending on the first character
+    of the file. location is the line or offset of the club in the file, for error messages
+    """
+    first = file.read(1)
+    while first.isspace() :
+        first = file.read(1)
+    file.seek(0)
+    return iter_json_array(file) if first == '[' else iter_ndjson(file)
+
+def iter_records (file) :
+    """
+    clubs in a file, as a JSON array or NDJSON depending on the first character of the file
+    """
+    return (record for _, record in iter_located_records(file))
+
+# why a record cannot be imported, or None if it can
+def invalid_record (record) :
+    if not isinstance(record, dict) :
+        return "not a JSON object"
+    if not record.get('code') or not record.get('name') :
+        return "missing club code or name"
+    if not isinstance(record['code'], str) or not isinstance(record['name'], str) :
+        return "club code and name must be strings"
+    if not isinstance(record.get('description') or "", str) :
+        return "description must be a string"
+    tags = record.get('tags') or []
+    if not isinstance(tags, list) or not all(isinstance(tag, str) for tag in tags) :
+        return "tags must be a list of strings"
+    return None
+
+# reads the next batch_size records from an iterator
+def take (records, batch_size) :
+    batch = []
+    for record in records :
+        batch.append(record)
+        if len(batch) == batch_size :
+            break
+    return batch
+
+def import_batch (records, locations=None, report=print) :
+    """
+    upserts a batch of clubs and their tags in the current transaction,
+    returns the number of records skipped because they are invalid or take the name of another club.
+    Each skipped record is reported with its entry in locations (its index in records by default)
+    """
+    locations = locations or ['record %d' % index for index in range(len(records))]
+    skipped = [0]
+    def skip (location, message) :
+        skipped[0] += 1
+        report("%s: %s, skipped" % (location, message))
+
+    clubs = {}
+    # name -> code of the club of the batch that has it
+    names = {}
+    for location, record in zip(locations, records) :
+        message = invalid_record(record)
+        if message is not None :
+            skip(location, message)
+            continue
+        code = record['code'].lower()
+        if names.get(record['name'], code) != code :
+            skip(location, "the name %r belongs to another club" % record['name'])
+            continue
+        # a club listed twice in a batch keeps its last version
+        previous = clubs.pop(code, None)
+        if previous is not None :
+            names.pop(previous['name'], None)
+        names[record['name']] = code
+        clubs[code] = {'code': code,
+                       'name': record['name'],
+                       'description': record.get('description') or "",
+                       'tags': sorted(set(tag.lower() for tag in record.get('tags') or [])),
+                       'location': location}
+    # names the db gives to other clubs
+    for batch in chunked(sorted(names)) :
+        for name, code in db.session.execute(SELECT_NAMES, {'names': batch}) :
+            if names[name] != code :
+                skip(clubs.pop(names[name])['location'], "the name %r belongs to another club" % name)
+    if not clubs :
+        return skipped[0]
+
+    codes = list(clubs)
+    # only clubs that are already in the db can have links to replace
+    existing = []
+    for batch in chunked(codes) :
+        existing += [code for code, in db.session.execute(SELECT_EXISTING, {'codes': batch})]
+
+    new_links = [{'tag_id': tag, 'club_id': code} for code in codes for tag in clubs[code]['tags']]
+    # tag counters change by the number of links added minus the number removed
+    deltas = {}
+    for link in new_links :
+        deltas[link['tag_id']] = deltas.get(link['tag_id'], 0) + 1
+    for batch in chunked(existing) :
+        for _, tag in db.session.execute(SELECT_LINKS, {'codes': batch}) :
+            deltas[tag] = deltas.get(tag, 0) - 1
+
+    tags = sorted(set(link['tag_id'] for link in new_links))
+    if tags :
+        db.session.execute(UPSERT_TAGS, [{'name': tag} for tag in tags])
+    db.session.execute(UPSERT_CLUBS, [{key: club[key] for key in ('code', 'name', 'description')}
+                                      for club in clubs.values()])
+    for batch in chunked(existing) :
+        db.session.execute(DELETE_LINKS, {'codes': batch})
+    if new_links :
+        db.session.execute(INSERT_LINKS, new_links)
+    changed = [{'name': tag, 'delta': delta} for tag, delta in deltas.items() if delta != 0]
+    if changed :
+        db.session.execute(ADJUST_CLUB_CNT, changed)
+    unindex_clubs(existing)
+    insert_search_rows(clubs.values())
+    catalog_changed(db.session, codes)
+    tags_changed(db.session, set(tags) | set(deltas))
+    return skipped[0]
+
+def import_clubs (path, batch_size=DEFAULT_BATCH_SIZE, checkpoint=None, resume=False, report=print) :
+    """
+    imports every club in the file at path, committing after each batch.
+    With a checkpoint file the number of committed records is saved after every batch,
+    and resume skips the records an earlier run already committed
+    """
+    done = 0
+    if resume and checkpoint is not None and os.path.exists(checkpoint) :
+        with open(checkpoint) as checkpoint_file :
+            done = int(checkpoint_file.read().strip() or 0)
+
+    start = time.perf_counter()
+    imported = skipped = 0
+    with open(path) as clubs_file :
+        records = iter_located_records(clubs_file)
+        for _ in range(done) :
+            next(records, None)
+        while True :
+            batch = take(records, batch_size)
+            if not batch :
+                break
+            skipped += import_batch([record for _, record in batch], [location for location, _ in batch], report)
+            db.session.commit()
+            done += len(batch)
+            imported += len(batch)
+            if checkpoint is not None :
+                with open(checkpoint, 'w') as checkpoint_file :
+                    checkpoint_file.write(str(done))
+            elapsed = time.perf_counter() - start
+            report("%d clubs imported (%d skipped), %.0f clubs/s" % (
+                done, skipped, imported / elapsed if elapsed > 0 else 0))
+
+    if checkpoint is not None and os.path.exists(checkpoint) :
+        os.remove(checkpoint)
+    return imported, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="stream a JSON or NDJSON file of clubs into the db")
+    parser.add_argument('path')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--resume', action='store_true',
+                        help="continue after the last batch committed by an interrupted import")
+    args = parser.parse_args()
+
+    from app import app
+    with app.app_context() :
+        db.create_all()
+        import_clubs(args.path, batch_size=args.batch_size,
+                     checkpoint=args.path + '.progress', resume=args.resume)
+    print("Finished importing clubs.")
@@ -0,0 +1,193 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+""" Per-request instrumentation
+    For every route (url rule and method) the app records a latency histogram, the number of responses
+    by status, the number of sql statements and the time spent in them (from engine events, on the read
+    and the write pools), the time spent serializing json and hashing passwords, and the response bytes.
+    The figures of the request in progress live in a thread local, and are added to the per route totals
+    under one lock when the request ends, so the overhead is a few counter updates per statement and per
+    request. /api/metrics serves the totals in the Prometheus text format.
+    With SLOW_REQUEST_MS set, requests slower than that are logged with every sql statement they ran
+"""
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 0))
+# upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# parts of a request whose time is measured separately
+PHASES = ('sql', 'serialization', 'password_hashing')
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+slow_request_log = logging.getLogger('clubreview.slow_requests')
+
+class RequestStats :
+    """
+    what is measured during one request
+    """
+    def __init__ (self, capture_sql) :
+        self.start = time.perf_counter()
+        self.sql_statements = 0
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        # (statement, seconds) pairs, only kept for the slow request log
+        self.statements = [] if capture_sql else None
+
+class RouteTotals :
+    def __init__ (self) :
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.latency_seconds = 0.0
+        self.statuses = {}
+        self.sql_statements = 0
+        self.phase_seconds = dict.fromkeys(PHASES, 0.0)
+        self.response_bytes = 0
+
+class Metrics :
+    def __init__ (self, slow_request_ms=SLOW_REQUEST_MS) :
+        self.slow_request_ms = slow_request_ms
+        self.routes = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current (self) :
+        return getattr(self._local, 'stats', None)
+
+    def request_started (self) :
+        self._local.stats = RequestStats(capture_sql=self.slow_request_ms > 0)
+
+    def add_time (self, phase, seconds) :
+        stats = self.current()
+        if stats is not None :
+            stats.phase_seconds[phase] += seconds
+
+    def add_statement (self, statement, seconds) :
+        stats = self.current()
+        if stats is not None :
+            stats.sql_statements += 1
+            stats.phase_seconds['sql'] += seconds
+            if stats.statements is not None :
+                stats.statements.append((statement, seconds))
+
+    def request_abandoned (self) :
+        """
+        forgets the request in progress, which is not counted (asgi.py hands it over to a worker thread)
+        """
+        self._local.stats = None
+
+    def request_finished (self, route, method, status, response_bytes) :
+        stats = self.current()
+        if stats is None :
+            return
+        self._local.stats = None
+        latency = time.perf_counter() - stats.start
+        with self._lock :
+            totals = self.routes.get((route, method))
+            if totals is None :
+                totals = self.routes[(route, method)] = RouteTotals()
+            totals.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            totals.count += 1
+            totals.latency_seconds += latency
+            totals.statuses[status] = totals.statuses.get(status, 0) + 1
+            totals.sql_statements += stats.sql_statements
+            for phase, seconds in stats.phase_seconds.items() :
+                totals.phase_seconds[phase] += seconds
+            totals.response_bytes += response_bytes
+
+        if self.slow_request_ms > 0 and latency * 1000 >= self.slow_request_ms :
+            slow_request_log.warning("slow request %s %s: %.1f ms, %d statements in %.1f ms\n%s",
+                                     method, route, latency * 1000, stats.sql_statements,
+                                     stats.phase_seconds['sql'] * 1000,
+                                     '\n'.join("  %.2f ms  %s" % (seconds * 1000, ' '.join(statement.split()))
+                                               for statement, seconds in stats.statements))
+
+    def reset (self) :
+        with self._lock :
+            self.routes.clear()
+
+    def prometheus (self) :
+        """
+        the totals in the Prometheus text exposition format
+        """
+        with self._lock :
+            routes = sorted(self.routes.items())
+            lines = ["# HELP http_request_duration_seconds Time to handle a request, by route.",
+                     "# TYPE http_request_duration_seconds histogram"]
+            for (route, method), totals in routes :
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), totals.buckets) :
+                    cumulative += count
+                    lines.append('http_request_duration_seconds_bucket{%s,le="%s"} %d'
+                                 % (labels(route, method), bound, cumulative))
+                lines.append('http_request_duration_seconds_sum{%s} %.6f' % (labels(route, method), totals.latency_seconds))
+                lines.append('http_request_duration_seconds_count{%s} %d' % (labels(route, method), totals.count))
+
+            lines += ["# HELP http_responses_total Responses sent, by route and status.",
+                      "# TYPE http_responses_total counter"]
+            for (route, method), totals in routes :
+                for status, count in sorted(totals.statuses.items()) :
+                    lines.append('http_responses_total{%s,status="%d"} %d' % (labels(route, method), status, count))
+
+            lines += ["# HELP http_request_sql_statements_total SQL statements executed, by route.",
+                      "# TYPE http_request_sql_statements_total counter"]
+            lines += ['http_request_sql_statements_total{%s} %d' % (labels(route, method), totals.sql_statements)
+                      for (route, method), totals in routes]
+
+            lines += ["# HELP http_request_phase_seconds_total Time spent in sql, json serialization and password "
+                      "hashing, by route.",
+                      "# TYPE http_request_phase_seconds_total counter"]
+            for (route, method), totals in routes :
+                for phase in PHASES :
+                    lines.append('http_request_phase_seconds_total{%s,phase="%s"} %.6f'
+                                 % (labels(route, method), phase, totals.phase_seconds[phase]))
+
+            lines += ["# HELP http_response_bytes_total Bytes of response bodies, by route.",
+                      "# TYPE http_response_bytes_total counter"]
+            lines += ['http_response_bytes_total{%s} %d' % (labels(route, method), totals.response_bytes)
+                      for (route, method), totals in routes]
+        return '\n'.join(lines) + '\n'
+
+# label values are escaped as the text format requires
+def labels (route, method) :
+    escape = lambda value : value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return 'route="%s",method="%s"' % (escape(route), escape(method))
+
+metrics = Metrics()
+
+# when no view matched, the path itself is not used as a label, so unknown urls cannot grow the registry
+def route_of_request () :
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer (conn, cursor, statement, parameters, context, executemany) :
+    if metrics.current() is not None :
+        conn.info.setdefault('metrics_statement_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer (conn, cursor, statement, parameters, context, executemany) :
+    starts = conn.info.get('metrics_statement_start')
+    if starts :
+        metrics.add_statement(statement, time.perf_counter() - starts.pop())
+
+# a failed statement never reaches after_cursor_execute
+@event.listens_for(Engine, 'handle_error')
+def discard_statement_timer (exception_context) :
+    if exception_context.connection is not None :
+        starts = exception_context.connection.info.get('metrics_statement_start')
+        if starts :
+            starts.pop()
+
+class TimedJSONProvider (DefaultJSONProvider) :
+    """
+    the default json provider, timing every serialization of the request
+    """
+    def dumps (self, obj, **kwargs) :
+        start = time.perf_counter()
+        try :
+            return super().dumps(obj, **kwargs)
+        finally :
+            metrics.add_time('serialization', time.perf_counter() - start)
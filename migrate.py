@@ -0,0 +1,95 @@
+from sqlalchemy import inspect, text
+
+from app import db
+from models import Club, Tag, User, UserSession, CatalogChange, clubs2tags, favorites, CLUB_SEARCH_DDL
+from counters import reconcile_counters
+from search import rebuild_search_index
+
+""" Brings an existing clubreview.db up to the current schema without losing data:
+    - adds the counter columns (club.fav_cnt, tag.club_cnt)
+    - rebuilds clubs2tags and favorites with their composite primary keys, dropping duplicate links
+    - creates the secondary indexes
+    - moves the sessions kept in user.session_key / user.session_expiration to the user_session table
+    - creates the catalog change log
+    - creates and fills the full-text search table
+    - recomputes the counters
+    Running it on an up to date db changes nothing.
+    Usage: python migrate.py
+"""
+# the columns added to existing tables since the first version of the schema
+ADDED_COLUMNS = [
+    (Club.__table__, "fav_cnt INTEGER NOT NULL DEFAULT 0"),
+    (Tag.__table__, "club_cnt INTEGER NOT NULL DEFAULT 0"),
+]
+
+def add_missing_columns (connection) :
+    inspector = inspect(connection)
+    for table, definition in ADDED_COLUMNS :
+        name = definition.split()[0]
+        if name not in [column['name'] for column in inspector.get_columns(table.name)] :
+            print("Adding column %s.%s" % (table.name, name))
+            connection.execute(text("ALTER TABLE %s ADD COLUMN %s" % (table.name, definition)))
+
+def rebuild_link_table (connection, table) :
+    """
+    sqlite cannot add a primary key to an existing table, so the table is recreated
+    and its distinct, complete rows are copied over
+    """
+    if inspect(connection).get_pk_constraint(table.name)['constrained_columns'] :
+        return
+    print("Rebuilding %s with a primary key" % table.name)
+    columns = ', '.join(column.name for column in table.columns)
+    not_null = ' AND '.join('%s IS NOT NULL' % column.name for column in table.columns)
+    connection.execute(text("ALTER TABLE %s RENAME TO %s_old" % (table.name, table.name)))
+    table.create(connection)
+    connection.execute(text("INSERT OR IGNORE INTO %s (%s) SELECT %s FROM %s_old WHERE %s" % (
+        table.name, columns, columns, table.name, not_null)))
+    connection.execute(text("DROP TABLE %s_old" % table.name))
+
+def move_user_sessions (connection) :
+    """
+    users had a single session stored on their row, it becomes their first row of user_session.
+    The old columns are emptied rather than dropped, so running this again moves nothing
+    """
+    UserSession.__table__.create(connection, checkfirst=True)
+    if 'session_key' not in [column['name'] for column in inspect(connection).get_columns(User.__table__.name)] :
+        return
+    moved = connection.execute(text(
+        "INSERT OR IGNORE INTO user_session (key, user_id, expires_at) "
+        "SELECT session_key, email, session_expiration FROM user "
+        "WHERE session_key IS NOT NULL AND session_expiration IS NOT NULL")).rowcount
+    connection.execute(text("UPDATE user SET session_key = NULL, session_expiration = NULL "
+                            "WHERE session_key IS NOT NULL"))
+    if moved :
+        print("Moved %d sessions to user_session" % moved)
+
+def create_missing_indexes (connection) :
+    for table in (Club.__table__, Tag.__table__, User.__table__, UserSession.__table__, CatalogChange.__table__,
+                  clubs2tags, favorites) :
+        for index in table.indexes :
+            index.create(connection, checkfirst=True)
+
+def migrate () :
+    with db.engine.begin() as connection :
+        add_missing_columns(connection)
+        rebuild_link_table(connection, clubs2tags)
+        rebuild_link_table(connection, favorites)
+        move_user_sessions(connection)
+        CatalogChange.__table__.create(connection, checkfirst=True)
+        create_missing_indexes(connection)
+        has_search_table = inspect(connection).has_table('club_search')
+        if not has_search_table :
+            print("Creating the search index")
+            for statement in CLUB_SEARCH_DDL :
+                connection.execute(statement)
+
+    if not has_search_table :
+        rebuild_search_index()
+        db.session.commit()
+    clubs_fixed, tags_fixed = reconcile_counters()
+    print("Fixed %d club favorite counts and %d tag club counts." % (clubs_fixed, tags_fixed))
+
+if __name__ == '__main__':
+    print("Migrating db...")
+    migrate()
+    print("Finished migrating db.")
@@ -1,7 +1,6 @@
-from app import db
-from enum import Enum
-import datetime
-import bcrypt
+from database import db
+from sqlalchemy import event, DDL
+from hashing import password_hasher
 
 # Your database models should go here.
 # Check out the Flask-SQLAlchemy quickstart for some good docs!
@@ -9,14 +8,22 @@ import bcrypt
 
 """ Creating tables to be used by database. They include:
     tags: many-to-many table between club and tag
+    favorites: many-to-many table between club and user
+    Both are keyed on the pair of ids, so a link cannot be stored twice and looking up the links
+    of a club is an index range scan. A second index covers the reverse direction
+    (clubs of a tag, clubs favorited by a user)
 """
 clubs2tags = db.Table('clubs2tags',
-                db.Column('tag_id', db.String, db.ForeignKey('tag.name')),
-                db.Column('club_id', db.String(100), db.ForeignKey('club.code')))
+                db.Column('tag_id', db.String, db.ForeignKey('tag.name'), nullable=False),
+                db.Column('club_id', db.String(100), db.ForeignKey('club.code'), nullable=False),
+                db.PrimaryKeyConstraint('club_id', 'tag_id'),
+                db.Index('ix_clubs2tags_tag_id_club_id', 'tag_id', 'club_id'))
 
 favorites = db.Table('favorites',
-                db.Column('club_id', db.String(100), db.ForeignKey('club.code')),
-                db.Column('user_id', db.String, db.ForeignKey('user.email')))
+                db.Column('club_id', db.String(100), db.ForeignKey('club.code'), nullable=False),
+                db.Column('user_id', db.String, db.ForeignKey('user.email'), nullable=False),
+                db.PrimaryKeyConstraint('club_id', 'user_id'),
+                db.Index('ix_favorites_user_id_club_id', 'user_id', 'club_id'))
 
 class Club (db.Model):
     """
@@ -24,8 +31,10 @@ class Club (db.Model):
     optional inputs: description, tags
     """
     code = db.Column("code", db.String(100), nullable=False, primary_key = True)
-    name = db.Column("name", db.String(100), nullable=False)
+    name = db.Column("name", db.String(100), nullable=False, index=True)
     description = db.Column("description", db.String, nullable=True)
+    # number of users that favorited the club, kept in sync with the favorites table
+    fav_cnt = db.Column("fav_cnt", db.Integer, nullable=False, default=0, server_default="0")
 
     # we define relationships in club for many-to-many tables
     # to concentrate logic here
@@ -41,30 +50,91 @@ class Club (db.Model):
         self.fav_cnt = fav_cnt
 
 
+""" Full-text index over club name, description and tag names (sqlite fts5), maintained by search.py.
+    code is indexed only so that a club's row can be found without scanning the index,
+    searches are restricted to the other columns. Column weights for bm25 ranking are stored
+    as the table's default rank (code is ignored, then name, description, tags)
+"""
+CLUB_SEARCH_DDL = [
+    DDL("CREATE VIRTUAL TABLE IF NOT EXISTS club_search USING fts5("
+        "code, name, description, tags, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"),
+    DDL("INSERT INTO club_search(club_search, rank) VALUES ('rank', 'bm25(0.0, 10.0, 1.0, 5.0)')"),
+]
+for statement in CLUB_SEARCH_DDL :
+    event.listen(Club.__table__, 'after_create', statement)
+event.listen(Club.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS club_search"))
+
+
 class Tag (db.Model) :
     name = db.Column(db.String, nullable=False, primary_key=True, unique=True)
+    # number of clubs with the tag, kept in sync with the clubs2tags table
+    club_cnt = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     def __init__(self, name):
         self.name = name.lower()
+        self.club_cnt = 0
 
 
 class User (db.Model):
     # using emails as primary key because...
     email = db.Column(db.String, unique=True, nullable=False, primary_key=True)
+    # unique, so sqlite keeps an index on it for lookups by username
     username = db.Column(db.String, unique=True, nullable=False)
     password_hash = db.Column(db.String, unique=False, nullable=False)
-    session_key = db.Column(db.String(30), nullable=True)
-    session_expiration = db.Column(db.DateTime, nullable=True)
 
 
-    def __init__ (self, email, username, pw_plain, session_key=None,
-                                session_expiration =None) :
+    def __init__ (self, email, username, pw_plain) :
         self.email = email
         self.username = username
-        salt = bcrypt.gensalt()
-        self.password_hash = bcrypt.hashpw(pw_plain.encode('utf-8'), salt)
-        self.session_key = session_key
-        #session_expiration must be in the format of datetime strftime return
-        self.session_expiration = None if session_expiration is None \
-                                        else datetime.strptime(session_expiration)
+        # hashed on the password hashing pool, see hashing.py
+        self.password_hash = password_hasher.hash(pw_plain)
+
+
+class UserSession (db.Model) :
+    """
+    one row per logged in device, so a user can have several sessions at once (see sessions.py)
+    required inputs: key, user_id, expires_at
+    """
+    key = db.Column(db.String(64), nullable=False, primary_key=True)
+    user_id = db.Column(db.String, db.ForeignKey('user.email'), nullable=False, index=True)
+    # indexed so that the sweeper finds expired sessions without scanning the table
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__ (self, key, user_id, expires_at) :
+        self.key = key
+        self.user_id = user_id
+        self.expires_at = expires_at
+
+
+class CatalogChange (db.Model) :
+    """
+    append-only log of the clubs and tags changed by each commit, read by /api/changes (see changes.py).
+    AUTOINCREMENT, so a seq is never handed out twice even once compaction deleted the newest rows
+    """
+    __table_args__ = (db.Index('ix_catalog_change_kind_key', 'kind', 'key'), {'sqlite_autoincrement': True})
+    seq = db.Column(db.Integer, primary_key=True)
+    # 'club', 'tag' or 'reset'
+    kind = db.Column(db.String(8), nullable=False)
+    # the club code or tag name, '' for a reset
+    key = db.Column(db.String, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+
+""" Counter maintenance: every change to a club's favorites or tags collection updates
+    the matching counter in the same session, so it is committed in the same transaction
+"""
+@event.listens_for(Club.favorites, 'append')
+def increment_fav_cnt (club, user, initiator) :
+    club.fav_cnt = (club.fav_cnt or 0) + 1
+
+@event.listens_for(Club.favorites, 'remove')
+def decrement_fav_cnt (club, user, initiator) :
+    club.fav_cnt = (club.fav_cnt or 0) - 1
+
+@event.listens_for(Club.tags, 'append')
+def increment_club_cnt (club, tag, initiator) :
+    tag.club_cnt = (tag.club_cnt or 0) + 1
 
+@event.listens_for(Club.tags, 'remove')
+def decrement_club_cnt (club, tag, initiator) :
+    tag.club_cnt = (tag.club_cnt or 0) - 1
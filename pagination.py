@@ -0,0 +1,67 @@
+import base64
+import json
+from flask import current_app, jsonify
+
+""" Keyset (cursor) pagination
+    Collections are ordered by their primary key and a page is fetched with
+    "WHERE key > last_key ORDER BY key LIMIT n", which sqlite answers with a range scan on the
+    primary key index, so every page costs the same no matter how deep into the collection it is.
+    The cursor handed to clients is the last key of the page, base64 encoded so it stays opaque
+"""
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+class InvalidPage (ValueError) :
+    pass
+
+def encode_cursor (key) :
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+def decode_cursor (cursor) :
+    try :
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, UnicodeError) :
+        raise InvalidPage("invalid cursor")
+
+# reads the limit and cursor query parameters, raising InvalidPage if they are malformed
+def page_args (args) :
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try :
+        limit = int(limit)
+    except ValueError :
+        raise InvalidPage("limit must be an integer")
+    if limit < 1 :
+        raise InvalidPage("limit must be positive")
+
+    cursor = args.get('cursor')
+    after = None if cursor is None else decode_cursor(cursor)
+    return min(limit, MAX_PAGE_SIZE), after
+
+def paginate (query, key_column, after, limit) :
+    """
+    runs query restricted to the page after the given key,
+    returns the rows and the cursor of the next page (None on the last page)
+    """
+    if after is not None :
+        # the keys are strings, a cursor decoded to any other json value was not made by encode_cursor
+        if not isinstance(after, str) :
+            raise InvalidPage("invalid cursor")
+        query = query.filter(key_column > after)
+    rows = query.order_by(key_column).limit(limit + 1).all()
+    if len(rows) <= limit :
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(getattr(rows[-1], key_column.key))
+
+# json response for one page, the next cursor is sent in a header so the body keeps its shape.
+# body is either the value to serialize or json bytes that are already encoded
+def page_response (body, next_cursor) :
+    if isinstance(body, bytes) :
+        # jsonify ends its output with a newline too
+        response = current_app.response_class(body + b'\n', mimetype='application/json')
+    else :
+        response = jsonify(body)
+    if next_cursor is not None :
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return response, 200
@@ -0,0 +1,119 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+from werkzeug.serving import make_server
+
+from app import app, db, warm_up
+from catalog import catalog_version
+from engine import read_engine
+from sessions import session_sweeper
+from changes import change_log_compactor
+
+""" Preforked serving mode
+    The master process imports the app (models and mappers are set up at import, see app.py), warms the
+    caches once, binds the listening socket and forks PREFORK_WORKERS workers, which share the warmed
+    caches' memory copy-on-write and accept connections from the same socket. sqlite connections are not
+    carried across the fork: the master closes its pools first, and every worker opens its own during its
+    warm-up, before it accepts anything. Workers serve with the threaded server, or under uvicorn with
+    --asgi. They count commits on a shared catalog version (see catalog.py), so a write in one worker
+    invalidates the cached responses of all of them, and the others read which clubs it changed from the
+    change log, so their per club caches only drop those. Worker 0 also runs the session sweeper and the change log
+    compactor.
+    The master only watches: it restarts workers that die and stops them all on SIGTERM or SIGINT.
+    Caches that are not keyed by the catalog stay per worker: a logout reaches the other workers' session
+    caches within its ttl, and each worker rate limits on its own (see ratelimit.py).
+    Usage: python prefork.py [host] [port] [--workers N] [--asgi]
+"""
+PREFORK_WORKERS = int(os.environ.get('PREFORK_WORKERS', os.cpu_count() or 1))
+LISTEN_BACKLOG = 1024
+
+def listen (host, port) :
+    listener = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(LISTEN_BACKLOG)
+    listener.set_inheritable(True)
+    return listener
+
+def close_pools () :
+    """
+    closes the master's pooled connections, which must not be shared with the forked workers
+    """
+    with app.app_context() :
+        db.session.remove()
+        for engine in set([db.engine, read_engine(db.engine)]) :
+            engine.dispose()
+
+def serve (number, listener, use_asgi) :
+    """
+    the body of worker number, never returns
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    start = time.perf_counter()
+    warm_up(app, caches=False)
+    if number == 0 :
+        session_sweeper.start(app)
+        change_log_compactor.start(app)
+    print("worker %d (pid %d) ready in %.0f ms" % (number, os.getpid(), (time.perf_counter() - start) * 1000))
+    sys.stdout.flush()
+    try :
+        if use_asgi :
+            import uvicorn
+            from asgi import application
+            uvicorn.Server(uvicorn.Config(application, log_level='warning')).run(sockets=[listener])
+        else :
+            host, port = listener.getsockname()[:2]
+            make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+    finally :
+        os._exit(0)
+
+def spawn (number, listener, use_asgi) :
+    pid = os.fork()
+    if pid == 0 :
+        serve(number, listener, use_asgi)
+    return pid
+
+def main () :
+    parser = argparse.ArgumentParser(description="serve the app from preforked worker processes")
+    parser.add_argument('host', nargs='?', default='127.0.0.1')
+    parser.add_argument('port', nargs='?', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=PREFORK_WORKERS)
+    parser.add_argument('--asgi', action='store_true', help="serve each worker under uvicorn")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    timings = warm_up(app, connections=False)
+    close_pools()
+    catalog_version.share()
+    # bound once warm, so no connection waits in the backlog for the warm-up
+    listener = listen(args.host, args.port)
+    print("master warmed up in %.0f ms (caches %.0f ms), forking %d workers"
+          % ((time.perf_counter() - start) * 1000, timings['caches'] * 1000, args.workers))
+    sys.stdout.flush()
+
+    stopping = []
+    def stop (signum, frame) :
+        stopping.append(signum)
+        for pid in workers :
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # pid -> worker number
+    workers = {}
+    for number in range(args.workers) :
+        workers[spawn(number, listener, args.asgi)] = number
+    while workers :
+        pid, status = os.wait()
+        number = workers.pop(pid, None)
+        if number is not None and not stopping :
+            print("worker %d (pid %d) exited with status %d, restarting it" % (number, pid, status))
+            sys.stdout.flush()
+            workers[spawn(number, listener, args.asgi)] = number
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import abc
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import request
+
+from sessions import live_session
+
+""" Admission control
+    Every request takes tokens from a bucket of its client, refilled at RATE_LIMIT_RATE tokens per second
+    up to RATE_LIMIT_BURST. A route costs ROUTE_COSTS tokens (1 when not listed), so a client can poll the
+    catalog many times for each login it is allowed. A client is its session when the body has the key of a
+    live session (checked against the session cache and the sessions table), its address otherwise: logins,
+    signups, reads and requests with a made up or expired key are limited per address, so making up keys
+    does not buy fresh buckets. An empty bucket is answered with a 429.
+    On top of that, the routes in IN_FLIGHT_ROUTES share RATE_LIMIT_MAX_IN_FLIGHT slots across all clients,
+    so that many clients together cannot keep every thread busy with expensive requests either; a request
+    that finds no free slot is answered with a 503. Both carry a Retry-After header.
+    A client that ignores Retry-After would keep sending refused requests as fast as they are answered, and
+    a storm of cheap refusals still takes the cpu from everyone else. So a 429 is held for up to
+    RATE_LIMIT_TARPIT seconds before it is sent (up to RATE_LIMIT_MAX_TARPIT requests at a time, a sleeping
+    thread costs no cpu), which slows such a client down to about one request per connection per second.
+    The GETs asgi.py answers from the response cache on its event loop are admitted the same way, by address,
+    and their 429s are held by the loop, without a thread or a tarpit slot.
+    Buckets are kept by a backend; MemoryBackend keeps them in process memory (each server process limits
+    on its own), a backend shared between processes implements RateLimitBackend.take
+"""
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') != '0'
+RATE_LIMIT_RATE = float(os.environ.get('RATE_LIMIT_RATE', 20))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 200))
+RATE_LIMIT_MAX_IN_FLIGHT = int(os.environ.get('RATE_LIMIT_MAX_IN_FLIGHT', 16))
+# clients whose buckets MemoryBackend keeps, the least recently seen are forgotten (their bucket is full again)
+RATE_LIMIT_MAX_CLIENTS = int(os.environ.get('RATE_LIMIT_MAX_CLIENTS', 100000))
+RATE_LIMIT_TARPIT = float(os.environ.get('RATE_LIMIT_TARPIT', 1))
+# each held request keeps its thread, under asgi.py keep this well below ASGI_WORKERS
+RATE_LIMIT_MAX_TARPIT = int(os.environ.get('RATE_LIMIT_MAX_TARPIT', 16))
+# seconds a client is told to wait when every in-flight slot is taken
+IN_FLIGHT_RETRY_AFTER = 1
+
+# tokens taken by a request to each route, by url rule
+ROUTE_COSTS = {
+    # a bcrypt hash or verification
+    '/api/user/login': 20,
+    '/api/user/signup': 20,
+    '/api/clubs/search': 5,
+    '/api/clubs/favorite_users/export': 20,
+    '/api/clubs/batch': 10,
+    '/api/user/favoriting/bulk': 5,
+    '/api/user/recommendations': 2,
+    '/api/tag/query': 2,
+}
+IN_FLIGHT_ROUTES = frozenset(['/api/user/login', '/api/user/signup', '/api/clubs/search',
+                              '/api/clubs/favorite_users/export', '/api/clubs/batch'])
+# routes that do not authenticate with a session key, always limited by address
+ADDRESS_ROUTES = frozenset(['/api/user/login', '/api/user/signup'])
+
+# why a request was refused: the http status, a message and the seconds to wait before retrying
+Rejection = namedtuple('Rejection', ['status', 'message', 'retry_after'])
+
+class RateLimitBackend (abc.ABC) :
+    """
+    where token buckets are kept
+    """
+    @abc.abstractmethod
+    def take (self, key, cost, rate, burst) :
+        """
+        takes cost tokens from the bucket of key, which holds at most burst tokens and gains rate per second.
+        returns 0 if they were taken, or the seconds until the bucket will hold cost tokens
+        """
+
+    @abc.abstractmethod
+    def clear (self) :
+        pass
+
+    def stats (self) :
+        return {}
+
+class MemoryBackend (RateLimitBackend) :
+    def __init__ (self, max_clients=RATE_LIMIT_MAX_CLIENTS) :
+        self.max_clients = max_clients
+        # key -> [tokens, time they were counted], least recently seen first
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take (self, key, cost, rate, burst) :
+        now = time.monotonic()
+        with self._lock :
+            bucket = self._buckets.get(key)
+            if bucket is None :
+                bucket = self._buckets[key] = [burst, now]
+                if len(self._buckets) > self.max_clients :
+                    self._buckets.popitem(last=False)
+            else :
+                self._buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= cost :
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / rate
+
+    def clear (self) :
+        with self._lock :
+            self._buckets.clear()
+
+    def stats (self) :
+        with self._lock :
+            return {'clients': len(self._buckets)}
+
+class RateLimiter :
+    def __init__ (self, backend=None, rate=RATE_LIMIT_RATE, burst=RATE_LIMIT_BURST, route_costs=ROUTE_COSTS,
+                  max_in_flight=RATE_LIMIT_MAX_IN_FLIGHT, in_flight_routes=IN_FLIGHT_ROUTES, tarpit=RATE_LIMIT_TARPIT,
+                  max_tarpit=RATE_LIMIT_MAX_TARPIT, enabled=RATE_LIMIT_ENABLED) :
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.rate = rate
+        self.burst = burst
+        self.route_costs = route_costs
+        self.max_in_flight = max_in_flight
+        self.in_flight_routes = in_flight_routes
+        self.tarpit = tarpit
+        self.enabled = enabled
+        self._tarpit_slots = threading.BoundedSemaphore(max_tarpit)
+        self.in_flight = 0
+        self.limited = 0
+        self.overloaded = 0
+        self._lock = threading.Lock()
+
+    def admit (self, route, key) :
+        """
+        whether a request of client key to route may run: (None, holds a slot) if it may, (Rejection, False)
+        if not. A request that holds an in-flight slot must release it once it is done
+        """
+        if not self.enabled :
+            return None, False
+        # a cost above the burst could never be paid
+        wait = self.backend.take(key, min(self.route_costs.get(route, 1), self.burst), self.rate, self.burst)
+        if wait :
+            with self._lock :
+                self.limited += 1
+            return Rejection(429, "too many requests", max(1, math.ceil(wait))), False
+        if route not in self.in_flight_routes :
+            return None, False
+        with self._lock :
+            if self.in_flight >= self.max_in_flight :
+                self.overloaded += 1
+                return Rejection(503, "server busy", IN_FLIGHT_RETRY_AFTER), False
+            self.in_flight += 1
+        return None, True
+
+    def tarpit_delay (self, rejection) :
+        """
+        the seconds to hold the answer to a refused request, 0 to send it right away
+        """
+        if rejection.status != 429 or self.tarpit <= 0 :
+            return 0
+        return min(self.tarpit, rejection.retry_after)
+
+    def hold (self, rejection) :
+        """
+        delays the answer to a client over its rate, if a tarpit slot is free
+        """
+        delay = self.tarpit_delay(rejection)
+        if not delay or not self._tarpit_slots.acquire(blocking=False) :
+            return
+        try :
+            time.sleep(delay)
+        finally :
+            self._tarpit_slots.release()
+
+    def release (self) :
+        """
+        frees the in-flight slot of an admitted request
+        """
+        with self._lock :
+            self.in_flight -= 1
+
+    def clear (self) :
+        self.backend.clear()
+        with self._lock :
+            self.limited = 0
+            self.overloaded = 0
+
+    def stats (self) :
+        with self._lock :
+            stats = {'enabled': self.enabled,
+                     'in_flight': self.in_flight,
+                     'max_in_flight': self.max_in_flight,
+                     'limited': self.limited,
+                     'overloaded': self.overloaded}
+        stats.update(self.backend.stats())
+        return stats
+
+rate_limiter = RateLimiter()
+
+def client_key (route=None) :
+    """
+    the client of the current request to route: its session if the json body has the key of a live session
+    (and route authenticates with it), else its address
+    """
+    if request.method == 'POST' and route not in ADDRESS_ROUTES :
+        data = request.get_json(force=True, silent=True)
+        if isinstance(data, dict) and isinstance(data.get('session_key'), str) \
+           and live_session(data['session_key']) is not None :
+            return 'session:' + data['session_key']
+    return address_key(request.remote_addr)
+
+def address_key (address) :
+    """
+    the client of a request that is limited by its address
+    """
+    return 'address:' + (address or '')
@@ -0,0 +1,326 @@
+import heapq
+import math
+import os
+import threading
+from array import array
+from collections import Counter
+from itertools import chain
+from sqlalchemy import bindparam, event, text
+from sqlalchemy.orm import Session
+
+from database import db
+from catalog import ALL_CLUBS, on_catalog_change, on_catalog_sync
+from models import Club
+from serializers import chunked
+
+""" Co-favorite recommendations ("users who liked X also liked")
+    A sparse club x club matrix counts, for every pair of clubs, the users who favorited both. Each club's
+    row is kept as two parallel arrays (neighbor club numbers, counts) built at once from the favorites
+    table, plus a dict of the changes made by favoriting since then. Similarity is the cosine of two clubs'
+    sets of fans: co-favorites / sqrt(fans of X * fans of Y), so popular clubs do not top every list.
+    Users with more than MAX_USER_FAVORITES favorites are left out: they relate everything to everything,
+    and the pairs of their favorites would outnumber all the others. Users with a single favorite relate
+    nothing and are left out too.
+    The matrix is built on first use. Favoriting records the user's favorites before and after the change
+    in the session, and once the transaction commits the pairs of the changed clubs are added or removed.
+    Favoriting that commits while the matrix is being read may or may not be in what was read, so the rows
+    of its clubs are read again once the matrix is in place, like the clubs a catalog change names are
+    patched into the snapshot.
+    Each club's most similar clubs are computed when first asked for and kept until its row changes.
+    Favorites of deleted clubs stay in the matrix until it is rebuilt, lookups drop clubs that no longer exist.
+    The favoriting of other processes (see prefork.py) is not seen as it commits: the rows of the clubs they
+    changed are read again from the db, with their count in the rows of their neighbors, at the next lookup
+"""
+MAX_USER_FAVORITES = int(os.environ.get('RECOMMEND_MAX_USER_FAVORITES', 50))
+# length of the similar clubs list kept per club, the most a request can ask for
+MAX_SIMILAR = 100
+# session.info key holding the (before, after) favorites of the users changed in the current transaction
+FAVORITE_CHANGES = 'favorite_changes'
+# club codes are joined with the ascii unit separator, which no code contains
+SEPARATOR = '\x1f'
+
+# the favorites of every user that has 2 to :max favorites, as one string per user
+USER_BASKETS = text("SELECT group_concat(club_id, char(31)) FROM favorites "
+                    "GROUP BY user_id HAVING count(*) BETWEEN 2 AND :max")
+USER_FAVORITES = text("SELECT club_id FROM favorites WHERE user_id = :email LIMIT :limit")
+# the rows of the clubs :codes, as (club, other club, co-favorites) over the users that have 2 to :max favorites.
+# The row of a club has itself as other club, with the number of its fans
+CLUB_ROWS = text("""
+    SELECT mine.club_id, other.club_id, count(*) FROM favorites AS mine
+    JOIN favorites AS other ON other.user_id = mine.user_id
+    WHERE mine.club_id IN :codes AND mine.user_id IN (
+        SELECT user_id FROM favorites
+        WHERE user_id IN (SELECT user_id FROM favorites WHERE club_id IN :codes)
+        GROUP BY user_id HAVING count(*) BETWEEN 2 AND :max)
+    GROUP BY mine.club_id, other.club_id
+""").bindparams(bindparam('codes', expanding=True))
+
+class CoFavorites :
+    def __init__ (self, max_user_favorites=MAX_USER_FAVORITES) :
+        self.max_user_favorites = max_user_favorites
+        self._lock = threading.Lock()
+        # held while the matrix is built, so lookups wait for it instead of building it twice
+        self._build_lock = threading.Lock()
+        self.rebuilds = 0
+        self.clear()
+
+    def clear (self) :
+        """
+        empties the matrix, the next lookup rebuilds it
+        """
+        with self._lock :
+            # club number -> code, code -> number
+            self.codes = []
+            self.numbers = {}
+            # per club number: neighbor numbers and counts at the last build, changes since, number of fans
+            self.neighbors = []
+            self.counts = []
+            self.deltas = {}
+            self.fans = array('i')
+            # club number -> its most similar clubs as (score, -number), best first
+            self.similar = {}
+            # codes of the clubs whose rows are read again from the db at the next lookup
+            self.pending = set()
+            # whether the matrix or pending rows are being read from the db, see apply
+            self.reading = False
+            self.stale = True
+
+    def changed (self, codes) :
+        """
+        catalog listener: writes that cannot tell what they changed (counter repairs) rebuild the matrix
+        """
+        if codes is ALL_CLUBS :
+            with self._lock :
+                self.stale = True
+
+    def synced (self, codes) :
+        """
+        sync listener: the favorites other processes changed are not known here, so the rows of the clubs
+        they changed are recounted
+        """
+        with self._lock :
+            if codes is ALL_CLUBS :
+                self.stale = True
+            elif not self.stale :
+                self.pending.update(codes)
+
+    def refresh (self) :
+        with self._build_lock :
+            if self.stale :
+                self.rebuild()
+            self.recount()
+
+    def rebuild (self) :
+        with self._lock :
+            self.stale = False
+            # favoriting that commits during the read is recounted once it is done, see apply
+            self.reading = True
+            self.pending = set()
+        codes = [code for code, in db.session.query(Club.code).order_by(Club.code)]
+        numbers = {code: number for number, code in enumerate(codes)}
+        baskets = []
+        for joined, in db.session.execute(USER_BASKETS, {'max': self.max_user_favorites}) :
+            basket = list(map(numbers.get, joined.split(SEPARATOR)))
+            # favorites of clubs deleted without their favorites
+            if None in basket :
+                basket = [number for number in basket if number is not None]
+            baskets.append(basket)
+
+        # the row of a club counts the clubs in the baskets of its fans, summed in C by Counter
+        fans = [[] for _ in codes]
+        for user, basket in enumerate(baskets) :
+            for number in basket :
+                fans[number].append(user)
+        neighbors, counts = [], []
+        for number, users in enumerate(fans) :
+            row = Counter(chain.from_iterable([baskets[user] for user in users]))
+            row.pop(number, None)
+            neighbors.append(array('i', row.keys()))
+            counts.append(array('i', row.values()))
+
+        with self._lock :
+            self.codes, self.numbers, self.neighbors, self.counts = codes, numbers, neighbors, counts
+            self.fans = array('i', map(len, fans))
+            self.deltas = {}
+            self.similar = {}
+            self.rebuilds += 1
+
+    def recount (self) :
+        """
+        reads the rows of the pending clubs from the db, with the build lock held, until no favoriting that
+        committed during a read is left
+        """
+        while True :
+            with self._lock :
+                codes, self.pending = self.pending, set()
+                self.reading = bool(codes) and not self.stale
+                if not self.reading :
+                    return
+            self.read_rows(codes)
+
+    def read_rows (self, codes) :
+        rows = {code: {} for code in codes}
+        for batch in chunked(sorted(codes)) :
+            for code, other, count in db.session.execute(CLUB_ROWS, {'codes': batch,
+                                                                     'max': self.max_user_favorites}) :
+                rows[code][other] = count
+        with self._lock :
+            if self.stale :
+                return
+            for code, row in rows.items() :
+                if row or code in self.numbers :
+                    # clubs created since the build are numbered, favorites of deleted ones left out
+                    fans = row.pop(code, 0)
+                    row = {self.number(other): count for other, count in row.items()
+                           if other in self.numbers or other in rows}
+                    self.set_row(self.number(code), row, fans)
+
+    def set_row (self, number, row, fans) :
+        """
+        replaces the row of a club by row (neighbor number -> count) and its number of fans, and its count in
+        the rows of its neighbors, with the lock held
+        """
+        old = dict(zip(self.neighbors[number], self.counts[number]))
+        for neighbor, delta in self.deltas.pop(number, {}).items() :
+            old[neighbor] = old.get(neighbor, 0) + delta
+        # the matrix is symmetric, the count of the club in the row of a neighbor is its count in the old row
+        for neighbor in set(old) | set(row) :
+            change = row.get(neighbor, 0) - old.get(neighbor, 0)
+            if change :
+                deltas = self.deltas.setdefault(neighbor, {})
+                deltas[number] = deltas.get(number, 0) + change
+            # the scores of the neighbors depend on the fans of the club too
+            self.similar.pop(neighbor, None)
+        self.neighbors[number] = array('i', row.keys())
+        self.counts[number] = array('i', row.values())
+        self.fans[number] = fans
+        self.similar.pop(number, None)
+
+    def number (self, code) :
+        """
+        the number of a club, numbering it if it was created after the build, with the lock held
+        """
+        number = self.numbers.get(code)
+        if number is None :
+            number = self.numbers[code] = len(self.codes)
+            self.codes.append(code)
+            self.neighbors.append(array('i'))
+            self.counts.append(array('i'))
+            self.fans.append(0)
+        return number
+
+    # whether the favorites of a user are counted in the matrix
+    def counted (self, basket) :
+        return 1 < len(basket) <= self.max_user_favorites
+
+    def add_pairs (self, basket, changed, delta) :
+        """
+        adds delta to the counts of the pairs of clubs of basket that involve a club of changed
+        """
+        for x in basket :
+            row = self.deltas.setdefault(x, {})
+            for y in basket :
+                if x != y and (x in changed or y in changed) :
+                    row[y] = row.get(y, 0) + delta
+            self.similar.pop(x, None)
+        for x in changed :
+            self.fans[x] += delta
+
+    def apply (self, before, after) :
+        """
+        updates the matrix for a user whose favorites (sets of codes) went from before to after
+        """
+        with self._lock :
+            if self.stale :
+                return
+            if self.reading :
+                # the read may or may not have seen this commit, so the clubs whose pairs it changed are read
+                # again after it, instead of changing counts that are about to be replaced
+                both = self.counted(before) and self.counted(after)
+                self.pending.update(before ^ after if both else before | after)
+                return
+            before = set(self.number(code) for code in before)
+            after = set(self.number(code) for code in after)
+            if self.counted(before) and self.counted(after) :
+                self.add_pairs(before, before - after, -1)
+                self.add_pairs(after, after - before, 1)
+            else :
+                # the user crossed a limit, and starts or stops counting as a whole
+                if self.counted(before) :
+                    self.add_pairs(before, before, -1)
+                if self.counted(after) :
+                    self.add_pairs(after, after, 1)
+
+    def similar_numbers (self, number) :
+        """
+        the most similar clubs of a club as (score, -number), best first, with the lock held
+        """
+        similar = self.similar.get(number)
+        if similar is None :
+            row = dict(zip(self.neighbors[number], self.counts[number]))
+            for neighbor, delta in self.deltas.get(number, {}).items() :
+                row[neighbor] = row.get(neighbor, 0) + delta
+            fans = self.fans[number]
+            similar = self.similar[number] = heapq.nlargest(
+                MAX_SIMILAR, ((count / math.sqrt(max(fans * self.fans[neighbor], 1)), -neighbor)
+                              for neighbor, count in row.items() if count > 0))
+        return similar
+
+    def similar_clubs (self, code, limit=MAX_SIMILAR) :
+        """
+        codes of the clubs most favorited by the fans of a club, most similar first
+        """
+        self.refresh()
+        with self._lock :
+            number = self.numbers.get(code)
+            if number is None :
+                return []
+            return [self.codes[-neighbor] for _, neighbor in self.similar_numbers(number)[:limit]]
+
+    def recommended_clubs (self, favorite_codes, limit=MAX_SIMILAR) :
+        """
+        codes of the clubs most similar to a user's favorites, summing the similarity to each favorite,
+        without the favorites themselves. Only the first MAX_USER_FAVORITES favorites (by code) are used
+        """
+        self.refresh()
+        with self._lock :
+            favorites = set(self.numbers[code] for code in favorite_codes if code in self.numbers)
+            scores = {}
+            for number in sorted(favorites)[:self.max_user_favorites] :
+                for score, neighbor in self.similar_numbers(number) :
+                    if -neighbor not in favorites :
+                        scores[neighbor] = scores.get(neighbor, 0) + score
+            best = heapq.nlargest(limit, ((score, neighbor) for neighbor, score in scores.items()))
+            return [self.codes[-neighbor] for _, neighbor in best]
+
+    def stats (self) :
+        with self._lock :
+            return {'clubs': len(self.codes),
+                    'pairs': sum(map(len, self.neighbors)),
+                    'changed_pairs': sum(map(len, self.deltas.values())),
+                    'rebuilds': self.rebuilds}
+
+co_favorites = CoFavorites()
+on_catalog_change(co_favorites.changed)
+on_catalog_sync(co_favorites.synced)
+
+def favorites_changed (session, email, added=(), removed=()) :
+    """
+    records that the current transaction of session favorited (added) or unfavorited (removed) clubs for a user,
+    after the rows were written. The matrix is updated once the transaction commits
+    """
+    added, removed = set(added), set(removed)
+    # users far above the limit are not in the matrix before or after, their favorites need not be read
+    limit = co_favorites.max_user_favorites + len(added) + 1
+    after = set(code for code, in session.execute(USER_FAVORITES, {'email': email, 'limit': limit}))
+    if len(after) < limit :
+        session.info.setdefault(FAVORITE_CHANGES, []).append(((after - added) | removed, after))
+
+@event.listens_for(Session, 'after_commit')
+def apply_favorite_changes (session) :
+    for before, after in session.info.pop(FAVORITE_CHANGES, ()) :
+        co_favorites.apply(before, after)
+
+@event.listens_for(Session, 'after_soft_rollback')
+def forget_favorite_changes (session, previous_transaction) :
+    session.info.pop(FAVORITE_CHANGES, None)
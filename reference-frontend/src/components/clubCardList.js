@@ -1,13 +1,13 @@
 import React, { useEffect, useState } from 'react'
 import ClubCard from './clubCard'
+import fetchAllPages from '../fetchAllPages'
 
 function ClubCardList() {
     const [clubs, setClubs] = useState([])
 
     useEffect(() => {
-        fetch("/api/clubs")
-            .then(res => res.json())
-            .then((result) => setClubs(result.clubs))
+        fetchAllPages("/api/clubs?limit=1000")
+            .then((clubs) => setClubs(clubs))
     }, [])
 
     return (
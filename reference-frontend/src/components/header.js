@@ -1,5 +1,6 @@
 import React, { useEffect, useState } from 'react'
 import styled from 'styled-components'
+import fetchAllPages from '../fetchAllPages'
 
 const ClubsIntro = styled.div`
     padding-top: 30px;
@@ -29,9 +30,8 @@ function Header() {
     const [clubs, setClubs] = useState([])
 
     useEffect(() => {
-        fetch("/api/clubs")
-            .then(res => res.json())
-            .then((result) => setClubs(result.clubs))
+        fetchAllPages("/api/clubs?limit=1000")
+            .then((clubs) => setClubs(clubs))
     }, [])
 
     return (
@@ -0,0 +1,15 @@
+// The list endpoints return one page at a time and the cursor of the next page in the
+// X-Next-Cursor header. This follows the cursors and resolves to every item of the list.
+async function fetchAllPages(url) {
+    const items = []
+    let cursor = null
+    do {
+        const separator = url.includes("?") ? "&" : "?"
+        const res = await fetch(cursor === null ? url : url + separator + "cursor=" + encodeURIComponent(cursor))
+        items.push(...(await res.json()))
+        cursor = res.headers.get("X-Next-Cursor")
+    } while (cursor !== null)
+    return items
+}
+
+export default fetchAllPages
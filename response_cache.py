@@ -0,0 +1,179 @@
+import functools
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from flask import current_app, request
+from werkzeug.http import http_date
+
+from catalog import catalog_version
+from content_encoding import compressor, compressible, encoded_headers
+from pagination import NEXT_CURSOR_HEADER
+
+""" Conditional GET and a cache of rendered responses for the catalog endpoints
+    Clients polling the catalog get an ETag and a Last-Modified header with every response, derived
+    from the catalog version, and a request whose If-None-Match (or If-Modified-Since) is still current
+    is answered with an empty 304 before the view runs.
+    Other requests are served from a cache of rendered bodies keyed by (path, query string, catalog
+    version): a write bumps the version, so entries never have to be invalidated one by one, they
+    simply stop being asked for and are evicted least recently used first once the cache is full.
+    Only successful responses are cached. An entry also keeps its body compressed in each encoding clients
+    asked for (see content_encoding.py), compressed by the first such request
+"""
+MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+# headers of the rendered response that are kept in the cache with the body
+CACHED_HEADERS = (NEXT_CURSOR_HEADER,)
+
+# encoded: encoding -> the body compressed in it, filled as clients ask for them
+CachedResponse = namedtuple('CachedResponse', ['body', 'mimetype', 'headers', 'encoded'])
+
+def entry_size (entry) :
+    return len(entry.body) + sum(len(body) for body in entry.encoded.values())
+
+class ResponseCache :
+    def __init__ (self, max_bytes=MAX_BYTES) :
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get (self, key) :
+        with self._lock :
+            entry = self._entries.get(key)
+            if entry is None :
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put (self, key, entry) :
+        # a body bigger than the whole cache would evict everything and then itself
+        if len(entry.body) > self.max_bytes :
+            return
+        with self._lock :
+            previous = self._entries.pop(key, None)
+            if previous is not None :
+                self.size -= entry_size(previous)
+            self._entries[key] = entry
+            self.size += entry_size(entry)
+            self._evict()
+
+    def put_encoded (self, key, encoding, body) :
+        """
+        keeps body, the body of the entry of key compressed in encoding, with the entry if it is still cached
+        """
+        with self._lock :
+            entry = self._entries.get(key)
+            if entry is None or encoding in entry.encoded :
+                return
+            entry.encoded[encoding] = body
+            self.size += len(body)
+            self._evict()
+
+    def _evict (self) :
+        while self.size > self.max_bytes :
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= entry_size(evicted)
+
+    def clear (self) :
+        with self._lock :
+            self._entries.clear()
+            self.size = 0
+
+    def stats (self) :
+        with self._lock :
+            return {'entries': len(self._entries),
+                    'bytes': self.size,
+                    'max_bytes': self.max_bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'not_modified': self.not_modified}
+
+response_cache = ResponseCache()
+
+# validators of a response rendered at a catalog version; no-cache makes clients revalidate every time
+def version_headers (version, last_modified) :
+    return {'ETag': '"%s"' % catalog_version.etag(version),
+            'Last-Modified': http_date(last_modified),
+            'Cache-Control': 'no-cache'}
+
+# whether the client's copy, described by the conditional headers of the request, is still current
+def is_not_modified (etag, last_modified, if_none_match, if_modified_since) :
+    if if_none_match :
+        return if_none_match.contains_weak(etag)
+    return if_modified_since is not None and if_modified_since >= last_modified
+
+# the body of entry, cached under key, in the encoding negotiated with the client, and that encoding.
+# Each encoding is compressed once per entry
+def encoded_body (key, entry, accept_encoding) :
+    encoding = compressor.negotiate(accept_encoding, len(entry.body)) if compressible(entry.mimetype) else None
+    if encoding is None :
+        return entry.body, None
+    body = entry.encoded.get(encoding)
+    if body is None :
+        body = compressor.compress(entry.body, encoding)
+        response_cache.put_encoded(key, encoding, body)
+    return body, encoding
+
+def cached_response (path, query_string, if_none_match, if_modified_since, accept_encoding=None) :
+    """
+    the (status, headers, body, mimetype) of a GET that can be answered without running its view,
+    or None. Used by cached_get, and by the asgi server to answer without leaving the event loop
+    """
+    version, last_modified = catalog_version.get()
+    etag = catalog_version.etag(version)
+    headers = version_headers(version, last_modified)
+    if is_not_modified(etag, last_modified, if_none_match, if_modified_since) :
+        response_cache.not_modified += 1
+        if compressor.encodings :
+            headers['Vary'] = 'Accept-Encoding'
+        return 304, headers, b'', None
+    key = (path, query_string, version)
+    entry = response_cache.get(key)
+    if entry is None :
+        return None
+    body, encoding = encoded_body(key, entry, accept_encoding)
+    headers = dict(entry.headers, **headers)
+    if compressor.encodings and compressible(entry.mimetype) :
+        encoded_headers(headers, encoding)
+    return 200, headers, body, entry.mimetype
+
+def cached_get (view) :
+    """
+    decorator for GET views whose response only depends on the url and the catalog
+    """
+    @functools.wraps(view)
+    def wrapper (*args, **kwargs) :
+        # read before the view runs, so a cached body is never older than its version
+        version, last_modified = catalog_version.get()
+        accept_encoding = request.headers.get('Accept-Encoding')
+        cached = cached_response(request.path, request.query_string,
+                                 request.if_none_match, request.if_modified_since, accept_encoding)
+        if cached is not None :
+            status, headers, body, mimetype = cached
+            return current_app.response_class(body, status=status, headers=headers, mimetype=mimetype)
+
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code != 200 :
+            return response
+        entry = CachedResponse(body=response.get_data(),
+                               mimetype=response.mimetype,
+                               headers={name: response.headers[name] for name in CACHED_HEADERS
+                                        if name in response.headers},
+                               encoded={})
+        key = (request.path, request.query_string, version)
+        response_cache.put(key, entry)
+        headers = version_headers(version, last_modified)
+        if compressor.encodings and compressible(entry.mimetype) :
+            body, encoding = encoded_body(key, entry, accept_encoding)
+            if encoding is not None :
+                response.set_data(body)
+            encoded_headers(headers, encoding)
+        response.headers.update(headers)
+        return response
+    # lets the asgi server know the view can be answered by cached_response
+    wrapper.cached_get = True
+    return wrapper
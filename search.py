@@ -0,0 +1,110 @@
+import re
+from database import db
+from pagination import encode_cursor, InvalidPage, DEFAULT_PAGE_SIZE
+from sqlalchemy import bindparam, text
+
+""" Full-text club search
+    club_search (created with the club table in models.py) is an fts5 index over each club's
+    name, description and tag names. Every write path that changes one of those fields calls
+    index_clubs / unindex_clubs in the same transaction, so the index never lags behind the clubs
+"""
+# searches only look at these columns, code is indexed just to locate a club's row
+SEARCH_COLUMNS = '{name description tags}'
+
+INDEX_SELECT = """
+    INSERT INTO club_search(code, name, description, tags)
+    SELECT club.code, club.name, coalesce(club.description, ''),
+           coalesce(group_concat(clubs2tags.tag_id, ' '), '')
+    FROM club LEFT OUTER JOIN clubs2tags ON clubs2tags.club_id = club.code
+    %s GROUP BY club.code
+"""
+INDEX_ALL_CLUBS = text(INDEX_SELECT % "")
+INDEX_CLUBS = text(INDEX_SELECT % "WHERE club.code IN :codes") \
+                .bindparams(bindparam('codes', expanding=True))
+
+INSERT_ROW = text("INSERT INTO club_search(code, name, description, tags) "
+                  "VALUES (:code, :name, :description, :tags)")
+
+# the MATCH finds the candidate rows through the index, code = :code drops tokenizer false positives
+UNINDEX_CLUB = text("""
+    DELETE FROM club_search WHERE rowid IN (
+        SELECT rowid FROM club_search WHERE club_search MATCH :match
+    ) AND code = :code
+""")
+
+# quotes a string as an fts5 phrase, so that its content is never parsed as query syntax
+def fts_phrase (string) :
+    return '"' + string.replace('"', '""') + '"'
+
+def fts_query (search_string) :
+    """
+    turns user input into a prefix query over SEARCH_COLUMNS where every word has to match,
+    returns None if the input has no searchable words
+    """
+    words = re.findall(r'\w+', search_string.lower())
+    if not words :
+        return None
+    return SEARCH_COLUMNS + ' : (' + ' '.join(fts_phrase(word) + '*' for word in words) + ')'
+
+def unindex_clubs (codes) :
+    for code in codes :
+        if re.search(r'\w', code) is None :
+            # codes without any word character cannot be matched, fall back to a scan
+            db.session.execute(text("DELETE FROM club_search WHERE code = :code"), {'code': code})
+        else :
+            db.session.execute(UNINDEX_CLUB, {'match': 'code : ' + fts_phrase(code), 'code': code})
+
+def index_clubs (codes) :
+    """
+    (re)indexes the clubs with the given codes from their current rows, pending changes included
+    """
+    codes = list(codes)
+    if not codes :
+        return
+    db.session.flush()
+    unindex_clubs(codes)
+    db.session.execute(INDEX_CLUBS, {'codes': codes})
+
+def insert_search_rows (clubs) :
+    """
+    indexes clubs that are not indexed yet from dicts with their code, name, description and tag names,
+    for callers that already have the data at hand (bulk imports)
+    """
+    rows = [{'code': club['code'],
+             'name': club['name'],
+             'description': club['description'] or '',
+             'tags': ' '.join(club['tags'])} for club in clubs]
+    if rows :
+        db.session.execute(INSERT_ROW, rows)
+
+def rebuild_search_index () :
+    db.session.flush()
+    db.session.execute(text("DELETE FROM club_search"))
+    db.session.execute(INDEX_ALL_CLUBS)
+
+def search_club_codes (search_string, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    codes of the clubs matching search_string, best bm25 rank first.
+    Pages are keyed on (rank, code), so the cursor of a page is the rank and code of its last club
+    """
+    match = fts_query(search_string)
+    if match is None :
+        return [], None
+
+    statement = "SELECT code, rank FROM club_search WHERE club_search MATCH :match"
+    params = {'match': match, 'limit': limit + 1}
+    if after is not None :
+        # [rank, code], anything else would reach the query as a bound parameter
+        if not isinstance(after, list) or len(after) != 2 or isinstance(after[0], bool) \
+           or not isinstance(after[0], (int, float)) or not isinstance(after[1], str) :
+            raise InvalidPage("invalid cursor")
+        statement += " AND (rank > :rank OR (rank = :rank AND code > :code))"
+        params['rank'], params['code'] = after
+    statement += " ORDER BY rank, code LIMIT :limit"
+
+    rows = db.session.execute(text(statement), params).fetchall()
+    if len(rows) <= limit :
+        return [code for code, _ in rows], None
+    rows = rows[:limit]
+    last_code, last_rank = rows[-1]
+    return [code for code, _ in rows], encode_cursor([last_rank, last_code])
@@ -0,0 +1,159 @@
+import heapq
+import time
+
+from database import db
+from catalog import catalog_version
+from fragments import SHAPES, encode, fragment_cache, json_array
+from metrics import metrics
+from models import Club, User, clubs2tags, favorites
+from pagination import paginate, DEFAULT_PAGE_SIZE
+
+""" SERIALIZERS
+    Every list endpoint builds its response through the functions below so that the number of
+    queries per request stays fixed, no matter how many clubs or tags are returned:
+    counts are read from the counter columns and tags are loaded in batched IN queries.
+    Lists are served one keyset page at a time (see pagination.py), so every function takes
+    the key to start after and the page size, and returns the page with the next cursor.
+    Lists of clubs are returned as json bytes, concatenated from the cached fragments of the clubs
+    (see fragments.py); tags are only loaded for the clubs whose fragment is missing.
+    The catalog lists (clubs, tags, clubs of a tag, clubs by code) are read from the in-memory catalog
+    snapshot (see snapshot.py) the route passes in, and issue no query at all
+"""
+# sqlite limits the number of bound parameters per statement, so IN lists are sent in chunks
+IN_BATCH_SIZE = 500
+
+# yields successive slices of a list of keys
+def chunked (keys, size=IN_BATCH_SIZE) :
+    for start in range(0, len(keys), size) :
+        yield keys[start:start + size]
+
+# maps club code -> list of tag names, loading the tags of all clubs at once
+def tags_by_club (codes) :
+    tags = {code: [] for code in codes}
+    for batch in chunked(list(tags)) :
+        rows = db.session.query(clubs2tags.c.club_id, clubs2tags.c.tag_id) \
+                         .filter(clubs2tags.c.club_id.in_(batch)).all()
+        for club_id, tag_name in rows :
+            tags[club_id].append(tag_name)
+    return tags
+
+# the json fragments, in shape, of the clubs of rows, in order; rows start with the code and have
+# the shape's other fields except tags, and must have been read at catalog version (or later)
+def club_fragments (shape, rows, version) :
+    fields = SHAPES[shape]
+    fragments = fragment_cache.get_many(shape, [row[0] for row in rows])
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+    if missing :
+        tags = tags_by_club([rows[i][0] for i in missing]) if 'tags' in fields else None
+        start = time.perf_counter()
+        keys = rows[0]._fields
+        # columns read but not shown in this shape
+        hidden = [key for key in keys if key not in fields]
+        encoded = {}
+        for i in missing :
+            club = dict(zip(keys, rows[i]))
+            if tags is not None :
+                club['tags'] = tags[club['code']]
+            for key in hidden :
+                del club[key]
+            fragments[i] = encoded[club['code']] = encode(club)
+        metrics.add_time('serialization', time.perf_counter() - start)
+        fragment_cache.put_many(shape, encoded, version)
+    return fragments
+
+# the json fragments, in shape, of the ClubRecords of a snapshot, in order
+def record_fragments (shape, records, version) :
+    fields = SHAPES[shape]
+    fragments = fragment_cache.get_many(shape, [record.code for record in records])
+    missing = [i for i, fragment in enumerate(fragments) if fragment is None]
+    if missing :
+        start = time.perf_counter()
+        encoded = {}
+        for i in missing :
+            record = records[i]
+            fragments[i] = encoded[record.code] = encode({field: getattr(record, field) for field in fields})
+        metrics.add_time('serialization', time.perf_counter() - start)
+        fragment_cache.put_many(shape, encoded, version)
+    return fragments
+
+def club_summaries (snapshot, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    code, name and favorite count of every club (no query)
+    """
+    records, next_cursor = snapshot.club_page(after, limit)
+    return json_array(record_fragments('summary', records, snapshot.version)), next_cursor
+
+def club_details (*criteria, after=None, limit=DEFAULT_PAGE_SIZE, shape='full') :
+    """
+    full description of the clubs matching criteria, including tags (1 query + 1 per IN batch of uncached clubs)
+    """
+    version, _ = catalog_version.get()
+    query = db.session.query(Club.code, Club.name, Club.description, Club.fav_cnt)
+    if criteria :
+        query = query.filter(*criteria)
+    rows, next_cursor = paginate(query, Club.code, after, limit)
+    return json_array(club_fragments(shape, rows, version)), next_cursor
+
+def clubs_by_code (snapshot, codes, shape) :
+    """
+    the clubs with the given codes in shape, in the order of codes, skipping unknown codes (no query)
+    """
+    return json_array(record_fragments(shape, snapshot.clubs_by_code(codes), snapshot.version))
+
+def club_details_by_code (snapshot, codes) :
+    """
+    full description of the clubs with the given codes, in the order of codes (no query)
+    """
+    return clubs_by_code(snapshot, codes, 'full')
+
+def user_favorite_club_details (user, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    clubs favorited by a user, in the same shape as club_details but without favorite counts
+    """
+    favorited = db.session.query(favorites.c.club_id) \
+                          .filter(favorites.c.user_id == user.email)
+    return club_details(Club.code.in_(favorited), after=after, limit=limit, shape='details')
+
+def tags_with_club_cnt (snapshot, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    name and club count of every tag (no query)
+    """
+    tags, next_cursor = snapshot.tag_page(after, limit)
+    return [{'name': name, 'cnt': cnt} for name, cnt in tags], next_cursor
+
+def favorite_users (club, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    email and username of every user that favorited a club (1 query)
+    """
+    query = db.session.query(User.email, User.username) \
+                      .join(favorites, favorites.c.user_id == User.email) \
+                      .filter(favorites.c.club_id == club.code)
+    rows, next_cursor = paginate(query, User.email, after, limit)
+    return [{'email': email, 'username': username} for email, username in rows], next_cursor
+
+def favorite_users_export (codes, batch_size=1000) :
+    """
+    (email, username) of every user that favorited any of the clubs, once each, in email order.
+    Each club's favorites are read in primary key order through a cursor that fetches batch_size rows
+    at a time (yield_per), and the sorted streams are merged, so memory does not grow with the clubs' size
+    """
+    streams = [db.session.query(User.email, User.username)
+                         .join(favorites, favorites.c.user_id == User.email)
+                         .filter(favorites.c.club_id == code)
+                         .order_by(favorites.c.user_id)
+                         .yield_per(batch_size)
+               for code in codes]
+    previous = None
+    for email, username in heapq.merge(*streams, key=lambda row : row[0]) :
+        if email != previous :
+            yield email, username
+            previous = email
+
+def tag_club_summaries (snapshot, tag_name, after=None, limit=DEFAULT_PAGE_SIZE) :
+    """
+    code and name of every club with a tag, (None, None) if there is no such tag (no query)
+    """
+    records, next_cursor = snapshot.tag_club_page(tag_name, after, limit)
+    if records is None :
+        return None, None
+    return json_array(record_fragments('brief', records, snapshot.version)), next_cursor
@@ -0,0 +1,61 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+""" In-process cache of session keys for authenticate_post
+    Maps a session key to the user it belongs to and the session's expiration, so that authenticated
+    requests usually do not touch the database at all. Entries are evicted least recently used first
+    once the cache is full, and are dropped after a short ttl so that a logout served by another
+    process is noticed within ttl seconds. logout and login invalidate the entries they replace
+"""
+MAX_SESSIONS = 10000
+TTL_SECONDS = 60
+
+# what authenticate_post hands to the handlers: the logged in user and when their session ends
+SessionUser = namedtuple('SessionUser', ['email', 'username', 'expiration'])
+
+class SessionCache :
+    def __init__ (self, max_size=MAX_SESSIONS, ttl=TTL_SECONDS) :
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # session key -> (SessionUser, time the entry was cached)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get (self, session_key) :
+        with self._lock :
+            entry = self._entries.get(session_key)
+            if entry is not None and time.monotonic() - entry[1] < self.ttl :
+                self._entries.move_to_end(session_key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None :
+                del self._entries[session_key]
+            self.misses += 1
+            return None
+
+    def put (self, session_key, session_user) :
+        with self._lock :
+            self._entries[session_key] = (session_user, time.monotonic())
+            self._entries.move_to_end(session_key)
+            while len(self._entries) > self.max_size :
+                self._entries.popitem(last=False)
+
+    def invalidate (self, session_key) :
+        with self._lock :
+            self._entries.pop(session_key, None)
+
+    def clear (self) :
+        with self._lock :
+            self._entries.clear()
+
+    def stats (self) :
+        with self._lock :
+            return {'size': len(self._entries),
+                    'max_size': self.max_size,
+                    'hits': self.hits,
+                    'misses': self.misses}
+
+session_cache = SessionCache()
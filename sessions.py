@@ -0,0 +1,152 @@
+import datetime
+import logging
+import os
+import secrets
+import threading
+
+from database import db
+from models import User, UserSession
+from session_cache import session_cache, SessionUser
+
+""" Login sessions
+    Every login or signup adds a row to the user_session table, so a user stays logged in on each of
+    their devices until that device logs out or its session expires. Keys are drawn from the secrets
+    module (SESSION_KEY_BYTES random bytes, url-safe base64). A user keeps at most MAX_USER_SESSIONS
+    sessions, a new login ends their oldest ones beyond that.
+    Expired sessions are refused when they are looked up and deleted by a background sweeper every
+    SESSION_SWEEP_INTERVAL seconds, SESSION_SWEEP_BATCH rows per transaction so the write lock is only
+    held briefly, found through the index on expires_at
+"""
+SESSION_LIFETIME = datetime.timedelta(hours=24)
+SESSION_KEY_BYTES = 32
+MAX_USER_SESSIONS = int(os.environ.get('MAX_USER_SESSIONS', 20))
+# 0 disables the sweeper
+SESSION_SWEEP_INTERVAL = float(os.environ.get('SESSION_SWEEP_INTERVAL', 300))
+SESSION_SWEEP_BATCH = int(os.environ.get('SESSION_SWEEP_BATCH', 1000))
+
+logger = logging.getLogger('clubreview.sessions')
+
+def new_session_key () :
+    return secrets.token_urlsafe(SESSION_KEY_BYTES)
+
+def start_session (email, now=None) :
+    """
+    adds a session for the user to db.session, to be committed by the caller, and returns its key
+    """
+    now = now or datetime.datetime.now()
+    # the oldest sessions beyond the limit make room for the new one
+    ended = [key for key, in db.session.query(UserSession.key).filter(UserSession.user_id == email)
+                                       .order_by(UserSession.expires_at.desc()).offset(MAX_USER_SESSIONS - 1)]
+    if ended :
+        db.session.query(UserSession).filter(UserSession.key.in_(ended)).delete(synchronize_session=False)
+        for key in ended :
+            session_cache.invalidate(key)
+    key = new_session_key()
+    db.session.add(UserSession(key=key, user_id=email, expires_at=now + SESSION_LIFETIME))
+    return key
+
+def end_session (key) :
+    """
+    deletes a session in db.session, to be committed by the caller. The user's other sessions are kept
+    """
+    session_cache.invalidate(key)
+    db.session.query(UserSession).filter(UserSession.key == key).delete(synchronize_session=False)
+
+def find_session (key) :
+    """
+    the SessionUser of a session key, or None if there is no such session
+    """
+    row = db.session.query(User.email, User.username, UserSession.expires_at) \
+                    .join(UserSession, UserSession.user_id == User.email) \
+                    .filter(UserSession.key == key).first()
+    if row is None :
+        return None
+    return SessionUser(email=row.email, username=row.username, expiration=row.expires_at)
+
+def live_session (key, now=None) :
+    """
+    the SessionUser of a session key that has not expired, from the session cache or else the db,
+    or None if there is no such session
+    """
+    session_user = session_cache.get(key)
+    if session_user is None :
+        session_user = find_session(key)
+        if session_user is None :
+            return None
+        session_cache.put(key, session_user)
+    if (now or datetime.datetime.now()) >= session_user.expiration :
+        session_cache.invalidate(key)
+        return None
+    return session_user
+
+def sweep_batch (now, batch_size) :
+    """
+    deletes and commits up to batch_size sessions that expired before now, returns how many
+    """
+    expired = db.session.query(UserSession.key).filter(UserSession.expires_at < now).limit(batch_size)
+    count = db.session.query(UserSession).filter(UserSession.key.in_(expired.subquery().select())) \
+                                         .delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def sweep_expired_sessions (now=None, batch_size=SESSION_SWEEP_BATCH) :
+    """
+    deletes the sessions that expired before now, batch_size per transaction, returns how many
+    """
+    now = now or datetime.datetime.now()
+    deleted = 0
+    while True :
+        count = sweep_batch(now, batch_size)
+        deleted += count
+        if count < batch_size :
+            return deleted
+
+class SessionSweeper :
+    def __init__ (self, interval=SESSION_SWEEP_INTERVAL, batch_size=SESSION_SWEEP_BATCH) :
+        self.interval = interval
+        self.batch_size = batch_size
+        self.swept = 0
+        self.sweeps = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start (self, flask_app) :
+        """
+        sweeps every interval seconds on a daemon thread, within an app context of flask_app
+        """
+        if self.interval <= 0 or self._thread is not None :
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, args=(flask_app,), name='session-sweeper', daemon=True)
+        self._thread.start()
+
+    def stop (self) :
+        self._stop.set()
+        if self._thread is not None :
+            self._thread.join()
+            self._thread = None
+
+    def run (self, flask_app) :
+        while not self._stop.wait(self.interval) :
+            with flask_app.app_context() :
+                try :
+                    self.sweep()
+                except Exception :
+                    # a locked db is retried at the next interval
+                    logger.exception("session sweep failed")
+                    db.session.rollback()
+                finally :
+                    db.session.remove()
+
+    def sweep (self) :
+        swept = sweep_expired_sessions(batch_size=self.batch_size)
+        self.swept += swept
+        self.sweeps += 1
+        return swept
+
+    def stats (self) :
+        return {'interval': self.interval,
+                'sweeps': self.sweeps,
+                'swept': self.swept}
+
+session_sweeper = SessionSweeper()
@@ -0,0 +1,292 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+from sqlalchemy import select
+
+from database import db
+from catalog import ALL_CLUBS, catalog_version, on_catalog_change
+from models import Club, Tag, clubs2tags
+from pagination import encode_cursor, InvalidPage, DEFAULT_PAGE_SIZE
+from serializers import chunked
+
+""" Immutable in-memory catalog snapshot
+    The catalog read endpoints (/api/clubs, /api/tag, /api/tag/search, and the clubs of a search or a tag
+    query) are answered from a snapshot of the clubs, tags, club-tag links and favorite counts instead of
+    the db. A snapshot is never changed once built: clubs are ClubRecords (__slots__, no per object dict)
+    in code order, codes and tag names are interned so every record, index and cached fragment shares one
+    copy of each, and the clubs of each tag are an array of club positions (ints of 8 bytes, not objects),
+    which are also in code order.
+    The snapshot follows the catalog like the tag index: each commit reports the clubs it changed (see
+    catalog.py) and the next read patches them into a new snapshot, reading only their rows, or rebuilds
+    it when too many clubs (or all of them) changed. A patch shares everything it did not change with the
+    snapshot it was made from. The new snapshot replaces the old one in a single assignment, so a request
+    reads one consistent snapshot without taking any lock, even while the next one is being made
+"""
+# a refresh of more clubs than this fraction of the snapshot (and than REBUILD_MIN_CLUBS) rebuilds it instead
+REBUILD_FRACTION = 0.1
+REBUILD_MIN_CLUBS = 1000
+
+class ClubRecord :
+    __slots__ = ('code', 'name', 'description', 'fav_cnt', 'tags')
+
+    def __init__ (self, code, name, description, fav_cnt, tags) :
+        self.code = sys.intern(code)
+        self.name = name
+        self.description = description
+        self.fav_cnt = fav_cnt
+        # the tag names in name order, as the club's tags have always been served
+        self.tags = tuple(sys.intern(tag) for tag in tags)
+
+# the key after which a page starts, which the snapshot compares with codes and tag names
+def page_start (keys, after) :
+    if after is None :
+        return 0
+    if not isinstance(after, str) :
+        raise InvalidPage("invalid cursor")
+    return bisect_right(keys, after)
+
+class CatalogSnapshot :
+    """
+    the catalog at a catalog version; must not be modified, a change makes a new snapshot (see patched)
+    """
+    __slots__ = ('version', 'codes', 'clubs', 'positions', 'tag_names', 'tag_numbers', 'tag_counts', 'tag_clubs')
+
+    def __init__ (self, version, codes, clubs, positions, tag_names, tag_numbers, tag_counts, tag_clubs) :
+        self.version = version
+        # club codes, the ClubRecords in the same order, code -> position
+        self.codes = codes
+        self.clubs = clubs
+        self.positions = positions
+        # tag names in order, tag name -> number, club count and array of club positions of each tag number
+        self.tag_names = tag_names
+        self.tag_numbers = tag_numbers
+        self.tag_counts = tag_counts
+        self.tag_clubs = tag_clubs
+
+    @classmethod
+    def assemble (cls, version, clubs, tag_counts) :
+        """
+        the snapshot of clubs (ClubRecords in code order) and tag_counts (tag name -> club count)
+        """
+        codes = tuple(club.code for club in clubs)
+        tag_names = tuple(sorted(sys.intern(name) for name in tag_counts))
+        tag_numbers = {name: number for number, name in enumerate(tag_names)}
+        tag_clubs = [array('q') for _ in tag_names]
+        for position, club in enumerate(clubs) :
+            for tag in club.tags :
+                number = tag_numbers.get(tag)
+                if number is not None :
+                    tag_clubs[number].append(position)
+        return cls(version, codes, tuple(clubs), {code: position for position, code in enumerate(codes)},
+                   tag_names, tag_numbers, array('q', (tag_counts[name] for name in tag_names)), tuple(tag_clubs))
+
+    def patched (self, version, codes, records, tag_counts) :
+        """
+        a snapshot where the clubs with the given codes are replaced by records (code -> ClubRecord, clubs
+        left out were deleted) and tag_counts (tag name -> club count, or None if the tag was deleted)
+        """
+        # a club created and deleted again between two refreshes is in neither
+        codes = [code for code in codes if code in self.positions or code in records]
+        added_or_deleted = any((code in self.positions) != (code in records) for code in codes)
+        new_tags = any((name in self.tag_numbers) != (count is not None) for name, count in tag_counts.items())
+        if added_or_deleted or new_tags :
+            # positions or tag numbers change, so the tags' club arrays are regrouped
+            clubs = [club for club in self.clubs if club.code not in codes]
+            clubs.extend(records.values())
+            clubs.sort(key=attrgetter('code'))
+            counts = dict(zip(self.tag_names, self.tag_counts))
+            for name, count in tag_counts.items() :
+                if count is None :
+                    counts.pop(name, None)
+                else :
+                    counts[name] = count
+            return CatalogSnapshot.assemble(version, clubs, counts)
+
+        clubs = list(self.clubs)
+        # tag number -> (positions added, positions removed)
+        moved = {}
+        for code in codes :
+            position = self.positions[code]
+            old, new = set(self.clubs[position].tags), set(records[code].tags)
+            clubs[position] = records[code]
+            for tag in new - old :
+                if tag in self.tag_numbers :
+                    moved.setdefault(self.tag_numbers[tag], (set(), set()))[0].add(position)
+            for tag in old - new :
+                if tag in self.tag_numbers :
+                    moved.setdefault(self.tag_numbers[tag], (set(), set()))[1].add(position)
+        tag_clubs = list(self.tag_clubs)
+        for number, (added, removed) in moved.items() :
+            tag_clubs[number] = array('q', sorted(set(tag_clubs[number]).union(added).difference(removed)))
+        counts = array('q', self.tag_counts)
+        for name, count in tag_counts.items() :
+            counts[self.tag_numbers[name]] = count
+        return CatalogSnapshot(version, self.codes, tuple(clubs), self.positions,
+                               self.tag_names, self.tag_numbers, counts, tuple(tag_clubs))
+
+    def club (self, code) :
+        position = self.positions.get(code)
+        return None if position is None else self.clubs[position]
+
+    def clubs_by_code (self, codes) :
+        """
+        the records of the clubs with the given codes, in the order of codes, skipping unknown codes
+        """
+        positions = self.positions
+        return [self.clubs[positions[code]] for code in codes if code in positions]
+
+    def club_page (self, after=None, limit=DEFAULT_PAGE_SIZE) :
+        """
+        the records of the clubs after the code after, in code order, and the cursor of the next page
+        """
+        start = page_start(self.codes, after)
+        clubs = self.clubs[start:start + limit]
+        if start + limit >= len(self.clubs) :
+            return clubs, None
+        return clubs, encode_cursor(clubs[-1].code)
+
+    def tag_page (self, after=None, limit=DEFAULT_PAGE_SIZE) :
+        """
+        (name, club count) of the tags after the name after, in name order, and the cursor of the next page
+        """
+        start = page_start(self.tag_names, after)
+        tags = list(zip(self.tag_names[start:start + limit], self.tag_counts[start:start + limit]))
+        if start + limit >= len(self.tag_names) :
+            return tags, None
+        return tags, encode_cursor(tags[-1][0])
+
+    def tag_club_page (self, tag, after=None, limit=DEFAULT_PAGE_SIZE) :
+        """
+        the records of the clubs with a tag after the code after, in code order, and the cursor of the
+        next page; None if there is no such tag
+        """
+        number = self.tag_numbers.get(tag)
+        if number is None :
+            return None, None
+        members = self.tag_clubs[number]
+        # club positions are in code order too
+        start = bisect_left(members, page_start(self.codes, after))
+        clubs = [self.clubs[position] for position in members[start:start + limit]]
+        if start + limit >= len(members) :
+            return clubs, None
+        return clubs, encode_cursor(clubs[-1].code)
+
+    def stats (self) :
+        return {'version': self.version,
+                'clubs': len(self.clubs),
+                'tags': len(self.tag_names),
+                'links': sum(len(members) for members in self.tag_clubs)}
+
+EMPTY_SNAPSHOT = CatalogSnapshot.assemble(0, [], {})
+
+# the ClubRecords of the clubs with the given codes (all of them when None) from the db, in code order.
+# Read with core selects, a rebuild takes twice as long through orm queries
+def load_clubs (codes=None) :
+    clubs = select(Club.code, Club.name, Club.description, Club.fav_cnt).order_by(Club.code)
+    links = select(clubs2tags.c.club_id, clubs2tags.c.tag_id).order_by(clubs2tags.c.club_id, clubs2tags.c.tag_id)
+    if codes is not None :
+        clubs = clubs.where(Club.code.in_(codes))
+        links = links.where(clubs2tags.c.club_id.in_(codes))
+    tags = {}
+    for club_id, tag_id in db.session.execute(links) :
+        tags.setdefault(club_id, []).append(tag_id)
+    return [ClubRecord(code, name, description, fav_cnt, tags.get(code, ()))
+            for code, name, description, fav_cnt in db.session.execute(clubs)]
+
+class LiveSnapshot :
+    """
+    holds the snapshot of the current catalog
+    """
+    def __init__ (self) :
+        self._lock = threading.Lock()
+        # held while the snapshot is read from the db, so refreshes apply in the order they read
+        self._refresh_lock = threading.Lock()
+        self.rebuilds = 0
+        self.patches = 0
+        self.refresh_seconds = 0.0
+        self.clear()
+
+    def clear (self) :
+        """
+        drops the snapshot, the next read rebuilds it
+        """
+        with self._lock :
+            self.snapshot = EMPTY_SNAPSHOT
+            self.stale = True
+            self.pending = set()
+
+    def changed (self, codes) :
+        """
+        catalog listener, the clubs are read again by the next refresh
+        """
+        with self._lock :
+            if codes is ALL_CLUBS :
+                self.stale = True
+            else :
+                self.pending.update(codes)
+
+    def get (self) :
+        """
+        the current snapshot, refreshed with the changes committed since the last read
+        """
+        # a refresh in progress may already have taken the pending changes
+        if self.stale or self.pending or self._refresh_lock.locked() :
+            self.refresh()
+        return self.snapshot
+
+    def refresh (self) :
+        with self._refresh_lock :
+            with self._lock :
+                stale, pending = self.stale, self.pending
+                self.stale, self.pending = False, set()
+            if not stale and not pending :
+                return
+            start = time.perf_counter()
+            # read before the rows, so the snapshot is never newer than its version says
+            version, _ = catalog_version.get()
+            try :
+                if stale or len(pending) > max(REBUILD_FRACTION * len(self.snapshot.clubs), REBUILD_MIN_CLUBS) :
+                    snapshot = self.rebuild(version)
+                    self.rebuilds += 1
+                else :
+                    snapshot = self.patch(version, pending)
+                    self.patches += 1
+            except Exception :
+                # the changes taken are not in the snapshot yet, the next read tries again
+                with self._lock :
+                    self.stale = self.stale or stale
+                    self.pending.update(pending)
+                raise
+            self.snapshot = snapshot
+            self.refresh_seconds = time.perf_counter() - start
+
+    def rebuild (self, version) :
+        tag_counts = dict(db.session.execute(select(Tag.name, Tag.club_cnt).order_by(Tag.name)).fetchall())
+        return CatalogSnapshot.assemble(version, load_clubs(), tag_counts)
+
+    def patch (self, version, codes) :
+        records = {}
+        for batch in chunked(sorted(codes)) :
+            records.update((club.code, club) for club in load_clubs(batch))
+        # the tags whose club count may have changed, None for the ones that no longer exist
+        tag_counts = {}
+        for code in codes :
+            club = self.snapshot.club(code)
+            tag_counts.update((tag, None) for tag in (club.tags if club is not None else ()))
+            tag_counts.update((tag, None) for tag in (records[code].tags if code in records else ()))
+        for batch in chunked(sorted(tag_counts)) :
+            tag_counts.update(db.session.execute(select(Tag.name, Tag.club_cnt).where(Tag.name.in_(batch))).fetchall())
+        return self.snapshot.patched(version, codes, records, tag_counts)
+
+    def stats (self) :
+        stats = self.snapshot.stats()
+        stats.update({'rebuilds': self.rebuilds,
+                      'patches': self.patches,
+                      'last_refresh_ms': round(self.refresh_seconds * 1000, 3)})
+        return stats
+
+catalog_snapshot = LiveSnapshot()
+on_catalog_change(catalog_snapshot.changed)
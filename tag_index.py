@@ -0,0 +1,262 @@
+import heapq
+import re
+import threading
+
+from database import db
+from catalog import ALL_CLUBS, on_catalog_change
+from models import Club, clubs2tags
+from pagination import encode_cursor, InvalidPage, DEFAULT_PAGE_SIZE
+from serializers import chunked
+from snapshot import catalog_snapshot
+
+""" In-memory tag index
+    Clubs are numbered densely (in code order when the index is built, new clubs are appended) and
+    every tag maps to a bitset of the numbers of its clubs, held in a python int, so a boolean tag
+    expression is evaluated with a few big-integer AND/OR/NOT operations instead of queries, and the
+    number of matches per tag (facets) is one AND and one popcount per tag.
+    The index is built from the catalog snapshot (see snapshot.py) on first use, whose clubs are already
+    numbered in code order with the clubs of each tag listed. After that it follows the catalog: each commit
+    reports the clubs it changed (see catalog.py) and the next query reloads only their tag links,
+    or rebuilds the whole index when too many clubs (or all of them) changed.
+    Expressions are tag names combined with AND, OR, NOT and parentheses, e.g.
+    "Undergraduate AND Athletics NOT Pre-Professional"; a NOT directly after a term means AND NOT.
+    Operators are upper case, so tag names made of several words need no quoting
+"""
+# a refresh of more clubs than this fraction of the index (and than REBUILD_MIN_CLUBS) rebuilds it instead
+REBUILD_FRACTION = 0.1
+REBUILD_MIN_CLUBS = 1000
+OPERATORS = ('AND', 'OR', 'NOT')
+TOKENS = re.compile(r'\(|\)|"[^"]*"|[^\s()"]+')
+
+class InvalidTagQuery (ValueError) :
+    pass
+
+# int.bit_count is python 3.10+
+popcount = getattr(int, 'bit_count', None) or (lambda bits : bin(bits).count('1'))
+
+# positions of the set bits of every byte value
+BYTE_BITS = [tuple(i for i in range(8) if byte >> i & 1) for byte in range(256)]
+
+# numbers of the set bits of a bitset, in increasing order
+def set_bits (bits) :
+    numbers = []
+    for offset, byte in enumerate(bits.to_bytes((bits.bit_length() + 7) // 8, 'little')) :
+        if byte :
+            numbers.extend(offset * 8 + i for i in BYTE_BITS[byte])
+    return numbers
+
+# the bitset of a list of numbers, built in a bytearray since every | on an int copies it
+def bitset (numbers, size) :
+    data = bytearray((size + 7) // 8)
+    for number in numbers :
+        data[number >> 3] |= 1 << (number & 7)
+    return int.from_bytes(data, 'little')
+
+class TagQueryParser :
+    """
+    parses an expression into nested tuples: ('tag', name), ('not', e), ('and', a, b), ('or', a, b)
+        expression := term (OR term)*
+        term       := unary (AND unary | unary starting with NOT)*
+        unary      := NOT unary | '(' expression ')' | name
+        name       := one or more words or "quoted strings", joined with spaces
+    """
+    def __init__ (self, expression) :
+        self.tokens = TOKENS.findall(expression)
+        self.position = 0
+
+    def parse (self) :
+        if not self.tokens :
+            raise InvalidTagQuery("empty tag query")
+        tree = self.expression()
+        if self.peek() is not None :
+            raise InvalidTagQuery("unexpected %s in tag query" % self.peek())
+        return tree
+
+    def peek (self) :
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take (self) :
+        self.position += 1
+        return self.tokens[self.position - 1]
+
+    def expression (self) :
+        tree = self.term()
+        while self.peek() == 'OR' :
+            self.take()
+            tree = ('or', tree, self.term())
+        return tree
+
+    def term (self) :
+        tree = self.unary()
+        while self.peek() in ('AND', 'NOT') :
+            if self.peek() == 'AND' :
+                self.take()
+            tree = ('and', tree, self.unary())
+        return tree
+
+    def unary (self) :
+        token = self.peek()
+        if token == 'NOT' :
+            self.take()
+            return ('not', self.unary())
+        if token == '(' :
+            self.take()
+            tree = self.expression()
+            if self.peek() != ')' :
+                raise InvalidTagQuery("missing ) in tag query")
+            self.take()
+            return tree
+        words = []
+        while self.peek() is not None and self.peek() not in OPERATORS + ('(', ')') :
+            words.append(self.take().strip('"'))
+        if not words :
+            raise InvalidTagQuery("expected a tag name %s" % ("at the end" if token is None else "before " + token))
+        return ('tag', ' '.join(words).lower())
+
+class TagIndex :
+    def __init__ (self) :
+        self._lock = threading.Lock()
+        # held while the index is read from the db, so refreshes apply in the order they read
+        self._refresh_lock = threading.Lock()
+        self.rebuilds = 0
+        self.clear()
+
+    def clear (self) :
+        """
+        empties the index, the next query rebuilds it
+        """
+        with self._lock :
+            # club number -> code (None once deleted), code -> number
+            self.codes = []
+            self.numbers = {}
+            # bitset of the numbers in use, tag name -> bitset, club number -> its tag names
+            self.clubs = 0
+            self.tags = {}
+            self.club_tags = {}
+            self.stale = True
+            self.pending = set()
+
+    def changed (self, codes) :
+        """
+        catalog listener, the clubs are reloaded on the next query
+        """
+        with self._lock :
+            if codes is ALL_CLUBS :
+                self.stale = True
+            else :
+                self.pending.update(codes)
+
+    def refresh (self) :
+        """
+        applies the changes committed since the last refresh, before any other query of the request,
+        so that the reads see every commit that reported its clubs
+        """
+        with self._refresh_lock :
+            with self._lock :
+                stale, pending = self.stale, self.pending
+                self.stale, self.pending = False, set()
+            if stale or len(pending) > max(REBUILD_FRACTION * len(self.numbers), REBUILD_MIN_CLUBS) :
+                self.rebuild()
+            elif pending :
+                self.update(pending)
+
+    def rebuild (self) :
+        snapshot = catalog_snapshot.get()
+        codes = list(snapshot.codes)
+        numbers = dict(snapshot.positions)
+        tags = {name: bitset(snapshot.tag_clubs[number], len(codes)) for number, name in enumerate(snapshot.tag_names)}
+        club_tags = {}
+        for number, club in enumerate(snapshot.clubs) :
+            known = set(tag for tag in club.tags if tag in tags)
+            if known :
+                club_tags[number] = known
+        with self._lock :
+            self.codes, self.numbers, self.club_tags, self.tags = codes, numbers, club_tags, tags
+            self.clubs = (1 << len(codes)) - 1
+            self.rebuilds += 1
+
+    def update (self, codes) :
+        """
+        reloads the tags of the clubs with the given codes, adding new clubs and dropping deleted ones
+        """
+        codes = list(codes)
+        existing = set()
+        links = {}
+        for batch in chunked(codes) :
+            existing.update(code for code, in db.session.query(Club.code).filter(Club.code.in_(batch)))
+            for club_id, tag_id in db.session.query(clubs2tags.c.club_id, clubs2tags.c.tag_id) \
+                                            .filter(clubs2tags.c.club_id.in_(batch)) :
+                links.setdefault(club_id, set()).add(tag_id)
+
+        with self._lock :
+            for code in codes :
+                number = self.numbers.get(code)
+                if number is None :
+                    if code not in existing :
+                        continue
+                    number = self.numbers[code] = len(self.codes)
+                    self.codes.append(code)
+                    self.clubs |= 1 << number
+                elif code not in existing :
+                    del self.numbers[code]
+                    self.codes[number] = None
+                    self.clubs &= ~(1 << number)
+
+                bit = 1 << number
+                old_tags = self.club_tags.pop(number, set())
+                new_tags = links.get(code, set())
+                for tag in old_tags - new_tags :
+                    self.tags[tag] &= ~bit
+                for tag in new_tags - old_tags :
+                    self.tags[tag] = self.tags.get(tag, 0) | bit
+                if new_tags :
+                    self.club_tags[number] = new_tags
+
+    def evaluate (self, tree) :
+        """
+        the bitset of the clubs matching a parsed expression, with the lock held
+        """
+        kind = tree[0]
+        if kind == 'tag' :
+            if tree[1] not in self.tags :
+                raise InvalidTagQuery("tag does not exist: %s" % tree[1])
+            return self.tags[tree[1]]
+        if kind == 'not' :
+            return self.clubs & ~self.evaluate(tree[1])
+        if kind == 'and' :
+            return self.evaluate(tree[1]) & self.evaluate(tree[2])
+        return self.evaluate(tree[1]) | self.evaluate(tree[2])
+
+    def query (self, expression, after=None, limit=DEFAULT_PAGE_SIZE) :
+        """
+        codes of the clubs matching a tag expression, in code order, one page after the code after.
+        returns (codes, next cursor, number of matches, facets), facets map every tag to its number
+        of matching clubs (tags without any are left out)
+        """
+        tree = TagQueryParser(expression).parse()
+        if after is not None and not isinstance(after, str) :
+            raise InvalidPage("invalid cursor")
+        self.refresh()
+        with self._lock :
+            matches = self.evaluate(tree)
+            facets = {}
+            for tag, members in self.tags.items() :
+                count = popcount(members & matches)
+                if count :
+                    facets[tag] = count
+            codes = [self.codes[number] for number in set_bits(matches)]
+
+        page = heapq.nsmallest(limit + 1, codes if after is None else (code for code in codes if code > after))
+        if len(page) <= limit :
+            return page, None, len(codes), facets
+        page = page[:limit]
+        return page, encode_cursor(page[-1]), len(codes), facets
+
+    def stats (self) :
+        with self._lock :
+            return {'clubs': len(self.numbers),
+                    'tags': len(self.tags),
+                    'rebuilds': self.rebuilds}
+
+tag_index = TagIndex()
+on_catalog_change(tag_index.changed)
@@ -1,9 +1,116 @@
+import os
+# cheap password hashes keep the tests fast, the cost factor itself is tested below
+os.environ.setdefault('BCRYPT_ROUNDS', '4')
+# the tests send far more requests per second than a client may, the rate limit is tested on its own below
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
 import unittest
+import datetime
+import time
 import json
+import base64
+import gzip
+import tempfile
+import asyncio
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 import bootstrap
 from bootstrap import session_key
 from app import app, db, DB_FILE
-from models import User, Club, Tag
+from models import User, Club, Tag, UserSession, CatalogChange
+from catalog import catalog_changed
+from session_cache import session_cache
+from hashing import password_hasher
+from response_cache import response_cache
+from fragments import fragment_cache
+from tag_index import tag_index
+from snapshot import catalog_snapshot
+from recommendations import co_favorites, MAX_USER_FAVORITES
+from engine import read_engine
+from metrics import metrics
+from ratelimit import rate_limiter
+
+# maximum number of sql statements each list endpoint may issue, no matter how many rows it returns,
+# once the catalog snapshot is current (the catalog lists are read from it, see snapshot.py)
+QUERY_BUDGETS = {
+    '/api/clubs': 0,
+    '/api/clubs/search?string=penn': 1,
+    '/api/clubs/favorite_users?code=pppjo': 2,
+    '/api/user/favorite_clubs?username=josh': 3,
+    '/api/tag': 0,
+    '/api/tag/search?tag=Undergraduate': 0,
+}
+# statements of a rebuild of the catalog snapshot: clubs, their tags and the tags' counts
+SNAPSHOT_REBUILD_STATEMENTS = 3
+
+# records every sql statement sent to the database inside the with block, by the write and the read engines
+@contextmanager
+def count_queries(with_parameters=False):
+    statements = []
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if executemany:
+            parameters = parameters[0]
+        statements.append((statement, parameters) if with_parameters else statement)
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
+
+# every endpoint with a request that exercises its queries, in an order that keeps each request valid
+QUERY_PLAN_REQUESTS = [
+    ('GET', '/api/clubs', None),
+    ('GET', '/api/clubs?limit=2&cursor=ImxvcmVtLWlwc3VtIg==', None),
+    ('GET', '/api/clubs/search?string=penn', None),
+    ('GET', '/api/clubs/favorite_users?code=pppjo', None),
+    ('GET', '/api/clubs/favorite_users?name=Penn%20Memes%20Club', None),
+    ('GET', '/api/clubs/favorite_users/export?code=pppjo&code=pppp', None),
+    ('GET', '/api/user?username=josh', None),
+    ('GET', '/api/user/favorite_clubs?username=josh', None),
+    ('GET', '/api/user/favorite_clubs?email=josh@upenn.edu', None),
+    ('GET', '/api/tag', None),
+    ('GET', '/api/tag/search?tag=undergraduate', None),
+    ('GET', '/api/changes?since=1', None),
+    ('POST', '/api/clubs/create', dict(code='pppal', name='Penn Pal', tags=['Literary', 'New'])),
+    ('POST', '/api/clubs/modify', dict(code='pppal', name='Penn Pal',
+                                       new_data={'name': 'Penn Pals', 'tags': ['Graduate']})),
+    ('POST', '/api/clubs/batch', dict(create=[{'code': 'batch', 'name': 'Batch', 'tags': ['Academic']}],
+                                      modify=[{'code': 'batch', 'name': 'Batch', 'new_data': {'tags': []}}],
+                                      delete=[{'code': 'pppal', 'name': 'Penn Pals'}])),
+    ('POST', '/api/user/favoriting', dict(code='pppjo')),
+    ('POST', '/api/user/favoriting/bulk', dict(codes=['pppjo', 'lorem-ipsum', 'nothing'])),
+    ('POST', '/api/user/unfavoriting', dict(code='lorem-ipsum')),
+    ('POST', '/api/clubs/delete', dict(code='pppjo', name='Penn Pre-Professional Juggling Organization')),
+    ('POST', '/api/user/signup', dict(email='bqle@upenn.edu', username='bqle', password='bqleiscool')),
+    ('POST', '/api/user/login', dict(email='andy@upenn.edu', password='andyiscool')),
+    ('POST', '/api/user/logout', dict()),
+]
+
+# lines of the query plan of a statement that read a whole table instead of using an index
+def full_scans(statement, parameters):
+    connection = db.engine.raw_connection()
+    try:
+        plan = connection.cursor().execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall()
+    finally:
+        connection.close()
+    return [row[3] for row in plan
+            if row[3].startswith('SCAN ') and ' USING ' not in row[3] and 'VIRTUAL TABLE' not in row[3]]
+
+# sends one request through the asgi adapter, returns (status, headers, body)
+def asgi_request(adapter, method, path, query_string=b'', body=b'', headers=()):
+    scope = {'type': 'http', 'method': method, 'path': path, 'query_string': query_string,
+             'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+             'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1)}
+    messages = []
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    async def send(message):
+        messages.append(message)
+    # a hung adapter fails the test instead of the whole run
+    asyncio.run(asyncio.wait_for(adapter(scope, receive, send), 10))
+    response_headers = dict((name.decode('latin-1'), value.decode('latin-1')) for name, value in messages[0]['headers'])
+    return messages[0]['status'], response_headers, b''.join(message['body'] for message in messages[1:])
 
 class BasicTests(unittest.TestCase):
     # executed prior to each test
@@ -14,6 +121,14 @@ class BasicTests(unittest.TestCase):
         app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{DB_FILE}"
 
         self.app = app.test_client()
+        session_cache.clear()
+        response_cache.clear()
+        fragment_cache.clear()
+        tag_index.clear()
+        catalog_snapshot.clear()
+        co_favorites.clear()
+        metrics.reset()
+        rate_limiter.clear()
         db.drop_all()
         db.create_all()
         bootstrap.create_user()
@@ -210,6 +325,75 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 406)
         print("Success\n")
 
+    def test_user_favoriting_idempotent(self):
+        print("Testing /api/user/favoriting twice counts once")
+        for _ in range(2):
+            response = self.app.post('/api/user/favoriting',data=json.dumps(dict(
+                session_key= session_key,
+                code= 'pppjo'
+            )))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Club.query.get('pppjo').fav_cnt, 1)
+        self.assertEqual(db.session.execute("SELECT count(*) FROM favorites").scalar(), 1)
+        print("Success")
+
+        print("Testing /api/user/favoriting does not load the club's favorites")
+        for i in range(200):
+            db.session.execute("INSERT INTO favorites (club_id, user_id) VALUES ('pppjo', :email)",
+                               {'email': 'fan%d@upenn.edu' % i})
+        db.session.commit()
+        db.session.execute("DELETE FROM favorites WHERE user_id = 'josh@upenn.edu'")
+        db.session.commit()
+        with count_queries() as statements:
+            response = self.app.post('/api/user/favoriting',data=json.dumps(dict(
+                session_key= session_key,
+                code= 'pppjo'
+            )))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('FROM user, favorites' in statement for statement in statements))
+        # session, insert, count, and the change log row
+        self.assertLessEqual(len(statements), 5)
+        print("Success")
+
+        print("Testing /api/user/unfavoriting")
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppp')))
+        for _ in range(2):
+            response = self.app.post('/api/user/unfavoriting',data=json.dumps(dict(
+                session_key= session_key,
+                code= 'pppp'
+            )))
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(Club.query.get('pppp').fav_cnt, 0)
+        response = self.app.post('/api/user/unfavoriting',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'ppcool'
+        )))
+        self.assertEqual(response.status_code, 406)
+        print("Success\n")
+
+    def test_user_favoriting_bulk(self):
+        print("Testing /api/user/favoriting/bulk")
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+        response = self.app.post('/api/user/favoriting/bulk',data=json.dumps(dict(
+            session_key= session_key,
+            codes= ['pppjo', 'pppp', 'ppcool', 'lorem-ipsum', 'pppp']
+        )))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data['favorited'], ['pppp', 'lorem-ipsum'])
+        self.assertEqual(data['unknown'], ['ppcool'])
+        for code in ['pppjo', 'pppp', 'lorem-ipsum']:
+            self.assertEqual(Club.query.get(code).fav_cnt, 1)
+        print("Success")
+
+        print("Testing /api/user/favoriting/bulk invalid body")
+        response = self.app.post('/api/user/favoriting/bulk',data=json.dumps(dict(
+            session_key= session_key,
+            codes= 'pppjo'
+        )))
+        self.assertEqual(response.status_code, 406)
+        print("Success\n")
+
     def test_user_favorite_clubs(self):
         print("Testing /api/user/favorite_clubs valid")
         response = self.app.get('/api/user/favorite_clubs?username=josh')
@@ -327,5 +511,1380 @@ class BasicTests(unittest.TestCase):
         self.assertEqual(response.status_code, 404)
         print("Success\n")
 
+    def test_query_budgets(self):
+        print("Testing query budgets of list endpoints")
+        # grow the catalog so that per-row queries would show up in the counts
+        josh = User.query.filter_by(email='josh@upenn.edu').first()
+        undergraduate = Tag.query.filter_by(name='undergraduate').first()
+        for i in range(50):
+            club = Club(code='penn-club-%d' % i, name='Penn Club %d' % i)
+            club.tags.append(undergraduate)
+            club.favorites.append(josh)
+            db.session.add(club)
+        db.session.commit()
+        # the lists are read from the catalog snapshot, built once
+        with count_queries() as statements:
+            catalog_snapshot.get()
+        self.assertEqual(len(statements), SNAPSHOT_REBUILD_STATEMENTS)
+
+        for url, budget in QUERY_BUDGETS.items():
+            with count_queries() as statements:
+                response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(statements), budget, url)
+        print("Success\n")
+
+    def test_serialized_counts(self):
+        print("Testing favorite and tag counts in list endpoints")
+        josh = User.query.filter_by(email='josh@upenn.edu').first()
+        andy = User.query.filter_by(email='andy@upenn.edu').first()
+        pppjo_club = Club.query.filter_by(code='pppjo').first()
+        pppjo_club.favorites.append(josh)
+        pppjo_club.favorites.append(andy)
+        db.session.commit()
+
+        clubs = {club['code']: club for club in json.loads(self.app.get('/api/clubs').data)}
+        self.assertEqual(clubs['pppjo']['fav_cnt'], 2)
+        self.assertEqual(clubs['locustlabs']['fav_cnt'], 0)
+
+        tags = {tag['name']: tag['cnt'] for tag in json.loads(self.app.get('/api/tag').data)}
+        self.assertEqual(tags['undergraduate'], 4)
+        self.assertEqual(tags['technology'], 1)
+
+        response = self.app.get('/api/user/favorite_clubs?username=josh')
+        clubs = json.loads(response.data)
+        self.assertEqual(len(clubs), 1)
+        self.assertEqual(sorted(clubs[0]['tags']), ['athletics', 'pre-professional', 'undergraduate'])
+        print("Success\n")
+
+    def test_counters(self):
+        print("Testing counters follow favoriting, modify and delete")
+        response = self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'pppjo'
+        )))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Club.query.filter_by(code='pppjo').first().fav_cnt, 1)
+
+        response = self.app.post('/api/clubs/modify',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'pppjo',
+            name= 'Penn Pre-Professional Juggling Organization',
+            new_data={
+                'name': 'Penn Pre-Professional Juggling Organization',
+                'tags': ['Undergraduate', 'Technology']
+            }
+        )))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Tag.query.filter_by(name='athletics').first().club_cnt, 0)
+        self.assertEqual(Tag.query.filter_by(name='technology').first().club_cnt, 2)
+        self.assertEqual(Tag.query.filter_by(name='undergraduate').first().club_cnt, 4)
+
+        response = self.app.post('/api/clubs/delete',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'pppjo',
+            name= 'Penn Pre-Professional Juggling Organization',
+        )))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Tag.query.filter_by(name='technology').first().club_cnt, 1)
+        self.assertEqual(Tag.query.filter_by(name='undergraduate').first().club_cnt, 3)
+        print("Success")
+
+        print("Testing counter reconciliation")
+        import counters
+        Club.query.filter_by(code='locustlabs').first().fav_cnt = 42
+        Tag.query.filter_by(name='literary').first().club_cnt = 0
+        db.session.commit()
+        self.assertEqual(counters.reconcile_counters(), (1, 1))
+        self.assertEqual(Club.query.filter_by(code='locustlabs').first().fav_cnt, 0)
+        self.assertEqual(Tag.query.filter_by(name='literary').first().club_cnt, 2)
+        self.assertEqual(counters.reconcile_counters(), (0, 0))
+        print("Success\n")
+
+    def test_pagination(self):
+        print("Testing /api/clubs pages follow the next cursor")
+        codes = []
+        url = '/api/clubs?limit=2'
+        while url is not None:
+            response = self.app.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = json.loads(response.data)
+            self.assertLessEqual(len(page), 2)
+            codes += [club['code'] for club in page]
+            cursor = response.headers.get('X-Next-Cursor')
+            url = None if cursor is None else '/api/clubs?limit=2&cursor=' + cursor
+        self.assertEqual(codes, sorted(['pppjo', 'lorem-ipsum', 'penn-memes', 'pppp', 'locustlabs']))
+        print("Success")
+
+        print("Testing /api/tag/search last page has no cursor")
+        response = self.app.get('/api/tag/search?tag=Undergraduate&limit=3')
+        self.assertEqual(len(json.loads(response.data)['clubs']), 3)
+        cursor = response.headers['X-Next-Cursor']
+        response = self.app.get('/api/tag/search?tag=Undergraduate&limit=3&cursor=' + cursor)
+        self.assertEqual(len(json.loads(response.data)['clubs']), 1)
+        self.assertNotIn('X-Next-Cursor', response.headers)
+        print("Success")
+
+        print("Testing /api/tag invalid limit and cursor")
+        self.assertEqual(self.app.get('/api/tag?limit=0').status_code, 406)
+        self.assertEqual(self.app.get('/api/tag?limit=ten').status_code, 406)
+        self.assertEqual(self.app.get('/api/tag?cursor=!!!').status_code, 406)
+        print("Success")
+
+        print("Testing cursors that decode to something other than a key")
+        for key in [{}, [1], 1, None]:
+            cursor = base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+            for url in ['/api/clubs/favorite_users?code=pppjo', '/api/user/favorite_clubs?username=josh']:
+                status = self.app.get(url + '&cursor=' + cursor).status_code
+                # a null cursor is the same as no cursor
+                self.assertEqual(status, 200 if key is None else 406, (url, key))
+        print("Success\n")
+
+    def test_clubs_search_full_text(self):
+        print("Testing /api/clubs/search matches descriptions, tags and prefixes")
+        response = self.app.get('/api/clubs/search?string=juggl')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['pppjo'])
+        response = self.app.get('/api/clubs/search?string=technology')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['locustlabs'])
+        response = self.app.get('/api/clubs/search?string=memes')
+        data = json.loads(response.data)
+        self.assertEqual(data[0]['code'], 'penn-memes')
+        self.assertEqual(sorted(data[0]['tags']), ['graduate', 'literary'])
+        print("Success")
+
+        print("Testing /api/clubs/search ranks name matches first")
+        self.app.post('/api/clubs/create',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'jugglers',
+            name='Penn Jugglers',
+            description='We throw things',
+        )))
+        response = self.app.get('/api/clubs/search?string=juggl')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['jugglers', 'pppjo'])
+        response = self.app.get('/api/clubs/search?string=juggl&limit=1')
+        cursor = response.headers['X-Next-Cursor']
+        response = self.app.get('/api/clubs/search?string=juggl&limit=1&cursor=' + cursor)
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['pppjo'])
+        for key in [[{}, []], ['-1', 'pppjo'], [-1, 5], [True, 'pppjo'], 'pppjo']:
+            cursor = base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+            response = self.app.get('/api/clubs/search?string=juggl&cursor=' + cursor)
+            self.assertEqual(response.status_code, 406, key)
+        print("Success")
+
+        print("Testing /api/clubs/search follows modify and delete")
+        self.app.post('/api/clubs/modify',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'jugglers',
+            name= 'Penn Jugglers',
+            new_data={'name': 'Penn Throwers', 'tags': ['Athletics']}
+        )))
+        response = self.app.get('/api/clubs/search?string=juggl')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['pppjo'])
+        response = self.app.get('/api/clubs/search?string=throwers athletics')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['jugglers'])
+        self.app.post('/api/clubs/delete',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'jugglers',
+            name= 'Penn Throwers',
+        )))
+        response = self.app.get('/api/clubs/search?string=throwers')
+        self.assertEqual(json.loads(response.data), [])
+        print("Success")
+
+        print("Testing /api/clubs/search without a string")
+        self.assertEqual(self.app.get('/api/clubs/search').status_code, 406)
+        self.assertEqual(json.loads(self.app.get('/api/clubs/search?string=%22*').data), [])
+        print("Success\n")
+
+    def test_session_cache(self):
+        print("Testing authenticated posts hit the session cache")
+        # the first request looks the session up and caches it
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'locustlabs'
+        )))
+        hits, misses = session_cache.hits, session_cache.misses
+        for code in ['pppjo', 'pppp']:
+            with count_queries() as statements:
+                response = self.app.post('/api/user/favoriting',data=json.dumps(dict(
+                    session_key= session_key,
+                    code= code
+                )))
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(any('user_session.key = ?' in statement for statement in statements))
+        self.assertEqual(session_cache.misses - misses, 0)
+        self.assertEqual(session_cache.hits - hits, 2)
+        stats = json.loads(self.app.get('/api/stats').data)['session_cache']
+        self.assertGreaterEqual(stats['size'], 1)
+        print("Success")
+
+        print("Testing logout invalidates the cached session")
+        response = self.app.post('/api/user/logout',data=json.dumps(dict(
+            session_key=session_key
+        )))
+        self.assertEqual(response.status_code, 200)
+        response = self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key= session_key,
+            code= 'pppjo'
+        )))
+        self.assertEqual(response.status_code, 404)
+        print("Success")
+
+        print("Testing a new login keeps the sessions of other devices")
+        response = self.app.post('/api/user/login',data=json.dumps(dict(
+            email='andy@upenn.edu',
+            password= 'andyiscool'
+        )))
+        first_key = json.loads(response.data)['session_key']
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=first_key, code='pppjo'))).status_code, 200)
+        response = self.app.post('/api/user/login',data=json.dumps(dict(
+            email='andy@upenn.edu',
+            password= 'andyiscool'
+        )))
+        second_key = json.loads(response.data)['session_key']
+        self.assertNotEqual(first_key, second_key)
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=first_key, code='pppjo'))).status_code, 200)
+        self.assertEqual(self.app.post('/api/user/logout',data=json.dumps(dict(
+            session_key=second_key))).status_code, 200)
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=second_key, code='pppjo'))).status_code, 404)
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=first_key, code='pppjo'))).status_code, 200)
+        print("Success\n")
+
+    def test_sessions(self):
+        import sessions
+        print("Testing each login adds a session, up to the per user limit")
+        limit = sessions.MAX_USER_SESSIONS
+        sessions.MAX_USER_SESSIONS = 3
+        try:
+            keys = [json.loads(self.app.post('/api/user/login',data=json.dumps(dict(
+                email='andy@upenn.edu', password='andyiscool'))).data)['session_key'] for _ in range(4)]
+        finally:
+            sessions.MAX_USER_SESSIONS = limit
+        self.assertTrue(all(len(key) >= 40 for key in keys))
+        self.assertEqual(UserSession.query.filter_by(user_id='andy@upenn.edu').count(), 3)
+        statuses = [self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=key, code='pppjo'))).status_code for key in keys]
+        self.assertEqual(statuses, [404, 200, 200, 200])
+        print("Success")
+
+        print("Testing expired sessions are refused and swept in batches")
+        now = datetime.datetime.now()
+        for i in range(25):
+            db.session.add(UserSession(key='expired-%d' % i, user_id='andy@upenn.edu',
+                                       expires_at=now - datetime.timedelta(minutes=1)))
+        db.session.commit()
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key='expired-0', code='pppjo'))).status_code, 404)
+        with count_queries() as statements:
+            swept = sessions.sweep_expired_sessions(batch_size=10)
+        self.assertEqual(swept, 25)
+        self.assertEqual(len([statement for statement in statements if statement.startswith('DELETE')]), 3)
+        self.assertEqual(UserSession.query.filter(UserSession.key.like('expired-%')).count(), 0)
+        self.assertEqual(self.app.post('/api/user/favoriting',data=json.dumps(dict(
+            session_key=session_key, code='pppjo'))).status_code, 200)
+        plan = ' '.join(str(row) for row in db.session.execute(
+            "EXPLAIN QUERY PLAN SELECT key FROM user_session WHERE expires_at < '2000-01-01' LIMIT 10"))
+        self.assertIn('ix_user_session_expires_at', plan)
+        print("Success")
+
+        print("Testing the sweeper thread")
+        sweeper = sessions.SessionSweeper(interval=0.01)
+        db.session.add(UserSession(key='expired', user_id='andy@upenn.edu',
+                                   expires_at=now - datetime.timedelta(minutes=1)))
+        db.session.commit()
+        sweeper.start(app)
+        deadline = time.monotonic() + 5
+        while sweeper.swept == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        sweeper.stop()
+        self.assertEqual(sweeper.swept, 1)
+        self.assertIn('session_sweeper', json.loads(self.app.get('/api/stats').data))
+        print("Success\n")
+
+    def test_rate_limit(self):
+        from ratelimit import MemoryBackend, RateLimitBackend
+        print("Testing token buckets refill at their rate")
+        backend = MemoryBackend()
+        self.assertEqual([backend.take('a', 1, 10, 2) for _ in range(2)], [0, 0])
+        wait = backend.take('a', 1, 10, 2)
+        self.assertTrue(0 < wait <= 0.1)
+        self.assertEqual(backend.take('b', 2, 10, 2), 0)
+        time.sleep(wait + 0.01)
+        self.assertEqual(backend.take('a', 1, 10, 2), 0)
+        with self.assertRaises(TypeError):
+            RateLimitBackend()
+        print("Success")
+
+        print("Testing a client flooding login gets 429s while other clients are served")
+        settings = rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit
+        rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit = True, 1, 60, 0.05
+        try:
+            login = json.dumps(dict(email='andy@upenn.edu', password='andyiscool'))
+            statuses = [self.app.post('/api/user/login', data=login).status_code for _ in range(4)]
+            self.assertEqual(statuses, [200, 200, 200, 429])
+            # the refusal is held for the tarpit time before it is sent
+            start = time.monotonic()
+            response = self.app.post('/api/user/login', data=login)
+            self.assertGreaterEqual(time.monotonic() - start, 0.05)
+            self.assertEqual(response.status_code, 429)
+            self.assertGreaterEqual(int(response.headers['Retry-After']), 1)
+            other = {'REMOTE_ADDR': '10.0.0.2'}
+            self.assertEqual(self.app.get('/api/clubs', environ_base=other).status_code, 200)
+            self.assertEqual(self.app.post('/api/user/login', data=login, environ_base=other).status_code, 200)
+            # authenticated requests are counted against their session, not the address
+            self.assertEqual(self.app.post('/api/user/favoriting', data=json.dumps(dict(
+                session_key=session_key, code='pppjo'))).status_code, 200)
+            print("Success")
+
+            print("Testing made up session keys do not get buckets of their own")
+            made_up = {'REMOTE_ADDR': '10.0.0.4'}
+            statuses = [self.app.post('/api/user/login', environ_base=made_up, data=json.dumps(dict(
+                email='andy@upenn.edu', password='wrong', session_key=os.urandom(8).hex()))).status_code
+                        for _ in range(4)]
+            self.assertEqual(statuses, [404, 404, 404, 429])
+            statuses = [self.app.post('/api/user/favoriting', environ_base=made_up, data=json.dumps(dict(
+                session_key=os.urandom(8).hex(), code='pppjo'))).status_code for _ in range(3)]
+            self.assertEqual(statuses, [429, 429, 429])
+            # a live session key still gets its own bucket from that address
+            self.assertEqual(self.app.post('/api/user/favoriting', environ_base=made_up, data=json.dumps(dict(
+                session_key=session_key, code='pppjo'))).status_code, 200)
+            print("Success")
+
+            print("Testing expensive routes are refused with 503 when every slot is in flight")
+            self.assertEqual(rate_limiter.in_flight, 0)
+            rate_limiter.in_flight = rate_limiter.max_in_flight
+            try:
+                response = self.app.get('/api/clubs/search?string=penn', environ_base={'REMOTE_ADDR': '10.0.0.3'})
+                self.assertEqual(response.status_code, 503)
+                self.assertEqual(response.headers['Retry-After'], '1')
+                self.assertEqual(self.app.get('/api/clubs', environ_base={'REMOTE_ADDR': '10.0.0.3'}).status_code, 200)
+            finally:
+                rate_limiter.in_flight = 0
+            self.assertEqual(self.app.get('/api/clubs/search?string=penn',
+                                          environ_base={'REMOTE_ADDR': '10.0.0.3'}).status_code, 200)
+            self.assertEqual(rate_limiter.in_flight, 0)
+            stats = json.loads(self.app.get('/api/stats', environ_base=other).data)['rate_limiter']
+            self.assertEqual((stats['limited'], stats['overloaded']), (6, 1))
+        finally:
+            rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit = settings
+        print("Success\n")
+
+    def test_password_rehash(self):
+        print("Testing login rehashes passwords made with another cost factor")
+        rounds = password_hasher.rounds
+        password_hasher.rounds = rounds + 1
+        try:
+            response = self.app.post('/api/user/login',data=json.dumps(dict(
+                email='andy@upenn.edu',
+                password= 'andyiscool'
+            )))
+            self.assertEqual(response.status_code, 200)
+            andy = User.query.filter_by(email='andy@upenn.edu').first()
+            self.assertFalse(password_hasher.needs_rehash(andy.password_hash))
+            self.assertTrue(password_hasher.verify('andyiscool', andy.password_hash))
+        finally:
+            password_hasher.rounds = rounds
+        print("Success")
+
+        print("Testing login fails fast when the hashing pool is full")
+        for _ in range(password_hasher.max_pending):
+            password_hasher._slots.acquire()
+        try:
+            response = self.app.post('/api/user/login',data=json.dumps(dict(
+                email='andy@upenn.edu',
+                password= 'andyiscool'
+            )))
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('Retry-After', response.headers)
+        finally:
+            for _ in range(password_hasher.max_pending):
+                password_hasher._slots.release()
+        print("Success\n")
+
+    def test_importer(self):
+        import importer
+        directory = tempfile.mkdtemp()
+        print("Testing importer streams NDJSON and JSON arrays")
+        ndjson_path = os.path.join(directory, 'clubs.ndjson')
+        with open(ndjson_path, 'w') as ndjson_file:
+            for i in range(25):
+                ndjson_file.write(json.dumps({'code': 'Imported-%d' % i, 'name': 'Imported %d' % i,
+                                              'description': 'bulk', 'tags': ['Bulk', 'bulk', 'Graduate']}) + '\n')
+            ndjson_file.write(json.dumps({'name': 'no code'}) + '\n')
+        self.assertEqual(importer.import_clubs(ndjson_path, batch_size=10, report=lambda _: None), (26, 1))
+        self.assertEqual(Club.query.count(), 30)
+        self.assertEqual(Tag.query.filter_by(name='bulk').first().club_cnt, 25)
+        self.assertEqual(Tag.query.filter_by(name='graduate').first().club_cnt, 27)
+        response = self.app.get('/api/clubs/search?string=bulk&limit=100')
+        self.assertEqual(len(json.loads(response.data)), 25)
+
+        read_chunk_size = importer.READ_CHUNK_SIZE
+        importer.READ_CHUNK_SIZE = 7
+        try:
+            with open('clubs.json') as clubs_file:
+                records = list(importer.iter_records(clubs_file))
+        finally:
+            importer.READ_CHUNK_SIZE = read_chunk_size
+        with open('clubs.json') as clubs_file:
+            self.assertEqual(records, json.load(clubs_file))
+        print("Success")
+
+        print("Testing importer re-imports are idempotent and update tags")
+        with open(ndjson_path, 'w') as ndjson_file:
+            for i in range(25):
+                ndjson_file.write(json.dumps({'code': 'imported-%d' % i, 'name': 'Imported %d' % i,
+                                              'tags': ['Bulk']}) + '\n')
+        importer.import_clubs(ndjson_path, batch_size=10, report=lambda _: None)
+        importer.import_clubs(ndjson_path, batch_size=10, report=lambda _: None)
+        self.assertEqual(Club.query.count(), 30)
+        self.assertEqual(Tag.query.filter_by(name='bulk').first().club_cnt, 25)
+        self.assertEqual(Tag.query.filter_by(name='graduate').first().club_cnt, 2)
+        import counters
+        self.assertEqual(counters.reconcile_counters(), (0, 0))
+        print("Success")
+
+        print("Testing importer resumes after the last committed batch")
+        checkpoint = ndjson_path + '.progress'
+        with open(checkpoint, 'w') as checkpoint_file:
+            checkpoint_file.write('20')
+        self.assertEqual(importer.import_clubs(ndjson_path, batch_size=10, checkpoint=checkpoint,
+                                               resume=True, report=lambda _: None), (5, 0))
+        self.assertFalse(os.path.exists(checkpoint))
+        print("Success")
+
+        print("Testing importer skips invalid records and reports where they are")
+        with open(ndjson_path, 'w') as ndjson_file:
+            for record in [{'code': 7, 'name': 'Seven'}, {'code': 'tagged', 'name': 'Tagged', 'tags': 'Bulk'},
+                           {'code': 'listed', 'name': 'Listed', 'tags': [['Bulk']]}, ['not', 'a', 'club'],
+                           {'code': 'labs', 'name': 'Locust Labs'}, {'code': 'twin-1', 'name': 'Twins'},
+                           {'code': 'twin-2', 'name': 'Twins'}, {'code': 'fine', 'name': 'Fine', 'tags': ['Bulk']}]:
+                ndjson_file.write(json.dumps(record) + '\n')
+        reports = []
+        self.assertEqual(importer.import_clubs(ndjson_path, batch_size=10, report=reports.append), (8, 6))
+        self.assertEqual(sorted(report.split(':')[0] for report in reports[:-1]),
+                         ['line 1', 'line 2', 'line 3', 'line 4', 'line 5', 'line 7'])
+        self.assertEqual(Club.query.filter_by(name='Locust Labs').count(), 1)
+        self.assertEqual(sorted(club.code for club in Club.query.filter(Club.code.in_(['twin-1', 'twin-2', 'fine']))),
+                         ['fine', 'twin-1'])
+        array_path = os.path.join(directory, 'clubs.json')
+        with open(array_path, 'w') as array_file:
+            array_file.write('[{"code": "ok", "name": "Ok"},\n {"code": ["x"], "name": "X"}]')
+        for chunk_size in [read_chunk_size, 7]:
+            importer.READ_CHUNK_SIZE = chunk_size
+            reports = []
+            try:
+                self.assertEqual(importer.import_clubs(array_path, report=reports.append), (2, 1))
+            finally:
+                importer.READ_CHUNK_SIZE = read_chunk_size
+            self.assertTrue(reports[0].startswith('offset 32: club code and name must be strings'), reports[0])
+        with open(ndjson_path, 'w') as ndjson_file:
+            ndjson_file.write(json.dumps({'code': 'ok', 'name': 'Ok'}) + '\n{"code": \n')
+        with self.assertRaisesRegex(importer.InvalidImportFile, '^line 2: '):
+            importer.import_clubs(ndjson_path, report=lambda _: None)
+        print("Success\n")
+
+    def test_clubs_batch(self):
+        print("Testing /api/clubs/batch applies valid items and reports each one")
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+            session_key= session_key,
+            create=[
+                {'code': 'batch-0', 'name': 'Batch Club 0', 'tags': ['Undergraduate', 'Batch']},
+                {'code': 'batch-1', 'name': 'Batch Club 1', 'tags': ['batch', 'BATCH']},
+                {'code': 'pppjo', 'name': 'Duplicate Code'},
+                {'name': 'Missing Code'},
+            ],
+            modify=[
+                {'code': 'batch-1', 'name': 'Batch Club 1', 'new_data': {'name': 'Renamed Batch Club'}},
+                {'code': 'pppp', 'name': 'Penn Program for Potential Procrastinators',
+                 'new_data': {'tags': ['Batch']}},
+                {'code': 'locustlabs', 'name': 'Wrong Name', 'new_data': {'description': ''}},
+                {'code': 'penn-memes', 'name': 'Penn Memes Club', 'new_data': {'name': 'Locust Labs'}},
+            ],
+            delete=[
+                {'code': 'lorem-ipsum', 'name': 'Penn Lorem Ipsum Club'},
+                {'code': 'batch-0', 'name': 'Batch Club 0'},
+                {'code': 'nope', 'name': 'Nope'},
+            ]
+        )))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)
+        self.assertEqual([r['status'] for r in results['create']], [200, 200, 406, 406])
+        self.assertEqual([r['status'] for r in results['modify']], [200, 200, 406, 406])
+        self.assertEqual([r['status'] for r in results['delete']], [200, 200, 406])
+
+        codes = sorted(club['code'] for club in json.loads(self.app.get('/api/clubs').data))
+        self.assertEqual(codes, ['batch-1', 'locustlabs', 'penn-memes', 'pppjo', 'pppp'])
+        self.assertEqual(Club.query.filter_by(code='batch-1').first().name, 'Renamed Batch Club')
+        tags = {tag['name']: tag['cnt'] for tag in json.loads(self.app.get('/api/tag').data)}
+        self.assertEqual(tags['batch'], 2)
+        self.assertEqual(tags['undergraduate'], 2)
+        self.assertEqual(tags['academic'], 0)
+        response = self.app.get('/api/clubs/search?string=renamed')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['batch-1'])
+        response = self.app.get('/api/clubs/search?string=lorem')
+        self.assertEqual(json.loads(response.data), [])
+        print("Success")
+
+        print("Testing /api/clubs/batch leaves nothing of a club it creates and deletes")
+        self.app.get('/api/clubs')
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+            session_key= session_key,
+            create=[{'code': 'tmpx', 'name': 'Temporary', 'tags': ['Fleeting']}],
+            modify=[{'code': 'pppjo', 'name': 'Penn Pre-Professional Juggling Organization',
+                     'new_data': {'description': 'We juggle in batches'}}],
+            delete=[{'code': 'tmpx', 'name': 'Temporary'}]
+        )))
+        self.assertEqual([item['status'] for kind in ('create', 'modify', 'delete')
+                          for item in json.loads(response.data)[kind]], [200, 200, 200])
+        self.assertIsNone(Club.query.filter_by(code='tmpx').first())
+        self.assertIsNone(Tag.query.filter_by(name='fleeting').first())
+        self.assertEqual(CatalogChange.query.filter_by(kind='club', key='tmpx').count(), 0)
+        response = self.app.get('/api/clubs/search?string=batches')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['pppjo'])
+        print("Success")
+
+        print("Testing /api/clubs/batch answers items with fields of the wrong type with a 406")
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+            session_key= session_key,
+            create=[
+                {'code': 'bad-tags', 'name': 'Bad Tags', 'tags': ['x', 5]},
+                {'code': 'bad-name', 'name': ['bad']},
+                {'code': 'string-tags', 'name': 'String Tags', 'tags': 'abc'},
+                {'code': 5, 'name': 'Number Code'},
+                {'code': 'good', 'name': 'Good Club', 'tags': ['Typed']},
+            ],
+            modify=[
+                {'code': 'pppjo', 'name': 'Penn Pre-Professional Juggling Organization', 'new_data': {'tags': None}},
+                {'code': 'pppjo', 'name': 'Penn Pre-Professional Juggling Organization', 'new_data': {'name': 7}},
+                {'code': 'pppjo', 'name': 'Penn Pre-Professional Juggling Organization',
+                 'new_data': {'description': ['x']}},
+            ],
+            delete=[{'code': 'pppp', 'name': None}]
+        )))
+        self.assertEqual(response.status_code, 200)
+        results = json.loads(response.data)
+        self.assertEqual([r['status'] for r in results['create']], [406, 406, 406, 406, 200])
+        self.assertEqual([r['status'] for r in results['modify']], [406, 406, 406])
+        self.assertEqual([r['status'] for r in results['delete']], [406])
+        self.assertEqual(results['create'][0]['message'], "tags must be a list of strings")
+        self.assertEqual(results['create'][2]['message'], "tags must be a list of strings")
+        self.assertIsNotNone(Club.query.filter_by(code='good').first())
+        self.assertIsNone(Club.query.filter_by(code='string-tags').first())
+        self.assertEqual(Tag.query.filter(Tag.name.in_(['a', 'b', 'c', 'x'])).count(), 0)
+        self.assertEqual(Club.query.filter_by(code='pppjo').first().name, 'Penn Pre-Professional Juggling Organization')
+        self.assertIsNotNone(Club.query.filter_by(code='pppp').first())
+        print("Success")
+
+        print("Testing /api/clubs/batch query count does not grow with the batch")
+        creates = [{'code': 'bulk-%d' % i, 'name': 'Bulk %d' % i, 'tags': ['bulk-%d' % i, 'Athletics']}
+                   for i in range(100)]
+        with count_queries() as statements:
+            response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+                session_key= session_key,
+                create=creates
+            )))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Club.query.count(), 106)
+        self.assertLessEqual(len(statements), 15)
+        print("Success")
+
+        print("Testing /api/clubs/batch permission denied and malformed lists")
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(create=[])))
+        self.assertEqual(response.status_code, 404)
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+            session_key= session_key,
+            create={'code': 'x'}
+        )))
+        self.assertEqual(response.status_code, 406)
+        print("Success\n")
+
+    def test_query_plans(self):
+        print("Testing no endpoint query scans a whole table")
+        for method, url, body in QUERY_PLAN_REQUESTS:
+            with count_queries(with_parameters=True) as statements:
+                if method == 'GET':
+                    response = self.app.get(url)
+                else:
+                    response = self.app.post(url, data=json.dumps(dict(body, session_key=session_key)))
+            self.assertEqual(response.status_code, 200, url)
+            for statement, parameters in statements:
+                if statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT')):
+                    self.assertEqual(full_scans(statement, parameters), [], (url, statement))
+        print("Success\n")
+
+    def test_conditional_get(self):
+        print("Testing GET endpoints answer If-None-Match with 304")
+        response = self.app.get('/api/clubs')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        with count_queries() as statements:
+            response = self.app.get('/api/clubs', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(statements, [])
+        response = self.app.get('/api/clubs', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        print("Success")
+
+        print("Testing repeated GETs are served from the response cache")
+        first = self.app.get('/api/clubs?limit=2')
+        with count_queries() as statements:
+            second = self.app.get('/api/clubs?limit=2')
+        self.assertEqual(statements, [])
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['X-Next-Cursor'], first.headers['X-Next-Cursor'])
+        print("Success")
+
+        print("Testing writes change the ETag and the cached responses")
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+        response = self.app.get('/api/clubs', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        fav_cnt = {club['code']: club['fav_cnt'] for club in json.loads(response.data)}
+        self.assertEqual(fav_cnt['pppjo'], 1)
+        etag = response.headers['ETag']
+        # favoriting again changes nothing, so the version stays the same
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+        response = self.app.get('/api/clubs', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        print("Success")
+
+        print("Testing errors are not cached")
+        self.app.get('/api/tag/search?tag=new')
+        self.app.post('/api/clubs/create',data=json.dumps(dict(
+            session_key= session_key, code= 'pppal', name='Penn Pal', tags=['New']
+        )))
+        response = self.app.get('/api/tag/search?tag=new')
+        self.assertEqual(response.status_code, 200)
+        print("Success\n")
+
+    def test_club_fragments(self):
+        print("Testing list bodies built from fragments are the ones jsonify renders")
+        clubs = Club.query.order_by(Club.code).all()
+        summaries = [{'code': club.code, 'name': club.name, 'fav_cnt': club.fav_cnt} for club in clubs]
+        with app.app_context():
+            expected = app.json.response(summaries).data
+        self.assertEqual(self.app.get('/api/clubs').data, expected)
+        # the second time every club comes from the fragment cache
+        response_cache.clear()
+        self.assertEqual(self.app.get('/api/clubs').data, expected)
+        self.assertGreaterEqual(fragment_cache.stats()['hits'], len(clubs))
+        print("Success")
+
+        print("Testing non-ascii names are the same json as jsonify renders")
+        self.app.post('/api/clubs/modify', data=json.dumps(dict(
+            session_key= session_key, code= 'pppp', name= 'Penn Program for Potential Procrastinators',
+            new_data= {'name': 'Caf\u00e9 Procrastinators \u2615'})))
+        clubs = Club.query.order_by(Club.code).all()
+        summaries = [{'code': club.code, 'name': club.name, 'fav_cnt': club.fav_cnt} for club in clubs]
+        with app.app_context():
+            expected = app.json.response(summaries).data
+        body = self.app.get('/api/clubs').data
+        self.assertEqual(json.loads(body.decode('utf-8')), json.loads(expected))
+        self.assertIn('Caf\u00e9 Procrastinators \u2615', [club['name'] for club in json.loads(body)])
+        print("Success")
+
+        print("Testing fragments are dropped when their club changes")
+        self.app.get('/api/clubs/search?string=pppjo')
+        self.app.get('/api/user/favorite_clubs?username=josh')
+        self.app.get('/api/tag/search?tag=undergraduate')
+        self.app.post('/api/clubs/modify', data=json.dumps(dict(
+            session_key= session_key, code= 'pppjo', name= 'Penn Pre-Professional Juggling Organization',
+            new_data= {'name': 'Penn Jugglers', 'description': 'juggling', 'tags': ['Circus']}
+        )))
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+        club = {club['code']: club for club in json.loads(self.app.get('/api/clubs').data)}['pppjo']
+        self.assertEqual((club['name'], club['fav_cnt']), ('Penn Jugglers', 1))
+        club = json.loads(self.app.get('/api/clubs/search?string=jugglers').data)[0]
+        self.assertEqual((club['description'], club['tags'], club['fav_cnt']), ('juggling', ['circus'], 1))
+        club = json.loads(self.app.get('/api/user/favorite_clubs?username=josh').data)[0]
+        self.assertEqual(club, {'code': 'pppjo', 'name': 'Penn Jugglers', 'description': 'juggling', 'tags': ['circus']})
+        response = json.loads(self.app.get('/api/tag/search?tag=circus').data)
+        self.assertEqual(response, {'name': 'circus', 'clubs': [{'code': 'pppjo', 'name': 'Penn Jugglers'}]})
+        print("Success\n")
+
+    def test_tag_query(self):
+        print("Testing /api/tag/query evaluates AND, OR and NOT with facets")
+        response = self.app.get('/api/tag/query?q=Undergraduate AND NOT Pre-Professional')
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertEqual([club['code'] for club in result['clubs']], ['locustlabs', 'lorem-ipsum', 'pppp'])
+        self.assertEqual(result['clubs'][0], {'code': 'locustlabs', 'name': 'Locust Labs'})
+        self.assertEqual(result['count'], 3)
+        self.assertEqual(result['facets'], {'undergraduate': 3, 'graduate': 1, 'technology': 1,
+                                            'literary': 1, 'academic': 1})
+        result = json.loads(self.app.get('/api/tag/query?q=(graduate OR athletics) AND literary').data)
+        self.assertEqual([club['code'] for club in result['clubs']], ['penn-memes'])
+        result = json.loads(self.app.get('/api/tag/query?q=NOT undergraduate').data)
+        self.assertEqual([club['code'] for club in result['clubs']], ['penn-memes'])
+        print("Success")
+
+        print("Testing /api/tag/query pages in code order")
+        response = self.app.get('/api/tag/query?q=undergraduate&limit=3')
+        self.assertEqual([club['code'] for club in json.loads(response.data)['clubs']],
+                         ['locustlabs', 'lorem-ipsum', 'pppjo'])
+        response = self.app.get('/api/tag/query?q=undergraduate&limit=3&cursor=' + response.headers['X-Next-Cursor'])
+        self.assertEqual([club['code'] for club in json.loads(response.data)['clubs']], ['pppp'])
+        self.assertNotIn('X-Next-Cursor', response.headers)
+        print("Success")
+
+        print("Testing invalid tag queries are rejected")
+        for query in ['', 'AND', 'undergraduate AND', '(undergraduate', 'undergraduate)', '(graduate) literary',
+                      'unknown-tag']:
+            response = self.app.get('/api/tag/query?q=' + query)
+            self.assertEqual(response.status_code, 406, query)
+        self.assertEqual(self.app.get('/api/tag/query').status_code, 406)
+        print("Success")
+
+        print("Testing the index follows club writes without a rebuild")
+        rebuilds = tag_index.stats()['rebuilds']
+        self.app.post('/api/clubs/create', data=json.dumps(dict(
+            session_key= session_key, code= 'pppal', name= 'Penn Pal', tags= ['Athletics', 'Social Impact']
+        )))
+        self.app.post('/api/clubs/modify', data=json.dumps(dict(
+            session_key= session_key, code= 'pppjo', name= 'Penn Pre-Professional Juggling Organization',
+            new_data= {'name': 'Penn Pre-Professional Juggling Organization', 'tags': ['Pre-Professional']}
+        )))
+        self.app.post('/api/clubs/delete', data=json.dumps(dict(
+            session_key= session_key, code= 'locustlabs', name= 'Locust Labs'
+        )))
+        result = json.loads(self.app.get('/api/tag/query?q=athletics OR technology').data)
+        self.assertEqual([club['code'] for club in result['clubs']], ['pppal'])
+        result = json.loads(self.app.get('/api/tag/query?q=Social Impact').data)
+        self.assertEqual(result['facets'], {'social impact': 1, 'athletics': 1})
+        self.assertEqual(tag_index.stats()['rebuilds'], rebuilds)
+        print("Success\n")
+
+    def test_recommendations(self):
+        print("Testing similar clubs and recommendations follow favoriting")
+        # the matrix is built before the favorites below, which are then applied as they commit
+        self.assertEqual(json.loads(self.app.get('/api/clubs/similar?code=pppjo').data), [])
+        keys = {}
+        for name in ['ann', 'bob', 'cat']:
+            response = self.app.post('/api/user/signup', data=json.dumps(dict(
+                email= name + '@upenn.edu', username= name, password= 'password')))
+            keys[name] = json.loads(response.data)['session_key']
+        favorites = {'ann': ['pppjo', 'pppp', 'locustlabs'], 'bob': ['pppjo', 'pppp', 'lorem-ipsum'],
+                     'cat': ['pppjo', 'penn-memes']}
+        for name, codes in favorites.items():
+            self.app.post('/api/user/favoriting/bulk', data=json.dumps(dict(session_key= keys[name], codes= codes)))
+        self.app.post('/api/user/unfavoriting', data=json.dumps(dict(session_key= keys['bob'], code= 'lorem-ipsum')))
+
+        response = self.app.get('/api/clubs/similar?code=pppjo')
+        self.assertEqual(response.status_code, 200)
+        similar = json.loads(response.data)
+        # pppp shares 2 of pppjo's 3 fans, the clubs sharing 1 fan are ordered by code
+        self.assertEqual([club['code'] for club in similar], ['pppp', 'locustlabs', 'penn-memes'])
+        self.assertEqual(similar[0], {'code': 'pppp', 'name': 'Penn Program for Potential Procrastinators',
+                                      'fav_cnt': 2})
+        self.assertEqual(len(json.loads(self.app.get('/api/clubs/similar?code=pppjo&limit=1').data)), 1)
+        response = self.app.get('/api/user/recommendations?username=bob')
+        self.assertEqual([club['code'] for club in json.loads(response.data)], ['locustlabs', 'penn-memes'])
+        self.assertEqual(self.app.get('/api/clubs/similar?code=nope').status_code, 404)
+        self.assertEqual(self.app.get('/api/clubs/similar').status_code, 406)
+        self.assertEqual(self.app.get('/api/user/recommendations?username=nobody').status_code, 404)
+        print("Success")
+
+        print("Testing incremental updates match a rebuild, across the favorites limit")
+        def all_similar():
+            return {code: co_favorites.similar_clubs(code) for code in co_favorites.numbers}
+        co_favorites.max_user_favorites = 2
+        try:
+            co_favorites.clear()
+            co_favorites.refresh()
+            # ann goes above the limit and cat comes back under it
+            self.app.post('/api/user/favoriting', data=json.dumps(dict(session_key= keys['cat'], code= 'pppp')))
+            self.app.post('/api/user/unfavoriting', data=json.dumps(dict(session_key= keys['ann'], code= 'pppp')))
+            self.app.post('/api/user/unfavoriting', data=json.dumps(dict(session_key= keys['cat'], code= 'pppjo')))
+            incremental = all_similar()
+            co_favorites.clear()
+            co_favorites.refresh()
+            self.assertEqual(incremental, all_similar())
+        finally:
+            co_favorites.max_user_favorites = MAX_USER_FAVORITES
+        print("Success")
+
+        print("Testing favoriting that commits while the matrix is rebuilt is not lost")
+        def favorite_during_read(conn, cursor, statement, parameters, context, executemany):
+            if 'group_concat' in statement and not favorited:
+                favorited.append(True)
+                # another request commits while the favorites are being read
+                thread = threading.Thread(target=lambda: self.app.post('/api/user/favoriting', data=json.dumps(dict(
+                    session_key= keys['ann'], code= 'penn-memes'))))
+                thread.start()
+                thread.join()
+        favorited = []
+        co_favorites.clear()
+        event.listen(db.engine, 'after_cursor_execute', favorite_during_read)
+        try:
+            co_favorites.refresh()
+        finally:
+            event.remove(db.engine, 'after_cursor_execute', favorite_during_read)
+        self.assertEqual(favorited, [True])
+        during = all_similar()
+        self.assertIn('penn-memes', during['pppjo'])
+        co_favorites.clear()
+        co_favorites.refresh()
+        self.assertEqual(during, all_similar())
+        print("Success")
+
+        print("Testing favorites committed by another process are recounted, not rebuilt, after a sync")
+        from sqlalchemy import text
+        co_favorites.clear()
+        co_favorites.refresh()
+        rebuilds = co_favorites.rebuilds
+        # favorites another worker wrote, which this process only hears about from the change log
+        db.session.execute(text("INSERT INTO favorites (club_id, user_id) VALUES (:code, :email)"),
+                           [{'code': 'locustlabs', 'email': 'cat@upenn.edu'},
+                            {'code': 'penn-memes', 'email': 'bob@upenn.edu'},
+                            {'code': 'lorem-ipsum', 'email': 'josh@upenn.edu'},
+                            {'code': 'pppp', 'email': 'josh@upenn.edu'}])
+        db.session.execute(text("DELETE FROM favorites WHERE club_id = 'pppjo' AND user_id = 'bob@upenn.edu'"))
+        db.session.commit()
+        co_favorites.synced(['locustlabs', 'penn-memes', 'lorem-ipsum', 'pppp', 'pppjo'])
+        synced = all_similar()
+        self.assertEqual(co_favorites.rebuilds, rebuilds)
+        co_favorites.clear()
+        co_favorites.refresh()
+        self.assertEqual(synced, all_similar())
+        print("Success\n")
+
+    def test_favorite_users_export(self):
+        print("Testing the favorite users export streams every user once")
+        from sqlalchemy import text
+        from asgi import application
+        db.session.execute(text("INSERT INTO user (email, username, password_hash) VALUES (:email, :username, 'x')"),
+                           [{'email': 'fan%04d@upenn.edu' % i, 'username': 'fan%04d' % i} for i in range(2500)])
+        # fans 0-1999 favorited pppjo and fans 1000-2499 favorited pppp
+        db.session.execute(text("INSERT INTO favorites (club_id, user_id) VALUES (:code, :email)"),
+                           [{'code': 'pppjo', 'email': 'fan%04d@upenn.edu' % i} for i in range(2000)] +
+                           [{'code': 'pppp', 'email': 'fan%04d@upenn.edu' % i} for i in range(1000, 2500)])
+        db.session.commit()
+
+        response = self.app.get('/api/clubs/favorite_users/export?code=pppjo&code=pppp')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(response.is_streamed)
+        users = [json.loads(line) for line in response.data.decode('utf-8').splitlines()]
+        self.assertEqual(len(users), 2500)
+        self.assertEqual(users[0], {'email': 'fan0000@upenn.edu', 'username': 'fan0000'})
+        self.assertEqual([user['email'] for user in users], sorted(set(user['email'] for user in users)))
+
+        response = self.app.get('/api/clubs/favorite_users/export?code=pppp&format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.data.decode('utf-8').splitlines()
+        self.assertEqual(lines[:2], ['email,username', 'fan1000@upenn.edu,fan1000'])
+        self.assertEqual(len(lines), 1501)
+        response = self.app.get('/api/clubs/favorite_users/export?code=penn-memes&format=csv')
+        self.assertEqual(response.data.decode('utf-8').splitlines(), ['email,username'])
+        print("Success")
+
+        print("Testing the export is streamed in chunks by the asgi adapter")
+        status, headers, body = asgi_request(application, 'GET', '/api/clubs/favorite_users/export',
+                                             b'code=pppjo&code=pppp')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, self.app.get('/api/clubs/favorite_users/export?code=pppjo&code=pppp').data)
+        print("Success")
+
+        print("Testing invalid exports are rejected")
+        self.assertEqual(self.app.get('/api/clubs/favorite_users/export').status_code, 406)
+        self.assertEqual(self.app.get('/api/clubs/favorite_users/export?code=pppp&format=xml').status_code, 406)
+        self.assertEqual(self.app.get('/api/clubs/favorite_users/export?code=pppp&code=nope').status_code, 404)
+        print("Success\n")
+
+    def test_engine_profile(self):
+        print("Testing the db runs in WAL mode with a busy timeout")
+        self.assertEqual(db.session.execute("PRAGMA journal_mode").scalar(), 'wal')
+        self.assertGreater(db.session.execute("PRAGMA busy_timeout").scalar(), 0)
+        print("Success")
+
+        print("Testing the read pool is read-only")
+        with read_engine(db.engine).connect() as connection:
+            self.assertEqual(connection.execute("PRAGMA query_only").scalar(), 1)
+            with self.assertRaises(Exception):
+                connection.execute("DELETE FROM club")
+        self.assertEqual(Club.query.count(), 5)
+        print("Success")
+
+        print("Testing GET requests use the read pool and POST requests the write pool")
+        statements = {'read': [], 'write': []}
+        listeners = [(read_engine(db.engine), lambda *args: statements['read'].append(args[2])),
+                     (db.engine, lambda *args: statements['write'].append(args[2]))]
+        for engine, listener in listeners:
+            event.listen(engine, 'before_cursor_execute', listener)
+        try:
+            self.app.get('/api/clubs/search?string=penn')
+            self.assertNotEqual(statements['read'], [])
+            self.assertEqual(statements['write'], [])
+            statements['read'].clear()
+            response = self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(statements['read'], [])
+            self.assertNotEqual(statements['write'], [])
+        finally:
+            for engine, listener in listeners:
+                event.remove(engine, 'before_cursor_execute', listener)
+        print("Success\n")
+
+    def test_catalog_snapshot(self):
+        print("Testing the catalog lists are read from the snapshot, patched on commit")
+        urls = ['/api/clubs', '/api/tag', '/api/tag/search?tag=undergraduate', '/api/tag/search?tag=new',
+                '/api/clubs/search?string=penn']
+        self.app.get('/api/clubs')
+        first = catalog_snapshot.get()
+        rebuilds, patches = catalog_snapshot.rebuilds, catalog_snapshot.patches
+        old_fav_cnt = first.club('pppjo').fav_cnt
+        response = self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key=session_key, code='pppjo')))
+        self.assertEqual(response.status_code, 200)
+        clubs = {club['code']: club for club in json.loads(self.app.get('/api/clubs').data)}
+        self.assertEqual(clubs['pppjo']['fav_cnt'], old_fav_cnt + 1)
+        # the snapshot served before the commit is left as it was
+        self.assertEqual(first.club('pppjo').fav_cnt, old_fav_cnt)
+        self.assertIsNot(catalog_snapshot.get(), first)
+
+        response = self.app.post('/api/clubs/create',data=json.dumps(dict(session_key=session_key,
+            code='aaa-first', name='Penn First', tags=['New', 'Undergraduate'])))
+        self.assertEqual(response.status_code, 200)
+        response = self.app.post('/api/clubs/modify',data=json.dumps(dict(session_key=session_key,
+            code='pppjo', name='Penn Pre-Professional Juggling Organization',
+            new_data={'name': 'Penn Pre-Professional Juggling Organization', 'tags': ['New']})))
+        self.assertEqual(response.status_code, 200)
+        codes = [club['code'] for club in json.loads(self.app.get('/api/clubs').data)]
+        self.assertEqual(codes, sorted(codes))
+        self.assertEqual(codes[0], 'aaa-first')
+        data = json.loads(self.app.get('/api/tag/search?tag=new').data)
+        self.assertEqual([club['code'] for club in data['clubs']], ['aaa-first', 'pppjo'])
+        data = json.loads(self.app.get('/api/tag/search?tag=undergraduate').data)
+        self.assertIn('aaa-first', [club['code'] for club in data['clubs']])
+        self.assertNotIn('pppjo', [club['code'] for club in data['clubs']])
+        tags = {tag['name']: tag['cnt'] for tag in json.loads(self.app.get('/api/tag').data)}
+        self.assertEqual(tags['new'], 2)
+        self.assertEqual(catalog_snapshot.stats()['rebuilds'], rebuilds)
+        # the create and the modify were patched in together
+        self.assertEqual(catalog_snapshot.stats()['patches'], patches + 2)
+        print("Success")
+
+        print("Testing a patched snapshot serves what a rebuilt one does")
+        response = self.app.post('/api/clubs/delete',data=json.dumps(dict(session_key=session_key,
+            code='aaa-first', name='Penn First')))
+        self.assertEqual(response.status_code, 200)
+        patched = [self.app.get(url).data for url in urls]
+        self.assertNotIn(b'aaa-first', patched[0])
+        response_cache.clear()
+        fragment_cache.clear()
+        catalog_snapshot.clear()
+        self.assertEqual([self.app.get(url).data for url in urls], patched)
+        self.assertEqual(catalog_snapshot.stats()['rebuilds'], rebuilds + 1)
+        print("Success")
+
+        print("Testing the snapshot follows a batch that creates, modifies and deletes a club")
+        response = self.app.post('/api/clubs/batch',data=json.dumps(dict(
+            session_key= session_key,
+            create=[{'code': 'tmpx', 'name': 'Temporary'}],
+            modify=[{'code': 'pppjo', 'name': 'Penn Pre-Professional Juggling Organization',
+                     'new_data': {'description': 'Juggling, patched'}}],
+            delete=[{'code': 'tmpx', 'name': 'Temporary'}]
+        )))
+        self.assertEqual(response.status_code, 200)
+        # a club created and deleted between two refreshes, as a listener may still hear of it
+        catalog_snapshot.changed(['tmpx'])
+        self.assertEqual(catalog_snapshot.get().club('pppjo').description, 'Juggling, patched')
+        self.assertIsNone(catalog_snapshot.get().club('tmpx'))
+        print("Success")
+
+        print("Testing a failed refresh keeps its changes for the next one")
+        Club.query.filter_by(code='pppjo').first().description = 'Juggling, retried'
+        catalog_changed(db.session, ['pppjo'])
+        db.session.commit()
+        patch = catalog_snapshot.patch
+        def failing_patch(version, codes):
+            raise RuntimeError("database is locked")
+        catalog_snapshot.patch = failing_patch
+        try:
+            with self.assertRaises(RuntimeError):
+                catalog_snapshot.get()
+        finally:
+            catalog_snapshot.patch = patch
+        self.assertEqual(catalog_snapshot.get().club('pppjo').description, 'Juggling, retried')
+        print("Success")
+
+        print("Testing the snapshot refuses cursors that are not codes")
+        cursor = base64.urlsafe_b64encode(b'5').decode('ascii')
+        self.assertEqual(self.app.get('/api/clubs?cursor=' + cursor).status_code, 406)
+        self.assertEqual(self.app.get('/api/tag/search?tag=new&cursor=' + cursor).status_code, 406)
+        print("Success\n")
+
+    def test_changes(self):
+        from changes import compact_changes
+        from counters import reconcile_counters
+        print("Testing /api/changes without since starts with a reset")
+        data = json.loads(self.app.get('/api/changes').data)
+        self.assertTrue(data['reset'])
+        start = data['seq']
+        self.assertEqual(json.loads(self.app.get('/api/changes?since=%d' % start).data),
+                         {'seq': start, 'reset': False, 'more': False, 'clubs': [], 'deleted': [], 'tags': []})
+        print("Success")
+
+        print("Testing /api/changes returns the current state of what changed")
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key=session_key, code='pppjo')))
+        self.app.post('/api/clubs/create',data=json.dumps(dict(session_key=session_key,
+            code='feed', name='Penn Feed', tags=['Fresh', 'Undergraduate'])))
+        self.app.post('/api/clubs/modify',data=json.dumps(dict(session_key=session_key,
+            code='feed', name='Penn Feed', new_data={'name': 'Penn Feeds', 'tags': ['Fresh']})))
+        self.app.post('/api/clubs/delete',data=json.dumps(dict(session_key=session_key,
+            code='locustlabs', name='Locust Labs')))
+        data = json.loads(self.app.get('/api/changes?since=%d' % start).data)
+        self.assertFalse(data['reset'])
+        self.assertFalse(data['more'])
+        clubs = {club['code']: club for club in json.loads(self.app.get('/api/clubs').data)}
+        self.assertEqual(data['clubs'], [clubs['feed'], clubs['pppjo']])
+        self.assertEqual(data['deleted'], ['locustlabs'])
+        tags = {tag['name']: tag for tag in json.loads(self.app.get('/api/tag').data)}
+        # the tags of the deleted club lost a club too
+        self.assertEqual([tag['name'] for tag in data['tags']], ['fresh', 'graduate', 'technology', 'undergraduate'])
+        self.assertEqual(data['tags'], [tags[tag['name']] for tag in data['tags']])
+        latest = data['seq']
+        self.assertEqual(json.loads(self.app.get('/api/changes?since=%d' % latest).data)['clubs'], [])
+        print("Success")
+
+        print("Testing /api/changes pages through the log with limit")
+        page = json.loads(self.app.get('/api/changes?since=%d&limit=1' % start).data)
+        self.assertTrue(page['more'])
+        self.assertEqual(page['clubs'], [clubs['pppjo']])
+        seen = set(club['code'] for club in page['clubs'])
+        while page['more']:
+            page = json.loads(self.app.get('/api/changes?since=%d&limit=1' % page['seq']).data)
+            seen.update(club['code'] for club in page['clubs'] + [{'code': code} for code in page['deleted']])
+        self.assertEqual(page['seq'], latest)
+        self.assertEqual(seen, {'pppjo', 'feed', 'locustlabs'})
+        self.assertEqual(self.app.get('/api/changes?since=soon').status_code, 406)
+        self.assertTrue(json.loads(self.app.get('/api/changes?since=%d' % (latest + 100)).data)['reset'])
+        print("Success")
+
+        print("Testing a rolled back transaction logs nothing")
+        rows = CatalogChange.query.count()
+        db.session.add(Club(code='never', name='Never'))
+        catalog_changed(db.session, ['never'])
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(CatalogChange.query.count(), rows)
+        print("Success")
+
+        print("Testing compaction keeps what clients see and resets the ones left behind")
+        before = json.loads(self.app.get('/api/changes?since=%d' % start).data)
+        self.assertGreater(compact_changes(), 0)
+        self.assertEqual(CatalogChange.query.filter_by(kind='club', key='feed').count(), 1)
+        self.assertEqual(json.loads(self.app.get('/api/changes?since=%d' % start).data), before)
+        compact_changes(now=datetime.datetime.now() + datetime.timedelta(days=30))
+        self.assertEqual(CatalogChange.query.count(), 1)
+        self.assertTrue(json.loads(self.app.get('/api/changes?since=%d' % start).data)['reset'])
+        data = json.loads(self.app.get('/api/changes?since=%d' % latest).data)
+        self.assertFalse(data['reset'])
+        self.assertEqual(data['seq'], latest)
+        print("Success")
+
+        print("Testing a change to every club is logged as a reset")
+        Club.query.filter_by(code='pppjo').first().fav_cnt = 42
+        db.session.commit()
+        reconcile_counters()
+        data = json.loads(self.app.get('/api/changes?since=%d' % latest).data)
+        self.assertTrue(data['reset'])
+        self.assertGreater(data['seq'], latest)
+        print("Success\n")
+
+    def test_compression(self):
+        from content_encoding import Compressor, compressor
+        print("Testing Accept-Encoding negotiation")
+        gzip_only = Compressor(encodings=['gzip'], min_bytes=100)
+        self.assertEqual(gzip_only.negotiate('deflate, gzip;q=0.5', 2000), 'gzip')
+        self.assertEqual(gzip_only.negotiate('*', 2000), 'gzip')
+        self.assertIsNone(gzip_only.negotiate('gzip;q=0, *', 2000))
+        self.assertIsNone(gzip_only.negotiate('identity', 2000))
+        self.assertIsNone(gzip_only.negotiate('gzip', 99))
+        self.assertIsNone(gzip_only.negotiate(None, 2000))
+        print("Success")
+
+        print("Testing large cached responses are compressed once per catalog version")
+        url = '/api/clubs/search?string=penn'
+        plain = self.app.get(url)
+        self.assertGreaterEqual(len(plain.data), compressor.min_bytes)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        compressed = lambda : compressor.stats()['compressed']['gzip']['bodies']
+        before = compressed()
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertEqual(response.headers['ETag'], 'W/' + plain.headers['ETag'])
+        with count_queries() as statements:
+            again = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(statements, [])
+        self.assertEqual(again.data, response.data)
+        self.assertEqual(compressed(), before + 1)
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip', 'If-None-Match': again.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        self.app.post('/api/user/favoriting',data=json.dumps(dict(session_key= session_key, code= 'pppjo')))
+        response = self.app.get(url, headers={'Accept-Encoding': 'gzip'})
+        fav_cnt = {club['code']: club['fav_cnt'] for club in json.loads(gzip.decompress(response.data))}
+        self.assertEqual(fav_cnt['pppjo'], 1)
+        self.assertEqual(compressed(), before + 2)
+        plain = self.app.get(url)
+        print("Success")
+
+        print("Testing small, refused and streamed responses are sent uncompressed")
+        small = self.app.get('/api/clubs', headers={'Accept-Encoding': 'gzip'})
+        self.assertLess(len(small.data), compressor.min_bytes)
+        self.assertNotIn('Content-Encoding', small.headers)
+        for accept_encoding in ['identity', 'gzip;q=0', 'compress']:
+            response = self.app.get(url, headers={'Accept-Encoding': accept_encoding})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.data, plain.data)
+        response = self.app.get('/api/clubs/favorite_users/export?code=pppjo', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        print("Success")
+
+        print("Testing responses of other views and of the asgi adapter are compressed too")
+        from asgi import application
+        response = self.app.get('/api/metrics', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(gzip.decompress(response.data).startswith(b'#'))
+        status, headers, body = asgi_request(application, 'GET', '/api/clubs/search', b'string=penn',
+                                             headers=[('Accept-Encoding', 'gzip')])
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), self.app.get(url).data)
+        print("Success\n")
+
+    def test_app_factory(self):
+        from app import create_app, warm_up
+        from catalog import catalog_changed, catalog_version, sync_catalog
+        print("Testing create_app serves the routes on a new app")
+        other = create_app({'SQLALCHEMY_DATABASE_URI': app.config['SQLALCHEMY_DATABASE_URI']})
+        self.assertIsNot(other, app)
+        data = json.loads(other.test_client().get('/api/clubs').data)
+        self.assertEqual(len(data), 5)
+        print("Success")
+
+        print("Testing warm_up opens the pools and fills the caches")
+        response_cache.clear()
+        tag_index.clear()
+        catalog_snapshot.clear()
+        timings = warm_up(app)
+        self.assertEqual(set(timings), {'connections', 'caches'})
+        self.assertEqual(tag_index.stats()['rebuilds'], 1)
+        self.assertGreaterEqual(response_cache.stats()['entries'], 2)
+        self.assertEqual(metrics.routes, {})
+        with count_queries() as statements:
+            self.assertEqual(self.app.get('/api/clubs').status_code, 200)
+        self.assertEqual(statements, [])
+        print("Success")
+
+        print("Testing workers sharing the catalog version hear about each other's commits")
+        catalog_version.share()
+        try:
+            version, _ = catalog_version.get()
+            self.app.get('/api/clubs')
+            fragments = fragment_cache.stats()['fragments']
+            rebuilds = catalog_snapshot.stats()['rebuilds']
+            self.assertGreater(fragments, 0)
+            # a commit of another worker, which logged the club it changed
+            def foreign_commit(kind, key):
+                with db.engine.begin() as connection:
+                    connection.execute(CatalogChange.__table__.insert(),
+                                       {'kind': kind, 'key': key, 'changed_at': datetime.datetime.now()})
+                with catalog_version.shared.get_lock():
+                    catalog_version.shared.value += 1
+            foreign_commit('club', 'pppjo')
+            sync_catalog()
+            self.assertEqual(catalog_version.get()[0], version + 1)
+            # only the fragments of the club it changed are dropped, and the snapshot is patched
+            self.assertEqual(fragment_cache.stats()['fragments'], fragments - 1)
+            self.app.get('/api/clubs')
+            self.assertEqual(catalog_snapshot.stats()['rebuilds'], rebuilds)
+            # a commit here after one of another worker that was not synced yet
+            self.app.get('/api/clubs')
+            fragments = fragment_cache.stats()['fragments']
+            foreign_commit('club', 'pppp')
+            catalog_changed(db.session, ['locustlabs'])
+            db.session.commit()
+            self.assertEqual(catalog_version.get()[0], version + 3)
+            self.assertTrue(catalog_version.behind())
+            self.assertEqual(fragment_cache.stats()['fragments'], fragments - 1)
+            # the next sync reads the other worker's change, at a version nothing was cached at
+            sync_catalog()
+            self.assertEqual(catalog_version.get()[0], version + 4)
+            self.assertEqual(fragment_cache.stats()['fragments'], fragments - 2)
+            self.assertFalse(catalog_version.behind())
+            # a reset row stands for every club
+            foreign_commit('reset', '')
+            sync_catalog()
+            self.assertEqual(fragment_cache.stats()['fragments'], 0)
+        finally:
+            catalog_version.shared = None
+            catalog_version.missed = False
+        print("Success\n")
+
+    def test_asgi(self):
+        print("Testing the asgi adapter serves the same responses")
+        from asgi import application
+        for url in ['/api/clubs', '/api/clubs/search?string=penn', '/api/tag/search?tag=undergraduate',
+                    '/api/user?username=josh', '/api/clubs/favorite_users']:
+            path, _, query_string = url.partition('?')
+            response = self.app.get(url)
+            status, headers, body = asgi_request(application, 'GET', path, query_string.encode('latin-1'))
+            self.assertEqual(status, response.status_code, url)
+            self.assertEqual(body, response.data, url)
+        print("Success")
+
+        print("Testing the asgi adapter answers cached and conditional GETs without a query")
+        status, headers, body = asgi_request(application, 'GET', '/api/clubs')
+        with count_queries() as statements:
+            cached = asgi_request(application, 'GET', '/api/clubs')
+            not_modified = asgi_request(application, 'GET', '/api/clubs', headers=[('If-None-Match', headers['etag'])])
+        self.assertEqual(statements, [])
+        self.assertEqual(cached[0], 200)
+        self.assertEqual(cached[2], body)
+        self.assertEqual(cached[1]['content-type'], 'application/json')
+        self.assertEqual(not_modified[0], 304)
+        print("Success")
+
+        print("Testing cached GETs over asgi are counted in the metrics and rate limited")
+        metrics.reset()
+        for _ in range(3):
+            self.assertEqual(asgi_request(application, 'GET', '/api/clubs')[0], 200)
+        totals = metrics.routes[('/api/clubs', 'GET')]
+        self.assertEqual(totals.count, 3)
+        self.assertEqual(totals.statuses, {200: 3})
+        self.assertEqual(totals.response_bytes, 3 * len(body))
+        settings = rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit
+        rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit = True, 1, 2, 0.05
+        rate_limiter.clear()
+        try:
+            # the in-flight slot of a cached search is given back once it is answered
+            search_status = asgi_request(application, 'GET', '/api/clubs/search', b'string=penn')[0]
+            in_flight = rate_limiter.in_flight
+            rate_limiter.clear()
+            statuses = [asgi_request(application, 'GET', '/api/clubs')[0] for _ in range(3)]
+            status, headers, limited_body = asgi_request(application, 'GET', '/api/clubs')
+            stats = rate_limiter.stats()
+        finally:
+            rate_limiter.enabled, rate_limiter.rate, rate_limiter.burst, rate_limiter.tarpit = settings
+        self.assertEqual((search_status, in_flight), (200, 0))
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(status, 429)
+        self.assertEqual(limited_body, b'too many requests')
+        self.assertIn('retry-after', headers)
+        self.assertEqual(stats['limited'], 2)
+        self.assertEqual(metrics.routes[('/api/clubs', 'GET')].statuses.get(429), 2)
+        print("Success")
+
+        print("Testing the asgi adapter raises the errors the app propagates instead of hanging")
+        from flask import Flask
+        from asgi import AsgiAdapter
+        failing = Flask('failing')
+        failing.config['TESTING'] = True
+        @failing.route('/boom')
+        def boom():
+            raise ZeroDivisionError("boom")
+        adapter = AsgiAdapter(failing, workers=1)
+        with self.assertRaises(ZeroDivisionError):
+            asgi_request(adapter, 'GET', '/boom')
+        adapter.executor.shutdown()
+        print("Success")
+
+        print("Testing the asgi adapter handles POST requests")
+        status, headers, body = asgi_request(application, 'POST', '/api/user/favoriting',
+                                             body=json.dumps(dict(session_key= session_key, code= 'pppjo')).encode('utf-8'))
+        self.assertEqual(status, 200)
+        status, headers, body = asgi_request(application, 'GET', '/api/clubs')
+        fav_cnt = {club['code']: club['fav_cnt'] for club in json.loads(body)}
+        self.assertEqual(fav_cnt['pppjo'], 1)
+        print("Success\n")
+
+    def test_metrics(self):
+        print("Testing /api/metrics reports per route figures")
+        self.app.get('/api/clubs')
+        self.app.get('/api/clubs/search?string=penn')
+        self.app.get('/api/clubs/search')
+        self.app.post('/api/user/login', data=json.dumps(dict(email='andy@upenn.edu', password='andyiscool')))
+        response = self.app.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        samples = {}
+        for line in response.data.decode('utf-8').splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        search = 'route="/api/clubs/search",method="GET"'
+        self.assertEqual(samples['http_request_duration_seconds_count{%s}' % search], 2)
+        self.assertEqual(samples['http_request_duration_seconds_bucket{%s,le="+Inf"}' % search], 2)
+        self.assertEqual(samples['http_responses_total{%s,status="200"}' % search], 1)
+        self.assertEqual(samples['http_responses_total{%s,status="406"}' % search], 1)
+        clubs = 'route="/api/clubs",method="GET"'
+        # the first request built the catalog snapshot
+        self.assertEqual(samples['http_request_sql_statements_total{%s}' % clubs], SNAPSHOT_REBUILD_STATEMENTS)
+        self.assertGreater(samples['http_request_phase_seconds_total{%s,phase="sql"}' % clubs], 0)
+        self.assertGreater(samples['http_request_phase_seconds_total{%s,phase="serialization"}' % clubs], 0)
+        self.assertGreater(samples['http_response_bytes_total{%s}' % clubs], 0)
+        login = 'route="/api/user/login",method="POST"'
+        self.assertGreater(samples['http_request_phase_seconds_total{%s,phase="password_hashing"}' % login], 0)
+        print("Success")
+
+        print("Testing slow requests are logged with their sql")
+        metrics.slow_request_ms = 0.001
+        try:
+            with self.assertLogs('clubreview.slow_requests', level='WARNING') as logs:
+                self.app.get('/api/clubs/favorite_users?code=pppjo')
+        finally:
+            metrics.slow_request_ms = 0
+        self.assertIn('/api/clubs/favorite_users', logs.output[0])
+        self.assertIn('FROM user', logs.output[0])
+        print("Success\n")
+
+    def test_migrate(self):
+        print("Testing migrate.py upgrades a db made with the original schema")
+        import migrate
+        db.session.remove()
+        db.drop_all()
+        with db.engine.begin() as connection:
+            for statement in [
+                "CREATE TABLE club (code VARCHAR(100) NOT NULL PRIMARY KEY, name VARCHAR(100) NOT NULL, description VARCHAR)",
+                "CREATE TABLE tag (name VARCHAR NOT NULL PRIMARY KEY UNIQUE)",
+                "CREATE TABLE user (email VARCHAR NOT NULL PRIMARY KEY UNIQUE, username VARCHAR NOT NULL UNIQUE, "
+                "password_hash VARCHAR NOT NULL, session_key VARCHAR(30), session_expiration DATETIME)",
+                "CREATE TABLE clubs2tags (tag_id VARCHAR, club_id VARCHAR(100))",
+                "CREATE TABLE favorites (club_id VARCHAR(100), user_id VARCHAR)",
+                "INSERT INTO club VALUES ('pppjo', 'Penn Juggling', 'juggling'), ('pppal', 'Penn Pals', '')",
+                "INSERT INTO tag VALUES ('undergraduate'), ('literary')",
+                "INSERT INTO user VALUES ('josh@upenn.edu', 'josh', 'x', 'old-session', '2999-01-01 00:00:00.000000')",
+                # duplicate and incomplete links, which the old tables allowed
+                "INSERT INTO clubs2tags VALUES ('undergraduate', 'pppjo'), ('undergraduate', 'pppjo'), "
+                "('undergraduate', 'pppal'), (NULL, 'pppal')",
+                "INSERT INTO favorites VALUES ('pppjo', 'josh@upenn.edu'), ('pppjo', 'josh@upenn.edu')",
+            ]:
+                connection.execute(statement)
+
+        migrate.migrate()
+        migrate.migrate()
+        db.session.remove()
+
+        self.assertEqual(db.session.execute("SELECT count(*) FROM clubs2tags").scalar(), 2)
+        self.assertEqual(db.session.execute("SELECT count(*) FROM favorites").scalar(), 1)
+        self.assertEqual(Club.query.get('pppjo').fav_cnt, 1)
+        self.assertEqual(Tag.query.get('undergraduate').club_cnt, 2)
+        self.assertEqual(Tag.query.get('literary').club_cnt, 0)
+        indexes = set(name for name, in db.session.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+        self.assertIn('ix_clubs2tags_tag_id_club_id', indexes)
+        self.assertIn('ix_favorites_user_id_club_id', indexes)
+        self.assertIn('ix_user_session_expires_at', indexes)
+        self.assertEqual(self.app.post('/api/user/logout',data=json.dumps(dict(
+            session_key='old-session'))).status_code, 200)
+        data = json.loads(self.app.get('/api/clubs/search?string=juggling').data)
+        self.assertEqual([club['code'] for club in data], ['pppjo'])
+        print("Success\n")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file